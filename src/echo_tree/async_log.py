@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+
+'''
+Non-blocking log for servers whose IOLoop must not wait for disk
+or console writes. Callers only append a record to a bounded queue.
+A background thread formats the records, and writes them in batches,
+flushing at most every flushInterval seconds. Records that arrive
+while the queue is full are dropped and counted.
+
+Records are either free text, or structured events: an event name
+plus key=value fields. Large payloads, such as JSON trees, are
+sampled and truncated by the caller via truncatePayload().
+'''
+
+import sys;
+import json;
+import time;
+import datetime;
+import threading;
+from collections import deque;
+
+# Max number of records waiting to be written:
+LOG_QUEUE_SIZE = 10000;
+# Seconds between two batch writes:
+LOG_FLUSH_INTERVAL = 0.5;
+# Max number of characters of a payload that are logged:
+LOG_MAX_PAYLOAD_CHARS = 300;
+
+# ------------------------------- class Async Log Writer ---------------------
+class AsyncLogWriter(threading.Thread):
+    '''
+    Daemon thread draining a queue of log records into one or more files.
+    log() and logEvent() are safe to call from any thread, and never block.
+    '''
+
+    def __init__(self, logFDs, maxQueueSize=LOG_QUEUE_SIZE, flushInterval=LOG_FLUSH_INTERVAL):
+        '''
+        @param logFDs: files to write each record to, e.g. a log file and sys.stdout.
+        @type logFDs: [file]
+        @param maxQueueSize: max number of records waiting to be written.
+        @type maxQueueSize: int
+        @param flushInterval: seconds between two batch writes.
+        @type flushInterval: float
+        '''
+        super(AsyncLogWriter, self).__init__(name='AsyncLogWriter');
+        if maxQueueSize <= 0:
+            raise ValueError("Log queue size must be a positive integer.");
+        self.daemon = True;
+        self.logFDs = logFDs;
+        self.maxQueueSize = maxQueueSize;
+        self.flushInterval = flushInterval;
+        # (time, eventName, text or fields). deque appends and pops need no lock:
+        self.records = deque();
+        self.numLogged = 0;
+        self.numWritten = 0;
+        self.numDropped = 0;
+        self.numDroppedReported = 0;
+        self.keepRunning = True;
+        self.wakeUp = threading.Event();
+
+    def log(self, text):
+        '''
+        Queue a free text record.
+        @return: False if the record was dropped because the queue is full.
+        @rtype: boolean
+        '''
+        return self.enqueue((time.time(), None, text));
+
+    def logEvent(self, eventName, **fields):
+        '''
+        Queue a structured record. Fields are formatted in the writer thread.
+        @param eventName: short name of the event, e.g. 'published'.
+        @type eventName: string
+        @return: False if the record was dropped because the queue is full.
+        @rtype: boolean
+        '''
+        return self.enqueue((time.time(), eventName, fields));
+
+    def enqueue(self, record):
+        # Checked without a lock; the queue may exceed its size by a few records:
+        if len(self.records) >= self.maxQueueSize:
+            self.numDropped += 1;
+            return False;
+        self.records.append(record);
+        self.numLogged += 1;
+        return True;
+
+    def getStats(self):
+        return {'logged'  : self.numLogged,
+                'written' : self.numWritten,
+                'dropped' : self.numDropped,
+                'queued'  : len(self.records)
+                };
+
+    def stop(self):
+        '''
+        Write all queued records, and end the thread.
+        '''
+        self.keepRunning = False;
+        self.wakeUp.set();
+        if self.is_alive():
+            self.join();
+
+    def run(self):
+        while self.keepRunning:
+            self.wakeUp.wait(self.flushInterval);
+            self.writeBatch();
+        self.writeBatch();
+
+    def writeBatch(self):
+        lines = [];
+        try:
+            while True:
+                lines.append(self.formatRecord(self.records.popleft()));
+        except IndexError:
+            pass;
+        if self.numDropped > self.numDroppedReported:
+            lines.append(self.formatRecord((time.time(), 'logDropped', {'numRecords' : self.numDropped - self.numDroppedReported})));
+            self.numDroppedReported = self.numDropped;
+        if len(lines) == 0:
+            return;
+        batch = ''.join(lines);
+        for logFD in self.logFDs:
+            try:
+                logFD.write(batch);
+                logFD.flush();
+            except (IOError, ValueError) as e:
+                sys.stderr.write("Cannot write log: %s\n" % str(e));
+        self.numWritten += len(lines);
+
+    @staticmethod
+    def formatRecord(record):
+        (recordTime, eventName, content) = record;
+        timestamp = str(datetime.datetime.fromtimestamp(recordTime));
+        if eventName is None:
+            if isinstance(content, unicode):
+                content = content.encode('utf-8');
+            return "%s: %s\n" % (timestamp, content);
+        fields = ["%s=%s" % (key, AsyncLogWriter.formatValue(value)) for (key, value) in sorted(content.items())];
+        return "%s: %s %s\n" % (timestamp, eventName, ' '.join(fields));
+
+    @staticmethod
+    def formatValue(value):
+        if isinstance(value, float):
+            return "%.6f" % value;
+        if isinstance(value, basestring):
+            try:
+                return json.dumps(value);
+            except UnicodeDecodeError:
+                return repr(value);
+        return str(value);
+
+def truncatePayload(payload, maxChars=LOG_MAX_PAYLOAD_CHARS):
+    '''
+    Return at most maxChars characters of a payload, marking the cut.
+    @type payload: string
+    @rtype: string
+    '''
+    if len(payload) <= maxChars:
+        return payload;
+    return payload[:maxChars] + '...(%d more)' % (len(payload) - maxChars);
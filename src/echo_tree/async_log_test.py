@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+
+'''
+Tests of the record queue, formatting, and drop accounting of async_log.py.
+'''
+
+import unittest;
+from StringIO import StringIO;
+
+from async_log import AsyncLogWriter, truncatePayload;
+
+class AsyncLogWriterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.logFD = StringIO();
+        # Not started; each test writes the batches itself:
+        self.writer = AsyncLogWriter([self.logFD], maxQueueSize=2);
+
+    def getLines(self):
+        # Strips the timestamps:
+        return [line.split(': ', 1)[1] for line in self.logFD.getvalue().splitlines()];
+
+    def test_full_queue_drops_and_reports(self):
+        self.assertTrue(self.writer.log('first'));
+        self.assertTrue(self.writer.logEvent('published', word='the', numSubscribers=3, seconds=0.5));
+        self.assertFalse(self.writer.log('dropped'));
+        self.assertFalse(self.writer.log('dropped'));
+        self.assertEqual(self.writer.getStats(), {'logged' : 2, 'written' : 0, 'dropped' : 2, 'queued' : 2});
+        self.writer.writeBatch();
+        self.assertEqual(self.getLines(),
+                         ['first',
+                          'published numSubscribers=3 seconds=0.500000 word="the"',
+                          'logDropped numRecords=2']);
+        self.assertEqual(self.writer.getStats(), {'logged' : 2, 'written' : 3, 'dropped' : 2, 'queued' : 0});
+        # Drops are reported once, and the emptied queue takes records again:
+        self.assertTrue(self.writer.log('second'));
+        self.writer.writeBatch();
+        self.writer.writeBatch();
+        self.assertEqual(self.getLines()[3:], ['second']);
+
+    def test_stop_writes_queued_records(self):
+        self.writer.start();
+        self.writer.log(u'caf\xe9');
+        self.writer.logEvent('closed', reason=None);
+        self.writer.stop();
+        self.assertFalse(self.writer.is_alive());
+        self.assertEqual(self.getLines(), ['caf\xc3\xa9', 'closed reason=None']);
+
+    def test_invalid_queue_size(self):
+        self.assertRaises(ValueError, AsyncLogWriter, [self.logFD], maxQueueSize=0);
+
+class TruncatePayloadTest(unittest.TestCase):
+
+    def test_truncate(self):
+        self.assertEqual(truncatePayload('abcde', maxChars=5), 'abcde');
+        self.assertEqual(truncatePayload('abcdefgh', maxChars=5), 'abcde...(3 more)');
+
+if __name__ == '__main__':
+    unittest.main();
@@ -1,11 +1,19 @@
 #!/usr/bin/env python
 
 import os;
+import sys;
+import zlib;
+import urllib;
+import hashlib;
+import threading;
 
 import sqlite3;
 import json;
+from json.encoder import encode_basestring_ascii;
 from collections import OrderedDict;
 
+from follower_graph import MappedFollowerGraph, isGraphFile;
+
 '''
 Module for generating word tree datastructures from an underlying
 database of co-occurrence data in a collection. Provides both 
@@ -15,26 +23,227 @@ Python and JSON results.
 WORD_TREE_BREADTH = 5;
 WORD_TREE_DEPTH   = 3;
 
+# Max number of words bound into one 'word IN (...)' query. SQLite
+# refuses statements with more than 999 host parameters:
+MAX_WORDS_PER_BATCH_QUERY = 500;
+
+# Default budget of the follower cache that WordExplorer
+# instances create for themselves:
+FOLLOWER_CACHE_MAX_ENTRIES = 100000;
+FOLLOWER_CACHE_MAX_BYTES   = None;
+
+# Default budget of the cache of finished trees that
+# WordExplorer instances create for themselves:
+TREE_CACHE_MAX_ENTRIES = 2000;
+TREE_CACHE_MAX_BYTES   = 64 * 1024 * 1024;
+
+# Optional precomputed table holding only the most frequent
+# followers of each word, already in rank order. Created by
+# make_top_followers_table.py. The info table holds the table's K:
+TOP_FOLLOWERS_TABLE      = 'EnronTopFollowers';
+TOP_FOLLOWERS_INFO_TABLE = 'EnronTopFollowersInfo';
+TOP_FOLLOWERS_K          = 20;
+
+# Tables of a precomputed tree store, as made by make_tree_store.py.
+# The store is an SQLite file of its own, so that building it does
+# not modify the word database it was computed from:
+PRECOMPUTED_TREES_TABLE      = 'PrecomputedTrees';
+PRECOMPUTED_TREES_INFO_TABLE = 'PrecomputedTreesInfo';
+PRECOMPUTED_TREES_SUFFIX     = '.trees';
+
+# Per-connection SQLite tuning. Max bytes of the database file
+# that SQLite reads via mmap rather than read() (ignored by
+# SQLite versions without mmap support), and page cache size in KB:
+WORD_DATABASE_MMAP_SIZE     = 512 * 1024 * 1024;
+WORD_DATABASE_CACHE_SIZE_KB = 64 * 1024;
+
+# How WordDatabase opens files read-only, depending on the sqlite3 module
+# and the SQLite library; see getReadOnlyOpenMethod(). Via a URI with 
+# mode=ro (and immutable=1) passed with uri=True, as Python 3 allows; via
+# the same URI as the file name, which SQLite libraries built with 
+# SQLITE_USE_URI interpret; or, if neither works, via the plain file name,
+# with writes refused by PRAGMA query_only, and without immutable:
+READ_ONLY_VIA_URI        = 'uri';
+READ_ONLY_VIA_SQLITE_URI = 'sqlite-uri';
+READ_ONLY_VIA_PRAGMA     = 'query_only';
+
+# Result of getReadOnlyOpenMethod(), once known:
+readOnlyOpenMethod = None;
+
+# ------------------------------- class Tree Computation Cancelled ---------------------
+
+class TreeComputationCancelled(Exception):
+    '''
+    Raised by WordExplorer tree builders when the caller's
+    isCancelled() function reports that the tree is no longer wanted.
+    '''
+    pass
+
+def getDatabaseVersion(dbPath):
+    '''
+    Return a string that changes whenever the given database file is 
+    replaced or modified. Derived from the file's real path, device and 
+    inode numbers, size, and modification time. A file modified in place 
+    within the file system's timestamp granularity without changing size
+    keeps its version.
+    @param dbPath: SQLite or graph file.
+    @type dbPath: string
+    @rtype: string
+    '''
+    dbStat = os.stat(dbPath);
+    return hashlib.md5("%s:%d:%d:%d:%r" % (os.path.realpath(dbPath), dbStat.st_dev, dbStat.st_ino,
+                                           dbStat.st_size, dbStat.st_mtime)).hexdigest()[:16];
+
+def getReadOnlyOpenMethod():
+    '''
+    Return how WordDatabase opens database files read-only in this process:
+    READ_ONLY_VIA_URI, READ_ONLY_VIA_SQLITE_URI, or READ_ONLY_VIA_PRAGMA.
+    Python 2's sqlite3.connect() takes no uri argument, so on Python 2 the
+    read-only and immutable URI parameters only take effect if the SQLite 
+    library interprets URI file names by default.
+    @rtype: string
+    '''
+    global readOnlyOpenMethod;
+    if readOnlyOpenMethod is not None:
+        return readOnlyOpenMethod;
+    try:
+        sqlite3.connect(':memory:', uri=True).close();
+        readOnlyOpenMethod = READ_ONLY_VIA_URI;
+        return readOnlyOpenMethod;
+    except TypeError:
+        pass;
+    conn = sqlite3.connect(':memory:');
+    try:
+        compileOptions = [row[0] for row in conn.execute('PRAGMA compile_options;')];
+    except sqlite3.DatabaseError:
+        compileOptions = [];
+    finally:
+        conn.close();
+    if 'USE_URI' in compileOptions or 'USE_URI=1' in compileOptions:
+        readOnlyOpenMethod = READ_ONLY_VIA_SQLITE_URI;
+    else:
+        readOnlyOpenMethod = READ_ONLY_VIA_PRAGMA;
+    return readOnlyOpenMethod;
+
 # ------------------------------- class Word Database ---------------------
 class WordDatabase(object):
     '''
-    Service class to wrap an underlying SQLite database file.socket
+    Service class to wrap an underlying SQLite database file.
+    Each thread that uses an instance gets its own read-only
+    connection, which is opened on the thread's first access 
+    to the conn attribute. A WordDatabase instance, and thus
+    a WordExplorer, may therefore be shared among threads. 
     '''
     
-    def __init__(self, SQLiteDbPath):
+    def __init__(self, SQLiteDbPath, immutable=True):
         '''
-        Open an SQLite connection to the underlying SQLite database file: 
+        Prepare read-only SQLite connections to the underlying SQLite database file,
+        and open the connection for the calling thread.
         @param SQLiteDbPath: SQLite database file.
         @type SQLiteDbPath: string
+        @param immutable: if True, tell SQLite that the file will not change while
+                          it is open, which avoids all file locking. Ignored if
+                          getReadOnlyOpenMethod() is READ_ONLY_VIA_PRAGMA. Replace, 
+                          rather than modify, database files that are opened this way.
+        @type immutable: boolean
         '''
         self.dbPath = SQLiteDbPath;
+        self.immutable = immutable;
+        # How the connections are opened read-only:
+        self.readOnlyMethod = getReadOnlyOpenMethod();
+        # Holds each thread's connection:
+        self.threadLocal = threading.local();
+        # All connections handed out so far, so that close() can close them:
+        self.connections = [];
+        self.connectionsLock = threading.Lock();
+        # Open the calling thread's connection now, to report problems early:
+        self.conn;
+        # Number of followers per word in the top-followers
+        # table, or None if the database has no such table:
+        self.topK = self.getTopFollowersK();
+        
+    @property
+    def conn(self):
+        '''
+        The calling thread's connection to the database.
+        @rtype: sqlite3.Connection
+        '''
         try:
-            self.conn   = sqlite3.connect(self.dbPath);
+            return self.threadLocal.conn;
+        except AttributeError:
+            pass;
+        conn = self.openConnection();
+        self.threadLocal.conn = conn;
+        with self.connectionsLock:
+            self.connections.append(conn);
+        return conn;
+    
+    def openConnection(self):
+        '''
+        Open a new read-only connection with the tuning pragmas applied.
+        The connection is only used by the thread that opens it, but close()
+        may be called from another thread; hence check_same_thread is off.
+        @rtype: sqlite3.Connection
+        '''
+        if not os.path.isfile(self.dbPath):
+            raise IOError("Database file does not exist: %s" % self.dbPath);
+        uri = 'file:%s?mode=ro' % urllib.quote(os.path.realpath(self.dbPath));
+        if self.immutable:
+            uri += '&immutable=1';
+        try:
+            if self.readOnlyMethod == READ_ONLY_VIA_URI:
+                conn = sqlite3.connect(uri, uri=True, check_same_thread=False);
+            elif self.readOnlyMethod == READ_ONLY_VIA_SQLITE_URI:
+                conn = sqlite3.connect(uri, check_same_thread=False);
+            else:
+                conn = sqlite3.connect(self.dbPath, check_same_thread=False);
+            # The only protection against writes with READ_ONLY_VIA_PRAGMA:
+            conn.execute('PRAGMA query_only = 1;');
+            conn.execute('PRAGMA mmap_size = %d;' % WORD_DATABASE_MMAP_SIZE);
+            conn.execute('PRAGMA cache_size = -%d;' % WORD_DATABASE_CACHE_SIZE_KB);
         except Exception as e:
             raise IOError(`e` + ": %s" % self.dbPath);
+        return conn;
+        
+    def getTopFollowersK(self):
+        '''
+        Return the number of followers per word that are stored in 
+        the precomputed TOP_FOLLOWERS_TABLE, or None if that table
+        was not created for this database.
+        @rtype: {int | None}
+        '''
+        cursor = self.conn.cursor();
+        try:
+            cursor.execute('SELECT topK from %s;' % TOP_FOLLOWERS_INFO_TABLE);
+            row = cursor.fetchone();
+        except sqlite3.OperationalError:
+            # No such table:
+            return None;
+        finally:
+            cursor.close();
+        if row is None:
+            return None;
+        return row[0];
+    
+    def coversNumFollowers(self, numFollowers):
+        '''
+        Return True if requests for numFollowers followers of a word
+        can be answered from the top-followers table.
+        @param numFollowers: number of followers needed. None for all followers.
+        @type numFollowers: {int | None}
+        '''
+        return self.topK is not None and numFollowers is not None and numFollowers <= self.topK;
         
     def close(self):
-        pass;
+        '''
+        Close the connections of all threads.
+        '''
+        with self.connectionsLock:
+            for conn in self.connections:
+                conn.close();
+            self.connections = [];
+        # Subsequent accesses to conn from any thread open new connections:
+        self.threadLocal = threading.local();
 
 # ------------------------------- class Word Follower ---------------------
 class WordFollower(object):
@@ -45,17 +254,23 @@ class WordFollower(object):
     exceptions. See Python contextmanager.
     '''
 
-    def __init__(self, db, word):
+    def __init__(self, db, word, maxFollowers=None):
         '''
         Provides a tuple generator, given a WordDatabase instance 
         that accesses a word co-occurrence file, and a root word.
+        If the database has a top-followers table that holds at
+        least maxFollowers followers per word, only that table's
+        rows for the word are returned. 
         @param db: WordDatabase instance that wraps an SQLite co-occurrence file.
         @type db: WordDatabase
         @param word: Root word, whose follower words are to be found.
         @type word: string
+        @param maxFollowers: number of followers the caller needs. None for all followers.
+        @type maxFollowers: {int | None}
         '''
         self.db   = db;
         self.word = word;
+        self.useTopFollowers = db.coversNumFollowers(maxFollowers);
         
     def __enter__(self):
         '''
@@ -69,7 +284,11 @@ class WordFollower(object):
         # Necessary so that the ordering isn't alpha. This even
         # thought the followingCount is declared as int:
         try:
-            self.cursor.execute('SELECT follower,followingCount from EnronWords where word="%s" ORDER BY followingCount*1 desc;' % self.word);
+            if self.useTopFollowers:
+                # Index-only lookup; rows are stored in rank order:
+                self.cursor.execute('SELECT follower,followingCount from %s where word=? ORDER BY rank;' % TOP_FOLLOWERS_TABLE, (self.word,));
+            else:
+                self.cursor.execute('SELECT follower,followingCount from EnronWords where word=? ORDER BY followingCount*1 desc;', (self.word,));
         except sqlite3.OperationalError as e:
             raise ValueError("SELECT statement failed for word '%s' in databse '%s': %s" % (self.word, self.db.dbPath, `e`));
             
@@ -92,7 +311,408 @@ class WordFollower(object):
             # exception occurred in the caller's with clause:
             pass;
         self.cursor.close();
+
+# ------------------------------- class Word Follower Batch ---------------------
+class WordFollowerBatch(WordFollower):
+    '''
+    Like WordFollower, but fetches the followers of several
+    root words with a single SELECT. Rows are triplets
+    <word><followerWord><count>, ordered by decreasing count
+    the same way WordFollower orders them for a single word.
+    Used by WordExplorer to retrieve all followers of one
+    tree level in a single database round trip.
+    '''
+
+    def __init__(self, db, words, maxFollowers=None):
+        '''
+        Provides a tuple generator for the followers of all given words.
+        @param db: WordDatabase instance that wraps an SQLite co-occurrence file.
+        @type db: WordDatabase
+        @param words: Root words, whose follower words are to be found. At most
+                      MAX_WORDS_PER_BATCH_QUERY words.
+        @type words: [string]
+        @param maxFollowers: number of followers the caller needs per word. None for all followers.
+        @type maxFollowers: {int | None}
+        '''
+        super(WordFollowerBatch, self).__init__(db, None, maxFollowers);
+        self.words = words;
+
+    def __enter__(self):
+        '''
+        Method required by contextmanager. Create a new cursor,
+        then initializes a tuple stream <word><followerWord><count>.
+        @return: initialized database cursor.
+        @rtype: sqlite3.cursor
+        '''
+        self.cursor = self.db.conn.cursor();
+        placeholders = ','.join(['?'] * len(self.words));
+        try:
+            if self.useTopFollowers:
+                self.cursor.execute('SELECT word,follower,followingCount from %s where word IN (%s) ORDER BY word,rank;' % (TOP_FOLLOWERS_TABLE, placeholders),
+                                    self.words);
+            else:
+                self.cursor.execute('SELECT word,follower,followingCount from EnronWords where word IN (%s) ORDER BY followingCount*1 desc;' % placeholders,
+                                    self.words);
+        except sqlite3.OperationalError as e:
+            raise ValueError("SELECT statement failed for words %s in databse '%s': %s" % (str(self.words), self.db.dbPath, `e`));
+        return self.cursor;
+        
+# ------------------------------- class Word Tree Node ---------------------
+class WordTreeNode(object):
+    '''
+    Lightweight node of a word tree. Used by WordExplorer in place of
+    one OrderedDict per node. Nodes may be read like the dict based
+    trees, i.e. node['word'] and node['followWordObjs'] work. Use
+    encodeWordTree() or WordExplorer.makeJSONTree() to obtain the
+    JSON string; json.dumps() does not handle nodes.
+    '''
+    __slots__ = ('word', 'followWordObjs');
+    
+    def __init__(self, word):
+        '''
+        Create a node without followers.
+        @param word: the node's word.
+        @type word: string
+        '''
+        self.word = word;
+        self.followWordObjs = [];
+    
+    def __getitem__(self, key):
+        if key == 'word':
+            return self.word;
+        if key == 'followWordObjs':
+            return self.followWordObjs;
+        raise KeyError(key);
+    
+    def toDict(self):
+        '''
+        Return the tree rooted at this node as the equivalent
+        structure of nested OrderedDicts.
+        @rtype: OrderedDict
+        '''
+        wordTree = OrderedDict();
+        wordTree['word'] = self.word;
+        wordTree['followWordObjs'] = [subtree.toDict() for subtree in self.followWordObjs];
+        return wordTree;
+
+def encodeWordTree(wordTree):
+    '''
+    Return the JSON string for a tree of WordTreeNode instances. The
+    result is identical to json.dumps() of the equivalent OrderedDict
+    tree, i.e. the EchoTree wire format with 'word' before 'followWordObjs'.
+    @param wordTree: root of the tree.
+    @type wordTree: WordTreeNode
+    @rtype: string
+    '''
+    parts = [];
+    encodeWordTreeHelper(wordTree, parts);
+    return ''.join(parts);
+
+def encodeWordTreeHelper(wordTree, parts):
+    parts.append('{"word": ');
+    parts.append('null' if wordTree.word is None else encode_basestring_ascii(wordTree.word));
+    parts.append(', "followWordObjs": [');
+    for i, subtree in enumerate(wordTree.followWordObjs):
+        if i > 0:
+            parts.append(', ');
+        encodeWordTreeHelper(subtree, parts);
+    parts.append(']}');
+
+# ------------------------------- class LRU Cache ---------------------
+class LRUCache(object):
+    '''
+    Base class for the bounded caches of this module. Holds at most
+    maxEntries entries, and entries of (approximately) maxBytes bytes
+    in total. When either budget is exceeded, the least recently used
+    entries are evicted. Hits, misses, and evictions are counted.
+    See getStats(). Subclasses provide the type specific get() and put()
+    methods on top of lookup() and store().
+    '''
+    
+    def __init__(self, maxEntries=None, maxBytes=None):
+        '''
+        Create an empty cache.
+        @param maxEntries: max number of entries. None for no limit.
+        @type maxEntries: {int | None}
+        @param maxBytes: max approximate memory taken by the cached values. None for no limit.
+        @type maxBytes: {int | None}
+        '''
+        if maxEntries is not None and maxEntries <= 0:
+            raise ValueError("Maximum number of cache entries must be a positive integer, or None.");
+        if maxBytes is not None and maxBytes <= 0:
+            raise ValueError("Maximum number of cache bytes must be a positive integer, or None.");
+        self.maxEntries = maxEntries;
+        self.maxBytes   = maxBytes;
+        # Every access, even a lookup, reorders the entries. Subclasses
+        # hold this lock around get() and put() as well:
+        self.lock = threading.RLock();
+        self.clear();
+        
+    def clear(self):
+        '''
+        Remove all entries, and reset the counters.
+        '''
+        with self.lock:
+            # key --> (value, numBytes). Least recently used entries first:
+            self.entries   = OrderedDict();
+            self.numBytes  = 0;
+            self.hits      = 0;
+            self.misses    = 0;
+            self.evictions = 0;
+        
+    def __len__(self):
+        return len(self.entries);
+    
+    def __contains__(self, key):
+        return key in self.entries;
+    
+    def getKeys(self, maxKeys=None):
+        '''
+        Return the keys of the cache, most recently used first.
+        @param maxKeys: max number of keys to return. None for all.
+        @type maxKeys: {int | None}
+        @rtype: [object]
+        '''
+        with self.lock:
+            keys = self.entries.keys();
+        keys.reverse();
+        return keys[:maxKeys];
+    
+    def lookup(self, key):
+        '''
+        Return the value cached under the given key, and mark
+        the entry as most recently used. Does not count a hit,
+        because subclasses may reject the value. Counts a miss 
+        if the key is not cached.
+        @raise KeyError: if the key is not cached.
+        '''
+        with self.lock:
+            try:
+                entry = self.entries.pop(key);
+            except KeyError:
+                self.misses += 1;
+                raise KeyError(key);
+            # Re-insert to mark as most recently used:
+            self.entries[key] = entry;
+            return entry[0];
+    
+    def store(self, key, value, numBytes):
+        '''
+        Add or replace the value cached under the given key,
+        evicting least recently used entries as needed. The
+        newest entry is never evicted.
+        @param numBytes: approximate memory taken by value.
+        @type numBytes: int
+        '''
+        with self.lock:
+            try:
+                self.numBytes -= self.entries.pop(key)[1];
+            except KeyError:
+                pass;
+            self.entries[key] = (value, numBytes);
+            self.numBytes += numBytes;
+            while len(self.entries) > 1 and \
+                 ((self.maxEntries is not None and len(self.entries) > self.maxEntries) or \
+                  (self.maxBytes is not None and self.numBytes > self.maxBytes)):
+                (dummyKey, evictedEntry) = self.entries.popitem(last=False);
+                self.numBytes -= evictedEntry[1];
+                self.evictions += 1;
+            
+    def getStats(self):
+        '''
+        Return the cache's counters and current size.
+        @return: dict with keys hits, misses, evictions, entries, bytes, and hitRatio.
+        @rtype: {string : number}
+        '''
+        with self.lock:
+            numLookups = self.hits + self.misses;
+            return {'hits'      : self.hits,
+                    'misses'    : self.misses,
+                    'evictions' : self.evictions,
+                    'entries'   : len(self.entries),
+                    'bytes'     : self.numBytes,
+                    'hitRatio'  : float(self.hits) / numLookups if numLookups > 0 else 0.0
+                    };
+
+# ------------------------------- class Follower Cache ---------------------
+class FollowerCache(LRUCache):
+    '''
+    Bounded LRU cache of frequency sorted follower arrays, keyed by root
+    word. Used by WordExplorer to avoid repeated database lookups.
+    
+    Callers state how many followers they need. Unless truncation
+    is turned off, follower arrays are stored only up to the largest
+    such number requested so far. A truncated entry that is too short
+    for a later, larger request counts as a miss.
+    
+    Alternative caches may be passed to WordExplorer, as long as
+    they provide get(), put(), clear(), and getStats().
+    '''
+    
+    def __init__(self, maxEntries=FOLLOWER_CACHE_MAX_ENTRIES, maxBytes=FOLLOWER_CACHE_MAX_BYTES, truncate=True):
+        '''
+        Create an empty cache.
+        @param maxEntries: max number of words to cache. None for no limit.
+        @type maxEntries: {int | None}
+        @param maxBytes: max approximate memory taken by the cached follower arrays. None for no limit.
+        @type maxBytes: {int | None}
+        @param truncate: if True, only store as many followers of each word as the
+                         largest number of followers requested so far.
+        @type truncate: boolean
+        '''
+        super(FollowerCache, self).__init__(maxEntries, maxBytes);
+        self.truncate   = truncate;
+        # Largest number of followers requested in any call to get(). 
+        # None once any caller asked for all followers of a word:
+        self.largestBreadth = 0;
+    
+    def get(self, word, numFollowers=None):
+        '''
+        Return the cached follower array of the given word.
+        @param word: root word whose followers are requested.
+        @type word: string
+        @param numFollowers: number of followers the caller will use. None if all followers are needed.
+        @type numFollowers: {int | None}
+        @return: frequency sorted follower array. May be longer than numFollowers.
+        @rtype: [string]
+        @raise KeyError: if the word is not cached, or only cached with too few followers. 
+        '''
+        with self.lock:
+            if numFollowers is None:
+                self.largestBreadth = None;
+            elif self.largestBreadth is not None:
+                self.largestBreadth = max(self.largestBreadth, numFollowers);
+            (followerArr, isTruncated) = self.lookup(word);
+            if isTruncated and (numFollowers is None or numFollowers > len(followerArr)):
+                self.misses += 1;
+                raise KeyError(word);
+            self.hits += 1;
+            return followerArr;
+    
+    def put(self, word, followerArr, isComplete=True):
+        '''
+        Add or replace the follower array of the given word,
+        evicting least recently used entries as needed.
+        @param word: root word.
+        @type word: string
+        @param followerArr: followers of the word, sorted by decreasing frequency.
+        @type followerArr: [string]
+        @param isComplete: False if followerArr holds only the word's most frequent followers.
+        @type isComplete: boolean
+        '''
+        isTruncated = not isComplete;
+        # Read once; other threads may raise it concurrently:
+        largestBreadth = self.largestBreadth;
+        if self.truncate and largestBreadth and len(followerArr) > largestBreadth:
+            followerArr = followerArr[:largestBreadth];
+            isTruncated = True;
+        numBytes = sys.getsizeof(word) + sys.getsizeof(followerArr) + sum([sys.getsizeof(follower) for follower in followerArr]);
+        self.store(word, (followerArr, isTruncated), numBytes);
+
+# ------------------------------- class Tree Cache ---------------------
+class TreeCache(LRUCache):
+    '''
+    Bounded LRU cache of finished word trees, keyed by root word,
+    tree depth, and tree breadth. Each entry holds both the Python
+    tree and its JSON string, so a repeated request needs neither
+    follower lookups nor JSON encoding. Callers must not modify
+    the Python trees they obtain from the cache.
+    '''
+    
+    def __init__(self, maxEntries=TREE_CACHE_MAX_ENTRIES, maxBytes=TREE_CACHE_MAX_BYTES):
+        '''
+        Create an empty cache.
+        @param maxEntries: max number of trees to cache. None for no limit.
+        @type maxEntries: {int | None}
+        @param maxBytes: max approximate memory taken by the cached trees. None for no limit.
+        @type maxBytes: {int | None}
+        '''
+        super(TreeCache, self).__init__(maxEntries, maxBytes);
+    
+    def get(self, word, maxDepth, maxBranch):
+        '''
+        Return the cached tree for the given root word and tree shape.
+        @return: the Python tree, and its JSON string.
+        @rtype: (OrderedDict, string)
+        @raise KeyError: if no such tree is cached.
+        '''
+        with self.lock:
+            trees = self.lookup((word, maxDepth, maxBranch));
+            self.hits += 1;
+            return trees;
+    
+    def put(self, word, maxDepth, maxBranch, wordTree, jsonTree):
+        '''
+        Add or replace the cached tree for the given root word and tree shape.
+        @param wordTree: Python tree as returned by WordExplorer.makeWordTree().
+        @type wordTree: OrderedDict
+        @param jsonTree: JSON encoding of wordTree.
+        @type jsonTree: string
+        '''
+        numBytes = sys.getsizeof(jsonTree) + self.getTreeSize(wordTree);
+        self.store((word, maxDepth, maxBranch), (wordTree, jsonTree), numBytes);
         
+    def getTreeSize(self, wordTree):
+        '''
+        Return the approximate memory taken by the given Python tree.
+        '''
+        if wordTree is None:
+            return 0;
+        numBytes = sys.getsizeof(wordTree) + sys.getsizeof(wordTree['word']) + sys.getsizeof(wordTree['followWordObjs']);
+        for subtree in wordTree['followWordObjs']:
+            numBytes += self.getTreeSize(subtree);
+        return numBytes;
+
+# ------------------------------- class Precomputed Tree Store ---------------------
+class PrecomputedTreeStore(object):
+    '''
+    Read-only collection of JSON trees that make_tree_store.py computed ahead
+    of time, typically for the most frequent words. All trees are loaded 
+    into memory when the store is opened. The trees have one depth and breadth;
+    requests for other tree shapes, or for words not in the store, get None.
+    '''
+    
+    def __init__(self, storePath, dbPath=None):
+        '''
+        Load the trees of a store file.
+        @param storePath: file written by make_tree_store.py.
+        @type storePath: string
+        @param dbPath: word database the trees are to match. If given, the
+                       store is refused unless it was computed from the 
+                       database's current version.
+        @type dbPath: {string | None}
+        @raise IOError: if the file does not exist, or is not a tree store.
+        @raise ValueError: if the store was computed from a different version of dbPath.
+        '''
+        if not os.path.isfile(storePath):
+            raise IOError("Tree store %s does not exist." % storePath);
+        conn = sqlite3.connect(storePath);
+        try:
+            try:
+                (sourceVersion, self.maxDepth, self.maxBranch) = conn.execute('SELECT sourceVersion, maxDepth, maxBranch FROM %s;' % PRECOMPUTED_TREES_INFO_TABLE).fetchone();
+            except (sqlite3.DatabaseError, TypeError):
+                raise IOError("File %s is not a complete tree store." % storePath);
+            self.sourceVersion = str(sourceVersion);
+            if dbPath is not None and self.sourceVersion != getDatabaseVersion(dbPath):
+                raise ValueError("Tree store %s was computed from an earlier version of %s." % (storePath, dbPath));
+            self.trees = {};
+            for (word, compressedTree) in conn.execute('SELECT word, compressedTree FROM %s;' % PRECOMPUTED_TREES_TABLE):
+                self.trees[word.encode('utf-8')] = zlib.decompress(compressedTree);
+        finally:
+            conn.close();
+    
+    def __len__(self):
+        return len(self.trees);
+    
+    def get(self, word, maxDepth, maxBranch):
+        '''
+        @return: the JSON tree of the given root word and shape, or None if not stored.
+        @rtype: {string | None}
+        '''
+        if maxDepth != self.maxDepth or maxBranch != self.maxBranch:
+            return None;
+        return self.trees.get(word);
+
 # ------------------------------- class Word Explorer ---------------------        
 class WordExplorer(object):
     '''
@@ -102,16 +722,94 @@ class WordExplorer(object):
     WordTree := {"word" : <rootWord>,"followWordObjs" : [WordTree1, WordTree2, ...]}
     '''
     
-    def __init__(self, dbPath):
+    def __init__(self, dbPath, breadthFirst=True, cache=None, graph=None, treeCache=None, compactTrees=True, treeStore=None):
         '''
         Create new WordExplorer that can be used for multiple tree creation requests.
-        @param dbPath: Path to SQLite word co-occurrence file.
+        Followers are looked up either in an SQLite file, or in a FollowerGraph
+        or MappedFollowerGraph (see follower_graph.py).
+        @param dbPath: Path to SQLite word co-occurrence file, or to a graph file as
+                       written by FollowerGraph.writeGraphFile(). Graph files are
+                       memory mapped. Ignored if graph is provided.
+        @type dbPath: string
+        @param breadthFirst: if True, makeWordTree() builds trees one level at a time,
+                             fetching the followers of all words in a level with a 
+                             single query. If False, trees are built by depth-first
+                             recursion with one query per node. Both produce the same tree.
+        @type breadthFirst: boolean
+        @param cache: cache for follower arrays. If None, a FollowerCache with
+                      default budget is created.
+        @type cache: FollowerCache
+        @param graph: in-memory follower graph to use instead of the SQLite file. 
+                      Lookups in the graph are not cached.
+        @type graph: FollowerGraph
+        @param treeCache: cache for finished trees, used by makeWordTreeAndJSON(). If None,
+                          a TreeCache with default budget is created.
+        @type treeCache: TreeCache
+        @param compactTrees: if True, breadth-first built trees consist of WordTreeNode 
+                             instances, rather than OrderedDicts.
+        @type compactTrees: boolean
+        @param treeStore: precomputed trees that makeWordTreeAndJSON() returns without
+                          building them. Must match the database.
+        @type treeStore: {PrecomputedTreeStore | None}
+        '''
+        if cache is None:
+            cache = FollowerCache();
+        if treeCache is None:
+            treeCache = TreeCache();
+        self.cache = cache;
+        self.treeCache = treeCache;
+        self.breadthFirst = breadthFirst;
+        self.compactTrees = compactTrees;
+        self.treeStore = treeStore;
+        self.db = None;
+        self.graph = None;
+        # True if self.graph was mapped by this explorer, rather than passed in:
+        self.ownsGraph = False;
+        self.useDatabase(dbPath, graph);
+        
+    def useDatabase(self, dbPath, graph=None):
+        '''
+        Look up followers in the given database or graph from now on.
+        Empties the follower and tree caches, since their content 
+        was derived from the previous database, and closes the previous
+        database. Only call while no other thread builds a tree with
+        this explorer.
+        @param dbPath: Path to SQLite word co-occurrence file, or to a graph file.
+                       Ignored if graph is provided.
         @type dbPath: string
+        @param graph: follower graph to use instead of a file. The explorer
+                      does not close it.
+        @type graph: {FollowerGraph | MappedFollowerGraph}
         '''
-        self.cache = {};
-        self.db = WordDatabase(dbPath);
+        ownsGraph = False;
+        if graph is None and isGraphFile(dbPath):
+            graph = MappedFollowerGraph(dbPath);
+            ownsGraph = True;
+        newDb = None;
+        if graph is None:
+            newDb = WordDatabase(dbPath);
+        self.close();
+        self.db = newDb;
+        self.graph = graph;
+        self.ownsGraph = ownsGraph;
+        self.cache.clear();
+        self.treeCache.clear();
 
-    def getSortedFollowers(self, word):
+    def close(self):
+        '''
+        Close the explorer's database connections, or unmap the graph file
+        it mapped itself. Only call once no thread builds trees with this 
+        explorer; afterwards, only useDatabase() may be called.
+        '''
+        if self.db is not None:
+            self.db.close();
+            self.db = None;
+        if self.ownsGraph:
+            self.graph.close();
+            self.graph = None;
+            self.ownsGraph = False;
+
+    def getSortedFollowers(self, word, maxFollowers=None):
         '''
         Return an array of follow-words for the given root word.
         The array is sorted by decreasing frequency. A cache
@@ -120,14 +818,19 @@ class WordExplorer(object):
         After the first request, follow-ons will therefore be fast.   
         @param word: root word for the new WordTree.
         @type word: string
+        @param maxFollowers: number of followers the caller will use. The
+                             returned array may be longer. None to get all followers.
+        @type maxFollowers: {int | None}
         '''
+        if self.graph is not None:
+            return self.graph.getSortedFollowers(word, maxFollowers);
 
         try:
-            frequencySortedWordArr = self.cache[word];
+            frequencySortedWordArr = self.cache.get(word, maxFollowers);
         except KeyError:
             # Not cached yet:
             wordArr = []; 
-            with WordFollower(self.db, word) as followers:
+            with WordFollower(self.db, word, maxFollowers) as followers:
                 for followerWordPlusCount in followers:
                     wordArr.append(followerWordPlusCount);
             # Sort array in place, using element 1 (the count) as
@@ -138,11 +841,64 @@ class WordExplorer(object):
             frequencySortedWordArr = [];
             for wordPlusCount in wordArr:
                 frequencySortedWordArr.append(wordPlusCount[0]);
-            self.cache[word] = frequencySortedWordArr;
+            self.cache.put(word, frequencySortedWordArr, self.isCompleteFollowerArr(frequencySortedWordArr, maxFollowers));
         return frequencySortedWordArr;
+    
+    def isCompleteFollowerArr(self, followerArr, maxFollowers):
+        '''
+        Return False if the given follower array, retrieved from the database 
+        for a request of maxFollowers followers, might lack some of the word's
+        followers. That is the case when the array was read from a full 
+        top-followers table entry.
+        @param followerArr: follower array as retrieved from the database.
+        @type followerArr: [string]
+        @param maxFollowers: number of followers requested from the database.
+        @type maxFollowers: {int | None}
+        '''
+        return not self.db.coversNumFollowers(maxFollowers) or len(followerArr) < self.db.topK;
+    
+    def getSortedFollowersBatch(self, words, maxFollowers=None):
+        '''
+        Return a dict mapping each of the given words to its array of 
+        follow-words, sorted by decreasing frequency just like the
+        result of getSortedFollowers(). Words not in the cache are
+        retrieved from the database in as few queries as possible 
+        (normally one), and are then added to the cache.
+        @param words: root words whose followers are requested. Duplicates are allowed.
+        @type words: [string]
+        @param maxFollowers: number of followers the caller will use for each word. The
+                             returned arrays may be longer. None to get all followers.
+        @type maxFollowers: {int | None}
+        @return: dict mapping each given word to its follower array.
+        @rtype: {string : [string]}
+        '''
+        if self.graph is not None:
+            return self.graph.getSortedFollowersBatch(words, maxFollowers);
+        followersByWord = {};
+        missingWords = [];
+        for word in words:
+            if word in followersByWord:
+                continue;
+            try:
+                followersByWord[word] = self.cache.get(word, maxFollowers);
+            except KeyError:
+                # Not cached yet. Collect for the batch query:
+                followersByWord[word] = [];
+                missingWords.append(word);
+        
+        for batchStart in range(0, len(missingWords), MAX_WORDS_PER_BATCH_QUERY):
+            batchWords = missingWords[batchStart:batchStart + MAX_WORDS_PER_BATCH_QUERY];
+            with WordFollowerBatch(self.db, batchWords, maxFollowers) as followers:
+                # Rows arrive sorted by count; appending preserves
+                # that order within each word's follower array:
+                for (word, followerWord, dummyCount) in followers:
+                    followersByWord[word].append(followerWord);
+            for word in batchWords:
+                self.cache.put(word, followersByWord[word], self.isCompleteFollowerArr(followersByWord[word], maxFollowers));
+        return followersByWord;
       
       
-    def makeWordTree(self, word, wordTree=None, maxDepth=WORD_TREE_DEPTH, maxBranch=WORD_TREE_BREADTH):
+    def makeWordTree(self, word, wordTree=None, maxDepth=WORD_TREE_DEPTH, maxBranch=WORD_TREE_BREADTH, isCancelled=None):
         '''
         Return a Python WordTree structure in which the
         followWordObjs are sorted by decreasing frequency. This
@@ -158,36 +914,152 @@ class WordExplorer(object):
                           The followWords chosen are by frequency with which the followWord follows
                           the respective word (content of parm word).
         @type maxBranch: int
+        @param isCancelled: optional function without arguments. Polled while the tree
+                            is built. If it returns True, the build is abandoned.
+        @type isCancelled: callable
         @return: new EchoTree Python structure
         @rtype: string
+        @raise TreeComputationCancelled: if isCancelled() returned True.
         '''
+        if self.breadthFirst and wordTree is None:
+            return self.makeWordTreeBreadthFirst(word, maxDepth=maxDepth, maxBranch=maxBranch, isCancelled=isCancelled);
         # Recursion bottomed out:
         if maxDepth <= 0:
             return wordTree;
+        if isCancelled is not None and isCancelled():
+            raise TreeComputationCancelled(word);
         if wordTree is None:
             # Use OrderedDict so that conversions to JSON show the 'word' key first:
             wordTree = OrderedDict();
         wordTree['word'] = word;
         wordTree['followWordObjs'] = []
-        for i,followerWord in enumerate(self.getSortedFollowers(word)):
+        for i,followerWord in enumerate(self.getSortedFollowers(word, maxBranch)):
             # Curtail the tree breadth, i.e. number of follow words we pursue:
             if i >= maxBranch:
                 return wordTree;
             # Each member of the followWordOjbs array is its own tree:
             followerTree = OrderedDict();
-            newSubtree = self.makeWordTree(followerWord, followerTree, maxDepth-1);
+            newSubtree = self.makeWordTree(followerWord, followerTree, maxDepth-1, maxBranch, isCancelled);
             # Don't enter empty dictionaries into the array:
             if len(newSubtree) > 0:
                 wordTree['followWordObjs'].append(newSubtree);
         return wordTree;
     
+    def makeWordTreeBreadthFirst(self, word, maxDepth=WORD_TREE_DEPTH, maxBranch=WORD_TREE_BREADTH, isCancelled=None):
+        '''
+        Return the same WordTree structure as the recursive makeWordTree(), but 
+        build it one tree level at a time. The followers of all words in a level 
+        are retrieved with one batched query, so a tree costs at most maxDepth-1
+        database round trips, rather than one per node. Words in the
+        bottom level are never looked up, since their followers are not shown.
+        @param word: root word for the new WordTree
+        @type word: string
+        @param maxDepth: number of levels in the tree, including the root.
+        @type maxDepth: int
+        @param maxBranch: max number of followWords pursued for each word.
+        @type maxBranch: int
+        @param isCancelled: optional function without arguments, polled before each
+                            level is built. If it returns True, the build is abandoned.
+        @type isCancelled: callable
+        @return: new EchoTree Python structure
+        @rtype: {WordTreeNode | OrderedDict}, depending on the compactTrees setting.
+        @raise TreeComputationCancelled: if isCancelled() returned True.
+        '''
+        if maxDepth <= 0:
+            return None;
+        if self.compactTrees:
+            makeNode = WordTreeNode;
+        else:
+            makeNode = self.makeDictNode;
+        wordTree = makeNode(word);
+        # Subtrees of the current level, whose children are to be added next:
+        frontier = [wordTree];
+        for dummyLevel in range(maxDepth - 1):
+            if isCancelled is not None and isCancelled():
+                raise TreeComputationCancelled(word);
+            followersByWord = self.getSortedFollowersBatch([subtree['word'] for subtree in frontier], maxBranch);
+            nextFrontier = [];
+            for subtree in frontier:
+                followWordObjs = subtree['followWordObjs'];
+                for followerWord in followersByWord[subtree['word']][:maxBranch]:
+                    followerTree = makeNode(followerWord);
+                    followWordObjs.append(followerTree);
+                    nextFrontier.append(followerTree);
+            if len(nextFrontier) == 0:
+                break;
+            frontier = nextFrontier;
+        return wordTree;
+    
+    def makeDictNode(self, word):
+        '''
+        Return a tree node without followers as an OrderedDict.
+        '''
+        # Use OrderedDict so that conversions to JSON show the 'word' key first:
+        wordTree = OrderedDict();
+        wordTree['word'] = word;
+        wordTree['followWordObjs'] = [];
+        return wordTree;
+    
+    def makeWordTreeAndJSON(self, word, maxDepth=WORD_TREE_DEPTH, maxBranch=WORD_TREE_BREADTH, isCancelled=None):
+        '''
+        Return both the Python WordTree structure for the given root 
+        word, as makeWordTree() would build it, and its JSON encoding.
+        Trees are served from the tree store or the tree cache when possible. 
+        The returned Python tree may be shared with other callers, and must not
+        be modified. For trees from the tree store it is None.
+        @param word: root word for the new WordTree
+        @type word: string
+        @param maxDepth: How deep the tree should grow. See makeWordTree().
+        @type maxDepth: int
+        @param maxBranch: max breadth of each branch. See makeWordTree().
+        @type maxBranch: int
+        @param isCancelled: optional cancellation test. See makeWordTree().
+        @type isCancelled: callable
+        @return: the Python tree, and its JSON string.
+        @rtype: ({OrderedDict | None}, string)
+        @raise TreeComputationCancelled: if isCancelled() returned True before the tree was done.
+        '''
+        if self.treeStore is not None:
+            jsonTree = self.treeStore.get(word, maxDepth, maxBranch);
+            if jsonTree is not None:
+                return (None, jsonTree);
+        try:
+            return self.treeCache.get(word, maxDepth, maxBranch);
+        except KeyError:
+            pass;
+        wordTree = self.makeWordTree(word, maxDepth=maxDepth, maxBranch=maxBranch, isCancelled=isCancelled);
+        jsonTree = self.makeJSONTree(wordTree);
+        self.treeCache.put(word, maxDepth, maxBranch, wordTree, jsonTree);
+        return (wordTree, jsonTree);
+    
+    def warmUp(self, treeKeys):
+        '''
+        Compute and cache the trees of the given keys, typically the most
+        recently used keys of another WordExplorer's tree cache. Fills the
+        follower cache along the way. Trees in the tree store are skipped.
+        Trees are computed in the given order; the last ends up most recently used.
+        @param treeKeys: (word, maxDepth, maxBranch) of each tree.
+        @type treeKeys: [(string, int, int)]
+        @return: number of trees computed.
+        @rtype: int
+        '''
+        numComputed = 0;
+        for (word, maxDepth, maxBranch) in treeKeys:
+            if self.treeStore is not None and self.treeStore.get(word, maxDepth, maxBranch) is not None:
+                continue;
+            self.makeWordTreeAndJSON(word, maxDepth=maxDepth, maxBranch=maxBranch);
+            numComputed += 1;
+        return numComputed;
+    
     def makeJSONTree(self, wordTree):
         '''
         Given a WordTree structure created by makeWordTree, return
         an equivalent JSON tree.
         @param wordTree: Word tree structure emanating from a root word.
-        @type wordTree: {}
+        @type wordTree: {WordTreeNode | OrderedDict}
         '''
+        if isinstance(wordTree, WordTreeNode):
+            return encodeWordTree(wordTree);
         return json.dumps(wordTree);
       
                 
@@ -8,22 +8,64 @@ Module holding three servers:
       This server pushes new EchoTrees as they arrive via (2.). The subscription is initiated
       by the served JavaScript (for example.)
 For ports, see constants below.
+
+Single trees can be requested, without a channel, via
+GET TREE_QUERY_URI_PATH?word=<word>&depth=<depth>&breadth=<breadth> on 
+ECHO_TREE_GET_PORT.
+
+Metrics are served as JSON at STATS_URI_PATH, and in the Prometheus text
+format at PROMETHEUS_STATS_URI_PATH, on ECHO_TREE_GET_PORT.
+
+The word database can be replaced while browsers stay connected: POST
+to ADMIN_SWAP_DATABASE_URI_PATH on ECHO_TREE_GET_PORT from the server's
+host, with the secret of the -a file in an ADMIN_TOKEN_HEADER header, 
+or send SIGHUP to reopen the current database after rebuilding it.
+See DatabaseSwapper.
+
+With -e, all three services are routes of one tornado.web.Application on 
+ECHO_TREE_GET_PORT, and run on one IOLoop; -p keeps the other two ports open
+as well, on the same loop.
+
+Each conversation is a named channel with its own current tree and subscribers.
+Browsers subscribe to ECHO_TREE_SUBSCRIBE_PATH + '/<channelId>', and root words are
+posted to NEW_TREE_SUBMISSION_URI_PATH + '/<channelId>'. Without a channel
+id, both use DEFAULT_CHANNEL_ID. All channels share one tree computation
+facility and its caches.
 '''
 
 import os;
 import sys;
+import signal;
+import gzip;
 import time;
+import hashlib;
+import hmac;
+import cStringIO;
+import email.utils;
 import socket;
 import argparse;
-import datetime;
-from threading import Event, Lock, Thread;
+import functools;
+import re;
+import json;
+import urllib;
+import httplib;
+import traceback;
+from collections import deque;
+from threading import Condition, Lock, Thread;
 
 import tornado;
-from tornado.ioloop import IOLoop;
-from tornado.websocket import WebSocketHandler;
+import tornado.web;
+from tornado.ioloop import IOLoop, PeriodicCallback;
+from tornado.websocket import WebSocketHandler, WebSocketProtocol13, BroadcastMessage;
 from tornado.httpserver import HTTPServer;
 
-from echo_tree import WordExplorer;
+from echo_tree import WordExplorer, PrecomputedTreeStore, TreeComputationCancelled, getDatabaseVersion, getReadOnlyOpenMethod, \
+                      WORD_TREE_DEPTH, WORD_TREE_BREADTH, PRECOMPUTED_TREES_SUFFIX;
+from follower_graph import FollowerGraph;
+from tree_worker_pool import TreeWorkerPool, DEFAULT_NUM_TREE_WORKERS;
+from tree_codec import encodeBinaryTree, BINARY_TREE_SUBPROTOCOL;
+from server_stats import ServerStats, IOLoopLagMonitor, PROMETHEUS_CONTENT_TYPE;
+from async_log import AsyncLogWriter, truncatePayload;
 
 HOST = socket.getfqdn();
 ECHO_TREE_SCRIPT_SERVER_PORT = 5000;
@@ -33,13 +75,257 @@ ECHO_TREE_NEW_ROOT_PORT = 5002;
 #DBPATH = os.path.join(os.path.realpath(os.path.dirname(__file__)), "Resources/testDb.db");
 DBPATH = os.path.join(os.path.realpath(os.path.dirname(__file__)), "Resources/EnronCollectionProcessed/EnronDB/enronDB.db");
 
+# Trees precomputed by make_tree_store.py, used if the file exists:
+TREE_STORE_PATH = DBPATH + PRECOMPUTED_TREES_SUFFIX;
+
 SCRIPT_REQUEST_URI_PATH = r"/request_echo_tree_script";
+STATS_URI_PATH = r"/stats";
+TREE_QUERY_URI_PATH = r"/tree";
+PROMETHEUS_STATS_URI_PATH = r"/metrics";
+ADMIN_SWAP_DATABASE_URI_PATH = r"/admin/swap_database";
 NEW_TREE_SUBMISSION_URI_PATH = r"/submit_new_echo_tree";
-ECHO_TREE_SUBSCRIBE_PATH = "r/subscribe_to_echo_trees";
+ECHO_TREE_SUBSCRIBE_PATH = r"/subscribe_to_echo_trees";
+
+# Channel used by clients that do not name one:
+DEFAULT_CHANNEL_ID = "default";
+# Legal channel ids:
+CHANNEL_ID_PATTERN = r"[A-Za-z0-9_\-]{1,64}";
+
+# Seconds a browser may take to receive one tree before it
+# is considered stuck, and disconnected:
+SLOW_CONSUMER_TIMEOUT = 30;
+# Max seconds between two checks for stuck browsers, which also
+# finds them on channels that get no new trees:
+SLOW_CONSUMER_CHECK_INTERVAL = 5.0;
+
+# Largest trees that may be requested via TREE_QUERY_URI_PATH:
+MAX_QUERY_TREE_DEPTH = 6;
+MAX_QUERY_TREE_BREADTH = 20;
+# Seconds for which caches may reuse a queried tree without revalidating it:
+TREE_QUERY_MAX_AGE = 300;
+
+# Max number of the old database's most recently used trees that are
+# computed from a new database before it is swapped in:
+DATABASE_WARM_UP_MAX_TREES = 500;
+# Seconds between two checks for SIGHUP, which reopens the database:
+HANGUP_CHECK_INTERVAL = 1.0;
+# Clients allowed to use the admin routes:
+ADMIN_CLIENT_ADDRESSES = ('127.0.0.1', '::1');
+# Request header carrying the admin secret. Behind a proxy on the server's
+# host every client appears local, so the address alone does not suffice:
+ADMIN_TOKEN_HEADER = 'X-EchoTree-Admin-Token';
+
+# The JSON of every TREE_LOG_SAMPLE_INTERVAL-th computed tree
+# is logged, truncated. 0: never log tree JSON:
+TREE_LOG_SAMPLE_INTERVAL = 10;
+
+# zlib level for trees sent to browsers that support the
+# permessage-deflate websocket extension. 0: no compression:
+TREE_COMPRESSION_LEVEL = 6;
 
 # Name of script to serve on ECHO_TREE_SCRIPT_SERVER_PORT. 
 # Fixed script intended to subscribe to the EchoTree event server: 
 TREE_EVENT_LISTEN_SCRIPT_NAME = "wordTreeListener.html";
+# Directory holding that script, and the assets it may load:
+BROWSER_SCRIPTS_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), "../browser_scripts");
+# Files in BROWSER_SCRIPTS_DIR that the script server hands out, by extension:
+SCRIPT_CONTENT_TYPES = {'.html' : 'text/html; charset=UTF-8',
+                        '.js'   : 'application/javascript',
+                        '.css'  : 'text/css',
+                        '.png'  : 'image/png',
+                        '.svg'  : 'image/svg+xml'};
+# Min seconds between checks whether a served file changed on disk:
+SCRIPT_RECHECK_INTERVAL = 1.0;
+
+# -----------------------------------------  Server Metrics --------------------
+
+class EchoTreeStats(object):
+    '''
+    Counters and latency histograms of this server, updated as
+    trees flow through it. Served by StatsHandler, along with gauges 
+    that are computed on request: subscribers and write buffers per
+    channel, IOLoop lag, and cache and worker pool state.
+    '''
+    
+    registry = ServerStats(prefix='echotree_');
+    submissionLatency = registry.addHistogram('submissionLatencySeconds', 'Seconds from a root word submission to the broadcast of its tree.');
+    computeTime       = registry.addHistogram('treeComputeSeconds', 'Seconds spent computing one tree.');
+    fanOutTime        = registry.addHistogram('broadcastFanOutSeconds', 'Seconds spent handing one tree to all subscribers of its channel.');
+    ioLoopLag         = registry.addHistogram('ioloopLagSeconds', 'Delay with which the main IOLoop ran timeouts.');
+    # Started in main; see IOLoopLagMonitor:
+    lagMonitor = None;
+    
+    @staticmethod
+    def count(counterName, amount=1):
+        EchoTreeStats.registry.increment(counterName, amount);
+
+    @staticmethod
+    def getChannelGauges():
+        subscriberCounts = [];
+        writeBufferSizes = [];
+        maxWriteBufferSize = 0;
+        for channel in EchoTreeChannel.channels.values():
+            channelBufferSize = 0;
+            for handler in list(channel.subscribers):
+                bufferSize = handler.getWriteBufferSize();
+                channelBufferSize += bufferSize;
+                maxWriteBufferSize = max(maxWriteBufferSize, bufferSize);
+            subscriberCounts.append((channel.channelId, len(channel.subscribers)));
+            writeBufferSizes.append((channel.channelId, channelBufferSize));
+        lagMonitor = EchoTreeStats.lagMonitor;
+        return [('channels', 'Channels in use.', None, [(None, len(EchoTreeChannel.channels))]),
+                ('subscribers', 'Open subscriber connections per channel.', 'channel', subscriberCounts),
+                ('writeBufferBytes', 'Tree bytes not yet received by the subscribers of a channel.', 'channel', writeBufferSizes),
+                ('maxWriteBufferBytes', 'Tree bytes not yet received by the most backlogged subscriber.', None, [(None, maxWriteBufferSize)]),
+                ('ioloopLagLastSeconds', 'Most recently measured IOLoop lag.', None, [(None, lagMonitor.lastLag if lagMonitor is not None else 0.0)]),
+                ];
+
+    @staticmethod
+    def getComputationGauges():
+        '''
+        Cache statistics of the TreeWorkerPool, or of the TreeComputer's WordExplorer,
+        and the pool's own counters.
+        '''
+        caches = [];
+        poolGauges = [];
+        treeWorkerPool = RootWordSubmissionService.treeWorkerPool;
+        if treeWorkerPool is not None:
+            poolStats = treeWorkerPool.getStats();
+            caches.append(('treeCache', poolStats.pop('treeCache')));
+            for (statName, value) in poolStats.items():
+                poolGauges.append(('pool' + statName[0].upper() + statName[1:], 'TreeWorkerPool statistic %s.' % statName, None, [(None, value)]));
+        else:
+            treeComputer = RootWordSubmissionService.TreeComputer.instance;
+            if treeComputer is not None and treeComputer.wordExplorer is not None:
+                caches.append(('treeCache', treeComputer.wordExplorer.treeCache.getStats()));
+                caches.append(('followerCache', treeComputer.wordExplorer.cache.getStats()));
+        gauges = [];
+        for (cacheName, cacheStats) in caches:
+            for (statName, value) in sorted(cacheStats.items()):
+                gauges.append((cacheName + statName[0].upper() + statName[1:], '%s statistic %s.' % (cacheName, statName), None, [(None, value)]));
+        return gauges + poolGauges;
+
+    @staticmethod
+    def getLogGauges():
+        logWriter = EchoTreeService.logWriter;
+        if logWriter is None:
+            return [];
+        return [('log' + statName[0].upper() + statName[1:], 'Log records %s.' % statName, None, [(None, value)]) 
+                for (statName, value) in sorted(logWriter.getStats().items())];
+
+for (counterName, helpText) in [('submissions', 'Root words submitted via HTTP or websocket.'),
+                                ('duplicateSubmissions', 'Submissions ignored because they repeat the channel\'s latest root word.'),
+                                ('treesComputed', 'Trees computed, including trees served from the tree cache.'),
+                                ('treesCancelled', 'Tree computations abandoned because newer root words arrived.'),
+                                ('treesFailed', 'Tree computations that raised an error.'),
+                                ('broadcasts', 'Trees published on a channel.'),
+                                ('treesSent', 'Trees handed to subscriber connections.'),
+                                ('subscriptions', 'Websocket subscriptions accepted.'),
+                                ('slowSubscribersDropped', 'Subscribers disconnected because they did not receive trees in time.'),
+                                ('databaseSwaps', 'Word databases swapped in while the server was running.')]:
+    EchoTreeStats.registry.addCounter(counterName, helpText);
+EchoTreeStats.registry.addGaugeSource(EchoTreeStats.getChannelGauges);
+EchoTreeStats.registry.addGaugeSource(EchoTreeStats.getComputationGauges);
+EchoTreeStats.registry.addGaugeSource(EchoTreeStats.getLogGauges);
+
+# -----------------------------------------  Channel State --------------------
+
+class EchoTreeChannel(object):
+    '''
+    State of one EchoTree session: the current tree, the browsers
+    subscribed to it, and the root word submissions in progress.
+    Channels are created on first use, and live as long as the server.
+    '''
+    
+    # channelId --> EchoTreeChannel:
+    channels = {};
+    channelsLock = Lock();
+    
+    def __init__(self, channelId):
+        '''
+        @param channelId: name of the channel.
+        @type channelId: string
+        '''
+        self.channelId = channelId;
+        # Current JSON EchoTree string, and the same tree as a TreeBroadcast.
+        # Only changed on the main IOLoop thread:
+        self.currentEchoTree = "";
+        self.currentTreeBroadcast = TreeBroadcast("", None);
+        # EchoTreeService instances whose connection is open.
+        # Only accessed from the main IOLoop thread:
+        self.subscribers = set();
+        # Most recently submitted root word, and its submission
+        # sequence number. Used to suppress resubmissions, and 
+        # results that arrive out of order:
+        self.submissionLock = Lock();
+        self.latestRootWord = None;
+        self.latestSubmissionSeq = 0;
+        self.latestPublishedSeq = 0;
+        # TreeWorkerPool request for the latest root word, while
+        # it is computed. Cancelled when a newer word arrives:
+        self.pendingRequest = None;
+        # Root word waiting for the TreeComputer thread, if any:
+        self.pendingRootWord = None;
+        # When the latest root word was submitted, until its tree is published:
+        self.latestSubmissionTime = None;
+    
+    @staticmethod
+    def isValidChannelId(channelId):
+        return re.match(CHANNEL_ID_PATTERN + '$', channelId) is not None;
+    
+    @staticmethod
+    def getChannel(channelId=DEFAULT_CHANNEL_ID):
+        '''
+        Return the channel of the given name, creating it if needed.
+        Safe to call from any thread.
+        @param channelId: name of the channel.
+        @type channelId: string
+        @rtype: EchoTreeChannel
+        @raise ValueError: if channelId does not match CHANNEL_ID_PATTERN.
+        '''
+        with EchoTreeChannel.channelsLock:
+            try:
+                return EchoTreeChannel.channels[channelId];
+            except KeyError:
+                if not EchoTreeChannel.isValidChannelId(channelId):
+                    raise ValueError("Illegal channel id: '%s'." % channelId);
+                channel = EchoTreeChannel(channelId);
+                EchoTreeChannel.channels[channelId] = channel;
+                return channel;
+
+class TreeBroadcast(object):
+    '''
+    One tree as sent to browsers: JSON for most of them, and the
+    binary encoding of tree_codec.py for those that asked for it.
+    Each encoding is made at most once, when first needed.
+    '''
+    
+    def __init__(self, jsonTree, wordTree):
+        '''
+        @param jsonTree: the tree's JSON string; empty for 'no tree'.
+        @type jsonTree: string
+        @param wordTree: the Python tree as made by WordExplorer.makeWordTree(). If
+                         None, it is recovered from jsonTree when a browser wants binary trees.
+        @type wordTree: {WordTreeNode | OrderedDict | None}
+        '''
+        self.jsonTree = jsonTree;
+        self.wordTree = wordTree;
+        self.jsonMessage = BroadcastMessage(jsonTree);
+        self.binaryMessage = None;
+    
+    def getMessage(self, useBinary=False):
+        '''
+        @return: the tree, encoded at most once per websocket protocol version.
+        @rtype: BroadcastMessage
+        '''
+        if not useBinary:
+            return self.jsonMessage;
+        if self.binaryMessage is None:
+            wordTree = self.wordTree;
+            if wordTree is None and len(self.jsonTree) > 0:
+                wordTree = json.loads(self.jsonTree);
+            self.binaryMessage = BroadcastMessage(encodeBinaryTree(wordTree), binary=True);
+        return self.binaryMessage;
 
 # -----------------------------------------  Top Level Service Provider Classes --------------------
 
@@ -47,18 +333,32 @@ class EchoTreeService(WebSocketHandler):
     '''
     Handles pushing new EchoTrees to browsers who display them.
     Each instance handles one browser via a long-standing WebSocket
-    connection.
-    '''
+    connection. All handlers live on the main IOLoop. New trees
+    are handed to that loop once, and the loop writes them to
+    every browser subscribed to the tree's channel. No threads per connection.
     
-    # Class-level list of handler instances: 
-    activeHandlers = [];
-    # Lock to make access to activeHanlders data struct thread safe:
-    activeHandlersChangeLock = Lock();
+    Each connection has at most one tree in its stream's write buffer, and
+    at most one more waiting to be written. A tree that is still waiting
+    when a newer one arrives is replaced, since browsers only show the
+    newest tree. Browsers that have not received a tree, or a control frame,
+    after slowConsumerTimeout seconds are disconnected. They are checked
+    when a new tree arrives, and periodically; see watchSlowConsumers().
+    
+    Trees are compressed for browsers that support permessage-deflate.
+    Unless compressionContextTakeover is set, each tree is compressed
+    once for all of them. Browsers that offer the BINARY_TREE_SUBPROTOCOL
+    websocket subprotocol get trees in the binary encoding of tree_codec.py.
+    '''
     
-    # Current JSON EchoTree string:
-    currentEchoTree = "";
-    # Lock for changing the current EchoTree:
-    currentEchoTreeLock = Lock();
+    # Seconds after which a browser that is still receiving a tree is disconnected:
+    slowConsumerTimeout = SLOW_CONSUMER_TIMEOUT;
+    # PeriodicCallback running dropSlowConsumers(), see watchSlowConsumers():
+    slowConsumerChecker = None;
+    # zlib level for outgoing trees; 0 turns compression off:
+    compressionLevel = TREE_COMPRESSION_LEVEL;
+    # If True, keep a compression context per browser across trees. Compresses
+    # better, but costs a compressor per browser, and one compression per browser:
+    compressionContextTakeover = False;
     
     # Log FD for logging. If None, calls to log() are ignored.
     # Else log to this FD (allowed to be sys.stdout for console:
@@ -67,6 +367,12 @@ class EchoTreeService(WebSocketHandler):
     # provided (and not just sys.stdout), then logging occurs to
     # that FD *and* to the console. Else just to the concole:
     logToConsole = False;
+    # AsyncLogWriter that writes to the above; made by prepareLogging().
+    # Log calls only queue records, and never wait for the writes:
+    logWriter = None;
+    # Log the JSON of every treeLogSampleInterval-th tree; 0: never:
+    treeLogSampleInterval = TREE_LOG_SAMPLE_INTERVAL;
+    numTreesLogged = 0;
     
     def __init__(self, application, request, **kwargs):
         '''
@@ -81,22 +387,17 @@ class EchoTreeService(WebSocketHandler):
         '''
         super(EchoTreeService, self).__init__(application, request, **kwargs);
         self.request = request;
-        EchoTreeService.log("Browser at %s (%s) subscribing to EchoTrees." % (request.host, request.remote_ip));
-        
-        # Register this handler instance as wishing to hear
-        # about new incoming EchoTrees:
-        with EchoTreeService.activeHandlersChangeLock:
-            EchoTreeService.activeHandlers.append(self);
-        # Event that will be set when a new EchoTree arrives.
-        # Thread NewEchoTreeWaitThread will wait for this event:
-        self.newEchoTreeEvent = Event();
-        
-        # Go wait for new-tree updates:
-        EchoTreeService.NewEchoTreeWaitThread(self).start();
-    
-#    def subscribeToNewTrees(self, handler):
-#        with EchoTreeService.activeHandlersChangeLock:
-#            EchoTreeService.activeHandlers.append(handler);
+        self.channel = None;
+        # True if this browser wants binary rather than JSON trees:
+        self.useBinaryTrees = False;
+        # Tree waiting until the browser has received the previous one:
+        self.queuedTree = None;
+        # Size of the tree frame most recently handed to the stream, and
+        # when the stream started writing. None while nothing is known to be
+        # written. The stream starts out writing the websocket handshake:
+        self.numBytesWriting = 0;
+        self.writeStartTime = time.time();
+        EchoTreeService.logEvent('subscribing', host=request.host, ip=request.remote_ip);
     
     def allow_draft76(self):
         '''
@@ -107,17 +408,150 @@ class EchoTreeService(WebSocketHandler):
         '''
         return True
     
-    def open(self): #@ReservedAssignment
+    def select_subprotocol(self, subprotocols):
+        '''
+        Called by tornado with the websocket subprotocols the browser offers.
+        Selects the binary tree encoding if offered. Otherwise trees are sent as JSON.
+        Draft 76 connections have no binary frames, and always get JSON.
+        @param subprotocols: subprotocol names offered by the browser.
+        @type subprotocols: [string]
+        @return: the selected subprotocol, or None.
+        @rtype: {string | None}
+        '''
+        if BINARY_TREE_SUBPROTOCOL in subprotocols and isinstance(self.ws_connection, WebSocketProtocol13):
+            self.useBinaryTrees = True;
+            return BINARY_TREE_SUBPROTOCOL;
+        return None;
+    
+    def get_compression_options(self):
+        '''
+        Have tornado negotiate the permessage-deflate extension with browsers that offer it.
+        '''
+        if EchoTreeService.compressionLevel <= 0:
+            return None;
+        return {'compression_level' : EchoTreeService.compressionLevel,
+                'context_takeover'  : EchoTreeService.compressionContextTakeover};
+    
+    def open(self, channelId=DEFAULT_CHANNEL_ID): #@ReservedAssignment
         '''
         Called by WebSocket/tornado when a client connects. Method must
-        be named 'open'
+        be named 'open'. Registers this handler as wishing to hear
+        about new incoming EchoTrees on the given channel.
+        @param channelId: channel id from the subscription URL.
+        @type channelId: string
         '''
-        with EchoTreeService.currentEchoTreeLock:
-            # Deliver the current tree to the subscribing browser:
-            try:
-                self.write_message(EchoTreeService.currentEchoTree);
-            except Exception as e:
-                EchoTreeService.log("Error during send of current EchoTree to %s (%s) during initial subscription: %s" % (self.request.host, self.request.remote_ip, `e`));
+        self.channel = EchoTreeChannel.getChannel(channelId.encode('utf-8'));
+        self.channel.subscribers.add(self);
+        EchoTreeStats.count('subscriptions');
+        # Deliver the current tree to the subscribing browser:
+        try:
+            self.sendTree(self.channel.currentTreeBroadcast);
+        except Exception as e:
+            EchoTreeService.log("Error during send of current EchoTree to %s (%s) during initial subscription: %s" % (self.request.host, self.request.remote_ip, `e`));
+        
+    def sendTree(self, treeBroadcast):
+        '''
+        Send a tree to this browser, or queue it if the browser has not
+        received the previous tree yet. A tree queued earlier is replaced.
+        Disconnects the browser if it has been receiving the previous tree
+        for more than slowConsumerTimeout seconds.
+        @param treeBroadcast: the tree.
+        @type treeBroadcast: TreeBroadcast
+        @return: False if the connection is closed, or was closed because it is stuck. Else True.
+        @rtype: boolean
+        '''
+        if self.ws_connection is None or self.stream.closed():
+            return False;
+        if self.stream.writing():
+            # Not encoded yet: compression contexts must only see trees that are sent:
+            self.queuedTree = treeBroadcast;
+            # The stream may be writing a handshake or control frame rather than a tree,
+            # so make sure the queued tree is sent once the buffer drains:
+            self.ws_connection.set_flush_callback(self.onWriteBufferFlushed);
+            return not self.dropIfStuck();
+        self.writeTree(treeBroadcast);
+        return True;
+    
+    def dropIfStuck(self):
+        '''
+        Disconnect the browser if the stream has been writing to it for
+        more than slowConsumerTimeout seconds. A write whose start is not
+        known, such as a pong, is timed from the first call that sees it.
+        @return: True if the browser was disconnected.
+        @rtype: boolean
+        '''
+        if self.ws_connection is None or self.stream.closed() or not self.stream.writing():
+            return False;
+        if self.writeStartTime is None:
+            self.writeStartTime = time.time();
+            # Stops the clock when the write is done:
+            self.ws_connection.set_flush_callback(self.onWriteBufferFlushed);
+            return False;
+        if time.time() - self.writeStartTime <= EchoTreeService.slowConsumerTimeout:
+            return False;
+        EchoTreeService.logEvent('slowSubscriberDropped', host=self.request.host, ip=self.request.remote_ip,
+                                 channel=self.channel.channelId, timeout=EchoTreeService.slowConsumerTimeout);
+        self.queuedTree = None;
+        EchoTreeStats.count('slowSubscribersDropped');
+        # Closing the stream runs on_close():
+        self.stream.close();
+        return True;
+    
+    @staticmethod
+    def watchSlowConsumers(ioLoop):
+        '''
+        Check all browsers for stuck writes at least every SLOW_CONSUMER_CHECK_INTERVAL
+        seconds. Without new trees on its channel, a stuck browser is otherwise never
+        noticed, and keeps its unsent data in memory.
+        @param ioLoop: the loop that serves the EchoTree connections.
+        @type ioLoop: IOLoop
+        '''
+        checkInterval = min(SLOW_CONSUMER_CHECK_INTERVAL, EchoTreeService.slowConsumerTimeout / 2.0);
+        EchoTreeService.slowConsumerChecker = PeriodicCallback(EchoTreeService.dropSlowConsumers, 
+                                                               checkInterval * 1000, io_loop=ioLoop);
+        EchoTreeService.slowConsumerChecker.start();
+    
+    @staticmethod
+    def dropSlowConsumers():
+        # Runs on the IOLoop.
+        with EchoTreeChannel.channelsLock:
+            channels = EchoTreeChannel.channels.values();
+        for channel in channels:
+            for subscriber in list(channel.subscribers):
+                subscriber.dropIfStuck();
+    
+    def writeTree(self, treeBroadcast):
+        self.queuedTree = None;
+        frame = treeBroadcast.getMessage(self.useBinaryTrees).encode_for(self);
+        self.numBytesWriting = len(frame);
+        self.writeStartTime = time.time();
+        self.ws_connection.write_encoded_message(frame, callback=self.onWriteBufferFlushed);
+        
+    def onWriteBufferFlushed(self):
+        '''
+        Called by the websocket connection when the browser has received all
+        data written so far, including control frames written after the tree.
+        Sends the queued tree, if any.
+        '''
+        if self.ws_connection is None or self.stream.closed():
+            return;
+        self.numBytesWriting = 0;
+        self.writeStartTime = None;
+        if self.queuedTree is not None:
+            self.writeTree(self.queuedTree);
+    
+    def getWriteBufferSize(self):
+        '''
+        Return the number of tree bytes this browser has yet to receive.
+        The queued tree, if any, is counted as uncompressed JSON.
+        @rtype: int
+        '''
+        numBytes = 0;
+        if self.ws_connection is not None and self.stream.writing():
+            numBytes = self.numBytesWriting;
+        if self.queuedTree is not None:
+            numBytes += len(self.queuedTree.jsonTree);
+        return numBytes;
         
     
     def on_message(self, message):
@@ -127,77 +561,130 @@ class EchoTreeService(WebSocketHandler):
         @type message: string
         '''
         newRootWord = message.encode('utf-8');
-        RootWordSubmissionService.triggerTreeComputationAndDistrib(newRootWord);
-        EchoTreeService.log("New root word from connected browser: '%s'." % newRootWord);
+        RootWordSubmissionService.triggerTreeComputationAndDistrib(newRootWord, self.channel);
+        EchoTreeService.logEvent('rootWord', source='websocket', channel=self.channel.channelId, word=newRootWord);
     
     def on_close(self):
         '''
         Called when socket is closed. Remove this handler from
-        the list of handlers.
+        its channel's set of handlers.
         '''
-        with EchoTreeService.activeHandlersChangeLock:
-            try:
-                EchoTreeService.activeHandlers.remove(self);
-            except:
-                pass
-        EchoTreeService.log("Browser at %s (%s) now disconnected." % (self.request.host, self.request.remote_ip));
+        if self.channel is not None:
+            self.channel.subscribers.discard(self);
+        self.queuedTree = None;
+        EchoTreeService.logEvent('disconnected', host=self.request.host, ip=self.request.remote_ip);
 
     @staticmethod
-    def log(theStr, addTimestamp=True):
-        if EchoTreeService.logFD is None and not EchoTreeService.logToConsole:
-            return;
-        if addTimestamp:
-            timestamp = str(datetime.datetime.now());
-            # Write timestamp to log file if appropriate:
-            if EchoTreeService.logFD is not None:
-                EchoTreeService.logFD.write(timestamp + ": ");
-            # Write timestamp to console, if appropriate:
-            if EchoTreeService.logToConsole and EchoTreeService.logFD != sys.stdout:
-                sys.stdout.write(timestamp + ': ');
+    def prepareLogging():
+        '''
+        Make the log writer, if logFD or logToConsole ask for logging. Records
+        are queued from now on, and written once startLogging() was called.
+        Does not start a thread, so worker processes may still be forked.
+        '''
+        logFDs = [];
         if EchoTreeService.logFD is not None:
-            EchoTreeService.logFD.write(theStr + '\n');
-            EchoTreeService.logFD.flush();
+            logFDs.append(EchoTreeService.logFD);
         if EchoTreeService.logToConsole and EchoTreeService.logFD != sys.stdout:
-            sys.stdout.write(theStr + '\n');
-        
+            logFDs.append(sys.stdout);
+        if len(logFDs) == 0:
+            return;
+        EchoTreeService.logWriter = AsyncLogWriter(logFDs);
     
     @staticmethod
-    def notifyInterestedParties():
+    def startLogging():
         '''
-        Called from other threads to set the new-EchoTree-arrived event flags
-        for all instances of EchoTreeService.  
+        Start the log writer thread, which writes the records queued so far.
         '''
-        with EchoTreeService.activeHandlersChangeLock:
-            for handler in EchoTreeService.activeHandlers:
-                handler.newEchoTreeEvent.set();
+        if EchoTreeService.logWriter is None:
+            EchoTreeService.prepareLogging();
+        if EchoTreeService.logWriter is not None:
+            EchoTreeService.logWriter.start();
     
-    class NewEchoTreeWaitThread(Thread):
+    @staticmethod
+    def stopLogging():
         '''
-        Thread that waits for a new EchoTree to be submitted.
+        Write all queued log records, and stop the log writer thread.
         '''
-        
-        def __init__(self, handlerObj):
-            '''
-            Init thread
-            @param handlerObj: instance of EchoTreeService.
-            @type handlerObj: EchoTreeService.
-            '''
-            super(EchoTreeService.NewEchoTreeWaitThread, self).__init__();
-            self.handlerObj = handlerObj
-        
-        def run(self):
-            while 1:
-                # Hang on new-EchoServer event:
-                self.handlerObj.newEchoTreeEvent.wait();
-                with EchoTreeService.currentEchoTreeLock:
-                    # Deliver the new tree to the browser:
-                    try:
-                        self.handlerObj.write_message(EchoTreeService.currentEchoTree);
-                    except Exception:
-                        EchoTreeService.log("Error during send of new EchoTree to %s (%s)" % (self.handlerObj.request.host, self.handlerObj.request.remote_ip));
-                self.handlerObj.newEchoTreeEvent.clear();
-                with EchoTreeService.currentEchoTreeLock:
-                    EchoTreeService.log(EchoTreeService.currentEchoTree);
+        if EchoTreeService.logWriter is not None:
+            EchoTreeService.logWriter.stop();
+    
+    @staticmethod
+    def log(theStr):
+        if EchoTreeService.logWriter is not None:
+            EchoTreeService.logWriter.log(theStr);
+    
+    @staticmethod
+    def logEvent(eventName, **fields):
+        '''
+        Log a structured event as eventName key=value...
+        Formatting happens in the log writer thread.
+        '''
+        if EchoTreeService.logWriter is not None:
+            EchoTreeService.logWriter.logEvent(eventName, **fields);
+    
+    @staticmethod
+    def logTree(rootWord, newJSONEchoTreeStr):
+        '''
+        Log the size of a computed tree. For every treeLogSampleInterval-th 
+        tree, also log the beginning of its JSON.
+        '''
+        if EchoTreeService.logWriter is None:
+            return;
+        EchoTreeService.numTreesLogged += 1;
+        sampleInterval = EchoTreeService.treeLogSampleInterval;
+        if sampleInterval > 0 and EchoTreeService.numTreesLogged % sampleInterval == 0:
+            EchoTreeService.logWriter.logEvent('tree', word=rootWord, bytes=len(newJSONEchoTreeStr), json=truncatePayload(newJSONEchoTreeStr));
+        else:
+            EchoTreeService.logWriter.logEvent('tree', word=rootWord, bytes=len(newJSONEchoTreeStr));
+    
+    @staticmethod
+    def publishNewEchoTree(channel, newJSONEchoTreeStr, newWordTree=None):
+        '''
+        Make the given tree the current EchoTree of a channel, and have it
+        pushed to all browsers subscribed to that channel. Safe to call from any
+        thread: the work is handed to the main IOLoop.
+        @param channel: channel whose tree is replaced.
+        @type channel: EchoTreeChannel
+        @param newJSONEchoTreeStr: new JSON EchoTree
+        @type newJSONEchoTreeStr: string
+        @param newWordTree: the same tree as made by WordExplorer.makeWordTree(), if available.
+        @type newWordTree: {WordTreeNode | OrderedDict | None}
+        '''
+        IOLoop.instance().add_callback(functools.partial(EchoTreeService.broadcastNewEchoTree, channel, newJSONEchoTreeStr, newWordTree));
+    
+    @staticmethod
+    def broadcastNewEchoTree(channel, newJSONEchoTreeStr, newWordTree=None):
+        '''
+        Runs on the main IOLoop. Stores the new tree in the channel, and writes
+        it to every browser subscribed to the channel. Connections whose write fails are closed.
+        @param channel: channel whose tree is replaced.
+        @type channel: EchoTreeChannel
+        @param newJSONEchoTreeStr: new JSON EchoTree
+        @type newJSONEchoTreeStr: string
+        @param newWordTree: the same tree as made by WordExplorer.makeWordTree(), if available.
+        @type newWordTree: {WordTreeNode | OrderedDict | None}
+        '''
+        startTime = time.time();
+        if channel.latestSubmissionTime is not None:
+            EchoTreeStats.submissionLatency.observe(startTime - channel.latestSubmissionTime);
+            channel.latestSubmissionTime = None;
+        channel.currentEchoTree = newJSONEchoTreeStr;
+        # Each websocket frame is built once per tree encoding and protocol version, and shared by all browsers:
+        treeBroadcast = TreeBroadcast(newJSONEchoTreeStr, newWordTree);
+        channel.currentTreeBroadcast = treeBroadcast;
+        # Handlers may be removed while we write; iterate over a copy:
+        for handler in list(channel.subscribers):
+            try:
+                if not handler.sendTree(treeBroadcast):
+                    channel.subscribers.discard(handler);
+            except Exception as e:
+                EchoTreeService.log("Error during send of new EchoTree to %s (%s): %s" % (handler.request.host, handler.request.remote_ip, `e`));
+                channel.subscribers.discard(handler);
+                if handler.ws_connection is not None:
+                    handler.close();
+        EchoTreeStats.count('broadcasts');
+        EchoTreeStats.count('treesSent', len(channel.subscribers));
+        EchoTreeStats.fanOutTime.observe(time.time() - startTime);
     
 # -----------------------------------------  Class for submission of new EchoTrees ---------------    
     
@@ -212,104 +699,931 @@ class RootWordSubmissionService(HTTPServer):
 #    def __init__(self, requestHandler):
 #        super(RootWordSubmissionService, self).__init__(requestHandler);
 #        RootWordSubmissionService.wordExplorer = WordExplorer(DBPATH);
+
+    # TreeWorkerPool that computes trees. If None, the
+    # TreeComputer thread computes them:
+    treeWorkerPool = None;
+    # If True, the pool speculatively computes the trees
+    # of the words in each requested tree:
+    prefetchTrees = True;
+    # Word database or graph file that trees are computed from.
+    # Changed by DatabaseSwapper:
+    dbPath = DBPATH;
+    # PrecomputedTreeStore whose trees are published without
+    # computing them, or None:
+    treeStore = None;
+    # Tree store file given on the command line, or None for
+    # the one next to the database:
+    treeStorePath = None;
     
     @staticmethod
     def handle_request(request):
         '''
         Receives a new root word, from which it asks the WordExplorer to make
-        a JSON word tree. Stores that new tree in EchoTreeService.currentEchoTree.
-        Then sets the newWordEvent so that everyone waiting for that event
-        gets called.
+        a JSON word tree. The tree becomes the current tree of the channel
+        named in the request path, and is pushed to that channel's subscribers.
         @param request: incoming new EchoTree 
         @type request: HTTPRequest.HTTPRequest
         '''
-        
-        EchoTreeService.log("New root via HTTP; word '%s' from %s (%s)..." % (request.body, request.host, request.remote_ip));    
-        RootWordSubmissionService.triggerTreeComputationAndDistrib(request.body);
+        channelId = DEFAULT_CHANNEL_ID;
+        if request.path.startswith(NEW_TREE_SUBMISSION_URI_PATH + '/'):
+            channelId = urllib.unquote(request.path[len(NEW_TREE_SUBMISSION_URI_PATH) + 1:]);
+        RootWordSubmissionService.acceptRootWord(request, channelId);
+
+    @staticmethod
+    def acceptRootWord(request, channelId):
+        '''
+        Start the computation of the tree for the root word in the request body.
+        @param request: incoming new root word
+        @type request: HTTPRequest.HTTPRequest
+        @param channelId: id of the channel on which to publish the tree.
+        @type channelId: string
+        @return: False if the channel id is invalid, else True.
+        @rtype: boolean
+        '''
+        try:
+            channel = EchoTreeChannel.getChannel(channelId);
+        except ValueError as e:
+            EchoTreeService.log("Root word '%s' from %s (%s) ignored: %s" % (request.body, request.host, request.remote_ip, str(e)));
+            return False;
+        EchoTreeService.logEvent('rootWord', source='http', channel=channelId, word=request.body, host=request.host, ip=request.remote_ip);
+        RootWordSubmissionService.triggerTreeComputationAndDistrib(request.body, channel);
+        return True;
+
+    @staticmethod
+    def triggerTreeComputationAndDistrib(newRootWord, channel):
+        '''
+        Have the tree for the given root word computed, and published on the
+        given channel. Resubmissions of the channel's latest word are ignored.
+        The newest word wins: computations for the channel's earlier words are
+        cancelled, unless other channels wait for the same tree. 
+        Safe to call from any thread.
+        @param newRootWord: root word of the new tree.
+        @type newRootWord: string
+        @param channel: channel on which to publish the tree.
+        @type channel: EchoTreeChannel
+        '''
+        EchoTreeStats.count('submissions');
+        with channel.submissionLock:
+            if newRootWord == channel.latestRootWord:
+                EchoTreeStats.count('duplicateSubmissions');
+                return;
+            channel.latestRootWord = newRootWord;
+            channel.latestSubmissionTime = time.time();
+            channel.latestSubmissionSeq += 1;
+            submissionSeq = channel.latestSubmissionSeq;
+            staleRequest = channel.pendingRequest;
+            channel.pendingRequest = None;
+        treeWorkerPool = RootWordSubmissionService.treeWorkerPool;
+        if treeWorkerPool is not None:
+            treeWorkerPool.cancelRequest(staleRequest);
+            request = treeWorkerPool.computeTree(newRootWord, 
+                                                 functools.partial(RootWordSubmissionService.distributeComputedTree, channel, submissionSeq),
+                                                 prefetchFollowers=RootWordSubmissionService.prefetchTrees,
+                                                 requester=channel.channelId);
+            with channel.submissionLock:
+                if submissionSeq == channel.latestSubmissionSeq:
+                    channel.pendingRequest = request;
+            return;
+        RootWordSubmissionService.TreeComputer.submit(channel, newRootWord);
 
     @staticmethod
-    def triggerTreeComputationAndDistrib(newRootWord):
-        if newRootWord == RootWordSubmissionService.TreeComputer.rootWord:
+    def distributeComputedTree(channel, submissionSeq, rootWord, newJSONEchoTreeStr, errorMsg, computeTime):
+        '''
+        Called on the main IOLoop when a worker of the TreeWorkerPool finished
+        a tree. Publishes the tree unless a tree for a later submission was
+        published on the channel already.
+        @param channel: channel on which the tree was requested.
+        @type channel: EchoTreeChannel
+        @param submissionSeq: sequence number assigned when rootWord was submitted.
+        @type submissionSeq: int
+        @param rootWord: the tree's root word.
+        @type rootWord: string
+        @param newJSONEchoTreeStr: the new tree, or None if the computation failed.
+        @type newJSONEchoTreeStr: {string | None}
+        @param errorMsg: worker traceback if the computation failed, else None.
+        @type errorMsg: {string | None}
+        @param computeTime: seconds the worker spent on the tree.
+        @type computeTime: float
+        '''
+        if newJSONEchoTreeStr is None:
+            EchoTreeStats.count('treesFailed');
+            EchoTreeService.log("Tree computation for '%s' failed: %s" % (rootWord, errorMsg));
             return;
-        RootWordSubmissionService.TreeComputer.rootWord = newRootWord;
-        RootWordSubmissionService.TreeComputer.newWordEvent.set();
+        EchoTreeStats.count('treesComputed');
+        # Trees from the pool's cache take no time:
+        if computeTime > 0:
+            EchoTreeStats.computeTime.observe(computeTime);
+        with channel.submissionLock:
+            if submissionSeq < channel.latestPublishedSeq:
+                return;
+            channel.latestPublishedSeq = submissionSeq;
+            if submissionSeq == channel.latestSubmissionSeq:
+                channel.pendingRequest = None;
+        # Pool callbacks run on the main IOLoop already. The Python tree stays in
+        # the worker; browsers that want binary trees get them decoded from the JSON:
+        EchoTreeService.broadcastNewEchoTree(channel, newJSONEchoTreeStr);
+        EchoTreeService.logEvent('published', word=rootWord, channel=channel.channelId, computeSeconds=computeTime);
+        EchoTreeService.logTree(rootWord, newJSONEchoTreeStr);
     
     def on_close(self):
         pass
     
     
     class TreeComputer(Thread):
+        '''
+        Computes the trees of all channels in one thread, when no
+        TreeWorkerPool is used. Each channel holds at most one 
+        waiting root word; newer submissions replace it. Channels
+        waiting for the same word share one computation. A computation
+        is abandoned when all its channels have a newer word waiting.
+        
+        After runOnIOLoop(), trees are computed on the IOLoop instead of
+        in the thread, one tree per loop iteration. Submissions and 
+        broadcasts then never cross threads.
+        '''
         
-        rootWord = None;
-        newWordEvent = Event();
+        # Channels whose pendingRootWord is waiting to be computed, in submission order:
+        pendingChannels = deque();
+        pendingCondition = Condition();
         keepRunning = True;
         singletonRunning = False;
+        # If True, load the whole database into an in-memory
+        # FollowerGraph at startup, rather than querying SQLite:
+        useInMemoryGraph = False;
+        # Instance computing trees on an IOLoop, if any; see runOnIOLoop():
+        loopComputer = None;
+        # True while a computeNextTree() call is scheduled on that IOLoop:
+        computeScheduled = False;
+        # The one TreeComputer of this process:
+        instance = None;
         
         def __init__(self):
             super(RootWordSubmissionService.TreeComputer, self).__init__();
             if RootWordSubmissionService.TreeComputer.singletonRunning:
                 raise RuntimeError("Only one TreeComputer instance may run per process.");
             RootWordSubmissionService.TreeComputer.singletonRunning = True;
+            RootWordSubmissionService.TreeComputer.instance = self;
+            self.wordExplorer = None;
+            self.ioLoop = None;
+            # Explorer a tree is being computed with, and the explorer
+            # useWordExplorer() replaced while it was busy. See there:
+            self.explorerLock = Lock();
+            self.busyExplorer = None;
+            self.retiredExplorer = None;
+        
+        @staticmethod
+        def submit(channel, rootWord):
+            '''
+            Queue a root word for the given channel. Safe to call from any thread.
+            '''
+            TreeComputer = RootWordSubmissionService.TreeComputer;
+            with TreeComputer.pendingCondition:
+                if channel.pendingRootWord is None:
+                    TreeComputer.pendingChannels.append(channel);
+                channel.pendingRootWord = rootWord;
+                if TreeComputer.loopComputer is None:
+                    TreeComputer.pendingCondition.notify();
+                elif not TreeComputer.computeScheduled:
+                    TreeComputer.computeScheduled = True;
+                    TreeComputer.loopComputer.ioLoop.add_callback(TreeComputer.loopComputer.computeNextTree);
         
         def stop(self):
-            RootWordSubmissionService.TreeComputer.keepRunning = False;
+            with RootWordSubmissionService.TreeComputer.pendingCondition:
+                RootWordSubmissionService.TreeComputer.keepRunning = False;
+                RootWordSubmissionService.TreeComputer.pendingCondition.notify();
+        
+        def makeWordExplorer(self, dbPath=None, treeStore=None):
+            '''
+            @param dbPath: database for the new WordExplorer. Default: the
+                           database in use, along with the tree store in use.
+            @type dbPath: {string | None}
+            @param treeStore: precomputed trees of dbPath, or None.
+            @type treeStore: {PrecomputedTreeStore | None}
+            @rtype: WordExplorer
+            '''
+            if dbPath is None:
+                dbPath = RootWordSubmissionService.dbPath;
+                treeStore = RootWordSubmissionService.treeStore;
+            if RootWordSubmissionService.TreeComputer.useInMemoryGraph:
+                EchoTreeService.log("Loading word database %s into memory..." % dbPath);
+                wordExplorer = WordExplorer(dbPath, graph=FollowerGraph.fromSQLite(dbPath), treeStore=treeStore);
+                EchoTreeService.log("Word database loaded.");
+                return wordExplorer;
+            return WordExplorer(dbPath, treeStore=treeStore);
+        
+        def useWordExplorer(self, wordExplorer):
+            '''
+            Compute trees with the given explorer from now on. The previous
+            explorer is closed, once the tree being computed with it, if any,
+            is done. Tree queries on the IOLoop need no such wait, since this
+            is called on the IOLoop as well.
+            @param wordExplorer: explorer of the new database.
+            @type wordExplorer: WordExplorer
+            '''
+            with self.explorerLock:
+                oldExplorer = self.wordExplorer;
+                self.wordExplorer = wordExplorer;
+                if oldExplorer is not None and oldExplorer is self.busyExplorer:
+                    self.retiredExplorer = oldExplorer;
+                    return;
+            if oldExplorer is not None:
+                oldExplorer.close();
+        
+        def runOnIOLoop(self, ioLoop):
+            '''
+            Compute trees on the given IOLoop from now on, rather than in this
+            thread. The thread must not be started. Submissions must then
+            be made on that IOLoop.
+            @param ioLoop: loop that serves all EchoTree connections.
+            @type ioLoop: IOLoop
+            '''
+            self.wordExplorer = self.makeWordExplorer();
+            self.ioLoop = ioLoop;
+            RootWordSubmissionService.TreeComputer.loopComputer = self;
         
         def run(self):
-            self.wordExplorer = WordExplorer(DBPATH);
-            while RootWordSubmissionService.TreeComputer.keepRunning:
-                RootWordSubmissionService.TreeComputer.newWordEvent.wait();
-                newJSONEchoTreeStr = self.wordExplorer.makeJSONTree(self.wordExplorer.makeWordTree(RootWordSubmissionService.TreeComputer.rootWord));
-                
-                # Store the new tree in the appropriate EchoTreeService class variable:
-                with EchoTreeService.currentEchoTreeLock:
-                    EchoTreeService.currentEchoTree = newJSONEchoTreeStr;
-                    
-                # Signal to the new-tree-arrived event pushers that a new
-                # jsonTree has arrived, and they should push it to their clients:
-                EchoTreeService.notifyInterestedParties();
-                RootWordSubmissionService.TreeComputer.newWordEvent.clear();
-                EchoTreeService.log(RootWordSubmissionService.TreeComputer.rootWord);
-                EchoTreeService.log(newJSONEchoTreeStr);
+            self.wordExplorer = self.makeWordExplorer();
+            pendingChannels = RootWordSubmissionService.TreeComputer.pendingChannels;
+            while True:
+                with RootWordSubmissionService.TreeComputer.pendingCondition:
+                    while len(pendingChannels) == 0 and RootWordSubmissionService.TreeComputer.keepRunning:
+                        RootWordSubmissionService.TreeComputer.pendingCondition.wait();
+                    if not RootWordSubmissionService.TreeComputer.keepRunning:
+                        return;
+                    (rootWord, channels) = self.takeNextRootWord();
+                self.computeAndPublish(rootWord, channels, EchoTreeService.publishNewEchoTree);
+        
+        def computeNextTree(self):
+            '''
+            Runs on the IOLoop given to runOnIOLoop(). Computes the tree of the oldest
+            waiting root word, and schedules itself again if more words are waiting.
+            Between the two calls the loop serves its connections.
+            '''
+            TreeComputer = RootWordSubmissionService.TreeComputer;
+            with TreeComputer.pendingCondition:
+                TreeComputer.computeScheduled = False;
+                if len(TreeComputer.pendingChannels) == 0 or not TreeComputer.keepRunning:
+                    return;
+                (rootWord, channels) = self.takeNextRootWord();
+                if len(TreeComputer.pendingChannels) > 0:
+                    TreeComputer.computeScheduled = True;
+                    self.ioLoop.add_callback(self.computeNextTree);
+            self.computeAndPublish(rootWord, channels, EchoTreeService.broadcastNewEchoTree);
+        
+        def takeNextRootWord(self):
+            '''
+            Remove the oldest waiting root word, and all channels waiting for the same
+            word, from the queue. Caller must hold pendingCondition.
+            @return: the root word, and the channels that wait for its tree.
+            @rtype: (string, [EchoTreeChannel])
+            '''
+            pendingChannels = RootWordSubmissionService.TreeComputer.pendingChannels;
+            channel = pendingChannels.popleft();
+            rootWord = channel.pendingRootWord;
+            channel.pendingRootWord = None;
+            channels = [channel];
+            for otherChannel in list(pendingChannels):
+                if otherChannel.pendingRootWord == rootWord:
+                    pendingChannels.remove(otherChannel);
+                    otherChannel.pendingRootWord = None;
+                    channels.append(otherChannel);
+            return (rootWord, channels);
+        
+        def computeAndPublish(self, rootWord, channels, publishFunc):
+            '''
+            Compute one tree, and publish it on the given channels.
+            @param publishFunc: EchoTreeService.publishNewEchoTree from other threads, 
+                                EchoTreeService.broadcastNewEchoTree on the IOLoop.
+            @type publishFunc: function
+            '''
+            startTime = time.time();
+            with self.explorerLock:
+                wordExplorer = self.busyExplorer = self.wordExplorer;
+            try:
+                (newWordTree, newJSONEchoTreeStr) = wordExplorer.makeWordTreeAndJSON(rootWord, 
+                                                                                     isCancelled=functools.partial(self.isSuperseded, channels));
+            except TreeComputationCancelled:
+                EchoTreeStats.count('treesCancelled');
+                EchoTreeService.logEvent('cancelled', word=rootWord);
+                return;
+            finally:
+                with self.explorerLock:
+                    self.busyExplorer = None;
+                    retiredExplorer = self.retiredExplorer;
+                    self.retiredExplorer = None;
+                if retiredExplorer is not None:
+                    retiredExplorer.close();
+            computeTime = time.time() - startTime;
+            EchoTreeStats.computeTime.observe(computeTime);
+            EchoTreeStats.count('treesComputed');
+            for channel in channels:
+                # Channels with a newer word waiting need not see this tree:
+                if channel.pendingRootWord is not None:
+                    continue;
+                publishFunc(channel, newJSONEchoTreeStr, newWordTree);
+                EchoTreeService.logEvent('published', word=rootWord, channel=channel.channelId, computeSeconds=computeTime);
+            EchoTreeService.logTree(rootWord, newJSONEchoTreeStr);
+        
+        def isSuperseded(self, channels):
+            '''
+            Return True if each of the given channels has a newer root word waiting.
+            '''
+            for channel in channels:
+                if channel.pendingRootWord is None:
+                    return False;
+            return True;
         
+class RootWordSubmissionHandler(tornado.web.RequestHandler):
+    '''
+    Accepts root words as a route of the single-loop application.
+    See RootWordSubmissionService.
+    '''
+    
+    def post(self, channelId=DEFAULT_CHANNEL_ID):
+        RootWordSubmissionService.acceptRootWord(self.request, urllib.unquote(channelId));
+
 # --------------------  Request Handler Class for browsers requesting the JavaScript that knows to open an EchoTreeService connection ---------------
+class CachedScriptFile(object):
+    '''
+    In-memory copy of one file served by EchoTreeScriptRequestHandler,
+    plain and gzipped, with its validators. The copy is reloaded
+    when the file's modification time changes.
+    '''
+    
+    def __init__(self, path, contentType):
+        '''
+        Load the file.
+        @param path: file to serve.
+        @type path: string
+        @param contentType: value of the Content-Type header sent with the file.
+        @type contentType: string
+        @raise IOError: if the file cannot be read.
+        '''
+        self.path = path;
+        self.contentType = contentType;
+        self.mtime = None;
+        self.lastCheckTime = time.time();
+        self.load();
+    
+    def load(self):
+        mtime = os.path.getmtime(self.path);
+        with open(self.path, 'rb') as fileFD:
+            self.body = fileFD.read();
+        gzipBuffer = cStringIO.StringIO();
+        gzipFile = gzip.GzipFile(fileobj=gzipBuffer, mode='wb', compresslevel=9, mtime=int(mtime));
+        gzipFile.write(self.body);
+        gzipFile.close();
+        self.gzippedBody = gzipBuffer.getvalue();
+        self.mtime = mtime;
+        # Second resolution, as in HTTP dates:
+        self.modifiedTime = int(mtime);
+        self.lastModified = email.utils.formatdate(self.modifiedTime, usegmt=True);
+        # The two encodings are different representations, and need different ETags:
+        digest = hashlib.md5(self.body).hexdigest();
+        self.etag = '"%s"' % digest;
+        self.gzippedEtag = '"%s-gz"' % digest;
+    
+    def refresh(self):
+        '''
+        Reload the file if it changed. Checks at most once every
+        SCRIPT_RECHECK_INTERVAL seconds. Keeps serving the old copy
+        if the file disappeared.
+        '''
+        now = time.time();
+        if now - self.lastCheckTime < SCRIPT_RECHECK_INTERVAL:
+            return;
+        self.lastCheckTime = now;
+        try:
+            if os.path.getmtime(self.path) != self.mtime:
+                self.load();
+        except (IOError, OSError) as e:
+            EchoTreeService.log("Cannot reload %s; serving cached copy: %s" % (self.path, str(e)));
+    
+    def isNotModified(self, request):
+        '''
+        Return True if the request's validators show that the client's copy is current.
+        If-None-Match takes precedence over If-Modified-Since.
+        '''
+        ifNoneMatch = request.headers.get('If-None-Match');
+        if ifNoneMatch is not None:
+            clientEtags = [etag.strip() for etag in ifNoneMatch.split(',')];
+            return '*' in clientEtags or self.etag in clientEtags or self.gzippedEtag in clientEtags;
+        ifModifiedSince = request.headers.get('If-Modified-Since');
+        if ifModifiedSince is not None:
+            dateTuple = email.utils.parsedate_tz(ifModifiedSince);
+            if dateTuple is not None:
+                return self.modifiedTime <= email.utils.mktime_tz(dateTuple);
+        return False;
+
 class EchoTreeScriptRequestHandler(HTTPServer):
     '''
     Web service serving a single JavaScript containing HTML page.
     That page contains instructions for requesting an event stream for
-    new EchoTree instances from this server.
+    new EchoTree instances from this server. Assets in the page's directory
+    are served under their file name. All files are served from memory,
+    gzipped for clients that accept it, and answered with 304 Not Modified 
+    when the client's copy is current.
     '''
 
-#    def _execute(self, transforms):
-#        pass;
+    # File name --> CachedScriptFile:
+    cachedFiles = {};
+    
+    @staticmethod
+    def preloadScripts(scriptDir=BROWSER_SCRIPTS_DIR):
+        '''
+        Load the HTML page and all assets into memory.
+        @param scriptDir: directory holding the files.
+        @type scriptDir: string
+        '''
+        for fileName in os.listdir(scriptDir):
+            contentType = SCRIPT_CONTENT_TYPES.get(os.path.splitext(fileName)[1]);
+            if contentType is None or fileName.startswith('.'):
+                continue;
+            EchoTreeScriptRequestHandler.cachedFiles[fileName] = CachedScriptFile(os.path.join(scriptDir, fileName), contentType);
+
+    @staticmethod
+    def makeResponse(request, fileName):
+        '''
+        Build the response to a GET or HEAD request for one file. Unknown
+        file names get TREE_EVENT_LISTEN_SCRIPT_NAME.
+        @param request: the request.
+        @type request: HTTPRequest.HTTPRequest
+        @param fileName: name of the requested file in BROWSER_SCRIPTS_DIR.
+        @type fileName: string
+        @return: HTTP status code, response headers, and body.
+        @rtype: (int, [(string, string)], string)
+        '''
+        cachedFiles = EchoTreeScriptRequestHandler.cachedFiles;
+        cachedFile = cachedFiles.get(fileName, cachedFiles[TREE_EVENT_LISTEN_SCRIPT_NAME]);
+        cachedFile.refresh();
+        
+        useGzip = 'gzip' in request.headers.get('Accept-Encoding', '');
+        # Spelled as tornado.web spells it, so that RequestHandler does not add its own:
+        headers = [("Cache-Control", "no-cache"),
+                   ("Vary", "Accept-Encoding"),
+                   ("Etag", cachedFile.gzippedEtag if useGzip else cachedFile.etag),
+                   ("Last-Modified", cachedFile.lastModified),
+                   ];
+        if cachedFile.isNotModified(request):
+            return (304, headers, '');
+        if useGzip:
+            body = cachedFile.gzippedBody;
+            headers.append(("Content-Encoding", "gzip"));
+        else:
+            body = cachedFile.body;
+        headers.append(("Content-Type", cachedFile.contentType));
+        headers.append(("Content-Length", str(len(body))));
+        return (200, headers, body);
 
     @staticmethod
     def handle_request(request):
         '''
-        Hangles the HTTP GET request.
+        Handles the HTTP GET request on the separate script server port. Requests for 
+        a known asset file name get that file; all others get TREE_EVENT_LISTEN_SCRIPT_NAME.
         @param request: instance holding information about the request
-        @type request: ???
-        '''
-        # Path to the HTML page we serve. Should probably just load that once, but
-        # this request is not frequent. 
-        scriptPath = os.path.join(os.path.dirname(os.path.realpath(__file__)), "../browser_scripts/" + TREE_EVENT_LISTEN_SCRIPT_NAME);
-        # Create the response and the HTML page string:
-        reply =  "HTTP/1.1 200 OK\r\n" +\
-                 "Content-type, text/html\r\n" +\
-                 "Content-Length:%s\r\n" % os.path.getsize(scriptPath) +\
-                 "Last-Modified:%s\r\n" % time.ctime(os.path.getmtime(scriptPath)) +\
-                 "\r\n";
-        # Add the HTML page to the header:
-        with open(scriptPath) as fileFD:
-            for line in fileFD:
-                reply += line;
-        request.write(reply);
+        @type request: HTTPRequest.HTTPRequest
+        '''
+        if request.method not in ('GET', 'HEAD'):
+            request.write("HTTP/1.1 405 Method Not Allowed\r\nAllow: GET, HEAD\r\nContent-Length: 0\r\n\r\n");
+            request.finish();
+            return;
+        (statusCode, headers, body) = EchoTreeScriptRequestHandler.makeResponse(request, request.path.lstrip('/'));
+        if request.method == 'HEAD':
+            body = '';
+        request.write("HTTP/1.1 %d %s\r\n" % (statusCode, httplib.responses[statusCode]) +
+                      "".join(["%s: %s\r\n" % header for header in headers]) + "\r\n" + body);
         request.finish();
+
+class EchoTreeScriptHandler(tornado.web.RequestHandler):
+    '''
+    Serves the browser scripts as a route of the single-loop application.
+    See EchoTreeScriptRequestHandler.
+    '''
+    
+    def get(self, fileName=TREE_EVENT_LISTEN_SCRIPT_NAME):
+        (statusCode, headers, body) = EchoTreeScriptRequestHandler.makeResponse(self.request, fileName);
+        self.set_status(statusCode);
+        for (name, value) in headers:
+            self.set_header(name, value);
+        if statusCode == 304:
+            # RequestHandler refuses even an empty body with 304:
+            self.finish();
+            return;
+        self.finish(body);
+
+    def head(self, fileName=TREE_EVENT_LISTEN_SCRIPT_NAME):
+        self.get(fileName);
+        
+# --------------------  Request Handler Class for tree queries ---------------
+
+class TreeQueryHandler(tornado.web.RequestHandler):
+    '''
+    Returns the JSON tree for GET TREE_QUERY_URI_PATH?word=...&depth=...&breadth=...
+    without involving channels. Trees come from the TreeWorkerPool, or from the 
+    TreeComputer's WordExplorer, and their caches. 
+    
+    A tree only depends on its parameters and the word database. Its strong ETag
+    is therefore derived from both, and a matching If-None-Match is answered
+    with 304 Not Modified before the tree is looked up.
+    
+    Without a TreeWorkerPool (-w 0), trees that are not cached are computed
+    synchronously on the IOLoop, which serves no other browser meanwhile. 
+    Run with workers where tree queries are frequent.
+    '''
+    
+    # Identifies the content of the word database; see echo_tree.getDatabaseVersion().
+    # Replaced by DatabaseSwapper:
+    dbVersion = None;
+    
+    def initialize(self):
+        self.poolRequest = None;
+        self.connectionClosed = False;
+    
+    @tornado.web.asynchronous
+    def get(self):
+        word = self.get_argument('word').encode('utf-8');
+        maxDepth = self.getIntArgument('depth', WORD_TREE_DEPTH, MAX_QUERY_TREE_DEPTH);
+        maxBranch = self.getIntArgument('breadth', WORD_TREE_BREADTH, MAX_QUERY_TREE_BREADTH);
+        
+        if TreeQueryHandler.dbVersion is None:
+            TreeQueryHandler.dbVersion = getDatabaseVersion(RootWordSubmissionService.dbPath);
+        etag = '"%s"' % hashlib.md5('\0'.join([TreeQueryHandler.dbVersion, word, str(maxDepth), str(maxBranch)])).hexdigest();
+        self.set_header("Etag", etag);
+        self.set_header("Cache-Control", "public, max-age=%d" % TREE_QUERY_MAX_AGE);
+        if self.isNotModified(etag):
+            self.set_status(304);
+            self.finish();
+            return;
         
+        treeWorkerPool = RootWordSubmissionService.treeWorkerPool;
+        if treeWorkerPool is not None:
+            self.poolRequest = treeWorkerPool.computeTree(word, self.onTreeComputed, maxDepth, maxBranch);
+            return;
+        # The TreeComputer's explorer, with its caches. WordExplorers may be 
+        # shared among threads, so this works whether or not the TreeComputer
+        # runs in a thread of its own:
+        treeComputer = RootWordSubmissionService.TreeComputer.instance;
+        wordExplorer = treeComputer.wordExplorer if treeComputer is not None else None;
+        if wordExplorer is None:
+            raise tornado.web.HTTPError(503, "the word database is still being opened");
+        # Blocks the IOLoop while the tree is built; see class comment:
+        startTime = time.time();
+        jsonTree = wordExplorer.makeWordTreeAndJSON(word, maxDepth, maxBranch)[1];
+        self.onTreeComputed(word, jsonTree, None, time.time() - startTime);
+    
+    def isNotModified(self, etag):
+        '''
+        Return True if the request's If-None-Match header lists the given ETag,
+        or is '*'. Tags are compared whole; weak tags (W/"...") match their strong
+        counterparts, as If-None-Match requires.
+        @param etag: the tree's quoted ETag.
+        @type etag: string
+        @rtype: boolean
+        '''
+        ifNoneMatch = self.request.headers.get('If-None-Match');
+        if ifNoneMatch is None:
+            return False;
+        for clientEtag in ifNoneMatch.split(','):
+            clientEtag = clientEtag.strip();
+            if clientEtag.startswith('W/'):
+                clientEtag = clientEtag[2:].strip();
+            if clientEtag == etag or clientEtag == '*':
+                return True;
+        return False;
+    
+    def getIntArgument(self, name, default, maxValue):
+        try:
+            value = int(self.get_argument(name, default));
+        except ValueError:
+            raise tornado.web.HTTPError(400, "%s must be an integer" % name);
+        if value < 1 or value > maxValue:
+            raise tornado.web.HTTPError(400, "%s must be between 1 and %d" % (name, maxValue));
+        return value;
+    
+    def onTreeComputed(self, word, jsonTree, errorMsg, computeTime):
+        self.poolRequest = None;
+        if self.connectionClosed:
+            return;
+        if jsonTree is None:
+            EchoTreeService.log("Tree query for '%s' failed: %s" % (word, errorMsg));
+            # Clears the ETag and cache headers as well:
+            self.send_error(500);
+            return;
+        self.set_header("Content-Type", "application/json");
+        self.finish(jsonTree);
+    
+    def on_connection_close(self):
+        self.connectionClosed = True;
+        if self.poolRequest is not None:
+            RootWordSubmissionService.treeWorkerPool.cancelRequest(self.poolRequest);
+            self.poolRequest = None;
+
+# --------------------  Request Handler Class for metrics ---------------
+
+class StatsHandler(tornado.web.RequestHandler):
+    '''
+    Serves EchoTreeStats as JSON, or, with ?format=prometheus, in
+    the Prometheus text format.
+    '''
+    
+    def initialize(self, defaultFormat='json'):
+        self.defaultFormat = defaultFormat;
+    
+    def get(self):
+        self.set_header("Cache-Control", "no-cache");
+        if self.get_argument('format', self.defaultFormat) == 'prometheus':
+            self.set_header("Content-Type", PROMETHEUS_CONTENT_TYPE);
+            self.finish(EchoTreeStats.registry.toPrometheus());
+            return;
+        self.set_header("Content-Type", "application/json");
+        self.finish(json.dumps(EchoTreeStats.registry.getStats()));
+
+# --------------------  Hot swap of the word database ---------------
+
+class DatabaseSwapper(Thread):
+    '''
+    Moves the server to another word database, or to a rebuilt version of
+    the current one, without a restart. This thread opens the new database 
+    and its tree store. With warm-up, it also computes from the new database
+    the trees most recently computed from the old one. Then one IOLoop callback,
+    swap(), puts the new database in place of the old: in the TreeWorkerPool or
+    the TreeComputer, in TreeQueryHandler's ETags, and in the channels' duplicate
+    suppression. Subscriber connections are not touched. Browsers keep their
+    current trees until the next root word arrives.
+    
+    Trees being computed during the swap are published when done, even though 
+    they come from the old database, which is closed afterwards. Tree workers
+    close it when they open a newer one; see WORKER_MAX_DATABASES. At most one
+    swap runs at a time.
+    '''
+    
+    # The swap in progress, if any:
+    current = None;
+    currentLock = Lock();
+    # Set by the SIGHUP handler. Signal handlers must not touch the IOLoop,
+    # whose callback lock they may interrupt; checkHangup() polls this instead:
+    hangupReceived = False;
+    # PeriodicCallback running checkHangup(), see watchHangups():
+    hangupChecker = None;
+    
+    def __init__(self, ioLoop, dbPath, treeStorePath=None, warmUp=True, doneCallback=None):
+        '''
+        Use DatabaseSwapper.startSwap() rather than creating instances directly.
+        @param ioLoop: the loop that serves the EchoTree connections.
+        @type ioLoop: IOLoop
+        @param dbPath: SQLite database or graph file to swap in.
+        @type dbPath: string
+        @param treeStorePath: tree store of the new database. Default: the store given 
+                              on the command line if dbPath is the database in use, else
+                              dbPath + PRECOMPUTED_TREES_SUFFIX, if it exists.
+        @type treeStorePath: {string | None}
+        @param warmUp: if True, compute the hot trees from the new database before the swap.
+        @type warmUp: boolean
+        @param doneCallback: called on ioLoop as doneCallback(result, errorMsg). result is
+                             a dict describing the new database, or None if the swap failed;
+                             errorMsg then says why.
+        @type doneCallback: {callable | None}
+        '''
+        super(DatabaseSwapper, self).__init__(name='DatabaseSwapper');
+        self.daemon = True;
+        if treeStorePath is None and dbPath == RootWordSubmissionService.dbPath:
+            treeStorePath = RootWordSubmissionService.treeStorePath;
+        self.ioLoop = ioLoop;
+        self.dbPath = dbPath;
+        self.treeStorePath = treeStorePath;
+        self.warmUp = warmUp;
+        self.doneCallback = doneCallback;
+        self.startTime = time.time();
+        # Set by prepare():
+        self.dbVersion = None;
+        self.treeStore = None;
+        self.preparedPool = None;
+        self.wordExplorer = None;
+        self.numTreesWarmedUp = 0;
+    
+    @staticmethod
+    def startSwap(ioLoop, dbPath, treeStorePath=None, warmUp=True, doneCallback=None):
+        '''
+        Start a swap, unless one is in progress. See __init__() for the parameters.
+        @return: the new swapper, or None if another swap is in progress.
+        @rtype: {DatabaseSwapper | None}
+        '''
+        with DatabaseSwapper.currentLock:
+            if DatabaseSwapper.current is not None:
+                EchoTreeService.log("Swap to database %s ignored: a swap to %s is in progress." % (dbPath, DatabaseSwapper.current.dbPath));
+                return None;
+            swapper = DatabaseSwapper(ioLoop, dbPath, treeStorePath, warmUp, doneCallback);
+            DatabaseSwapper.current = swapper;
+        EchoTreeService.log("Opening database %s for swap..." % dbPath);
+        swapper.start();
+        return swapper;
+    
+    @staticmethod
+    def watchHangups(ioLoop):
+        '''
+        Reopen the current database when SIGHUP arrives, e.g. after it
+        was rebuilt. The signal handler only sets hangupReceived; the 
+        swap starts on the given IOLoop within HANGUP_CHECK_INTERVAL seconds.
+        @param ioLoop: the loop that serves the EchoTree connections.
+        @type ioLoop: IOLoop
+        '''
+        if not hasattr(signal, 'SIGHUP'):
+            return;
+        def onHangup(signum, frame):
+            DatabaseSwapper.hangupReceived = True;
+        signal.signal(signal.SIGHUP, onHangup);
+        DatabaseSwapper.hangupChecker = PeriodicCallback(functools.partial(DatabaseSwapper.checkHangup, ioLoop),
+                                                         HANGUP_CHECK_INTERVAL * 1000, io_loop=ioLoop);
+        DatabaseSwapper.hangupChecker.start();
+    
+    @staticmethod
+    def checkHangup(ioLoop):
+        # Runs on the IOLoop.
+        if DatabaseSwapper.hangupReceived:
+            DatabaseSwapper.hangupReceived = False;
+            DatabaseSwapper.startSwap(ioLoop, RootWordSubmissionService.dbPath);
+    
+    def run(self):
+        try:
+            self.prepare();
+        except Exception:
+            errMsg = "Swap to database %s failed: %s" % (self.dbPath, traceback.format_exc());
+            if self.wordExplorer is not None:
+                self.wordExplorer.close();
+            self.ioLoop.add_callback(functools.partial(self.finish, None, errMsg));
+            return;
+        self.ioLoop.add_callback(self.swap);
+    
+    def prepare(self):
+        '''
+        Open the new database, load its tree store, and warm up its caches.
+        Runs in this thread, while the old database keeps serving.
+        '''
+        if not os.path.isfile(self.dbPath):
+            raise IOError("Database file %s does not exist." % self.dbPath);
+        self.dbVersion = getDatabaseVersion(self.dbPath);
+        self.treeStore = self.loadTreeStore();
+        treeWorkerPool = RootWordSubmissionService.treeWorkerPool;
+        if treeWorkerPool is not None:
+            warmUpKeys = treeWorkerPool.getHotTreeKeys(DATABASE_WARM_UP_MAX_TREES) if self.warmUp else [];
+            self.preparedPool = treeWorkerPool.prepareDatabase(self.dbPath, self.treeStore, warmUpKeys, self.dbVersion);
+            self.numTreesWarmedUp = len(self.preparedPool[2]);
+            return;
+        treeComputer = RootWordSubmissionService.TreeComputer.instance;
+        self.wordExplorer = treeComputer.makeWordExplorer(self.dbPath, self.treeStore);
+        oldExplorer = treeComputer.wordExplorer;
+        if self.warmUp and oldExplorer is not None:
+            # Hottest last, so that they end up most recently used:
+            self.numTreesWarmedUp = self.wordExplorer.warmUp(oldExplorer.treeCache.getKeys(DATABASE_WARM_UP_MAX_TREES)[::-1]);
+    
+    def loadTreeStore(self):
+        '''
+        @return: the tree store of the new database, or None if there is none, or it does not match.
+        @rtype: {PrecomputedTreeStore | None}
+        '''
+        storePath = self.treeStorePath;
+        if storePath is None:
+            storePath = self.dbPath + PRECOMPUTED_TREES_SUFFIX;
+            if not os.path.isfile(storePath):
+                return None;
+        try:
+            treeStore = PrecomputedTreeStore(storePath, self.dbPath);
+        except (IOError, ValueError) as e:
+            EchoTreeService.log("Precomputed trees not used: %s" % str(e));
+            return None;
+        EchoTreeService.log("Loaded %d precomputed trees from %s." % (len(treeStore), storePath));
+        return treeStore;
+    
+    def swap(self):
+        '''
+        Runs on the IOLoop. Puts the prepared database in place of the old one.
+        '''
+        RootWordSubmissionService.dbPath = self.dbPath;
+        RootWordSubmissionService.treeStore = self.treeStore;
+        RootWordSubmissionService.treeStorePath = self.treeStorePath;
+        TreeQueryHandler.dbVersion = self.dbVersion;
+        treeWorkerPool = RootWordSubmissionService.treeWorkerPool;
+        if treeWorkerPool is not None:
+            treeWorkerPool.useDatabase(self.preparedPool);
+        else:
+            # The TreeComputer thread picks this up with its next tree, tree queries with their next request:
+            RootWordSubmissionService.TreeComputer.instance.useWordExplorer(self.wordExplorer);
+        # The latest root words' trees came from the old database; let resubmissions through:
+        with EchoTreeChannel.channelsLock:
+            channels = EchoTreeChannel.channels.values();
+        for channel in channels:
+            with channel.submissionLock:
+                channel.latestRootWord = None;
+        EchoTreeStats.count('databaseSwaps');
+        self.finish({'dbPath'           : self.dbPath,
+                     'dbVersion'        : self.dbVersion,
+                     'precomputedTrees' : len(self.treeStore) if self.treeStore is not None else 0,
+                     'treesWarmedUp'    : self.numTreesWarmedUp,
+                     'seconds'          : time.time() - self.startTime
+                     }, None);
+    
+    def finish(self, result, errMsg):
+        # Runs on the IOLoop.
+        with DatabaseSwapper.currentLock:
+            DatabaseSwapper.current = None;
+        if result is None:
+            EchoTreeService.log(errMsg);
+        else:
+            EchoTreeService.logEvent('databaseSwapped', **result);
+        if self.doneCallback is not None:
+            self.doneCallback(result, errMsg);
+
+class DatabaseSwapHandler(tornado.web.RequestHandler):
+    '''
+    POST ADMIN_SWAP_DATABASE_URI_PATH starts a DatabaseSwapper. Optional
+    arguments: db, the database file to swap in; treeStore, its tree store file;
+    and warmUp=0 to skip the warm-up. Without db, the current database is 
+    reopened, as after rebuilding it in place. The JSON response is sent when
+    the swap is done. Only clients in ADMIN_CLIENT_ADDRESSES that send adminToken
+    in the ADMIN_TOKEN_HEADER header are served. Without an adminToken, the 
+    route is closed.
+    '''
+    
+    # Shared secret of the admin clients, read from the -a file:
+    adminToken = None;
+    
+    def initialize(self):
+        self.connectionClosed = False;
+    
+    @tornado.web.asynchronous
+    def post(self):
+        if self.request.remote_ip not in ADMIN_CLIENT_ADDRESSES or not self.isAdmin():
+            raise tornado.web.HTTPError(403);
+        dbPath = self.get_argument('db', RootWordSubmissionService.dbPath);
+        if not os.path.isfile(dbPath):
+            raise tornado.web.HTTPError(400, "database file %s does not exist" % dbPath);
+        swapper = DatabaseSwapper.startSwap(self.request.connection.stream.io_loop, dbPath,
+                                            treeStorePath=self.get_argument('treeStore', None),
+                                            warmUp=self.get_argument('warmUp', '1') != '0',
+                                            doneCallback=self.onSwapDone);
+        if swapper is None:
+            raise tornado.web.HTTPError(409, "another database swap is in progress");
+    
+    def isAdmin(self):
+        '''
+        Return True if the request carries the admin secret.
+        @rtype: boolean
+        '''
+        adminToken = DatabaseSwapHandler.adminToken;
+        if adminToken is None:
+            return False;
+        # Constant time comparison, so that response times do not give the secret away:
+        return hmac.compare_digest(self.request.headers.get(ADMIN_TOKEN_HEADER, ''), adminToken);
+    
+    def onSwapDone(self, result, errMsg):
+        if self.connectionClosed:
+            return;
+        self.set_header("Content-Type", "application/json");
+        if result is None:
+            self.set_status(500);
+            result = {'error' : errMsg};
+        self.finish(json.dumps(result));
+    
+    def on_connection_close(self):
+        self.connectionClosed = True;
+
+# --------------------  Application holding the services as routes ---------------
+
+class EchoTreeApplication(tornado.web.Application):
+    '''
+    The EchoTree subscription service. With allServices set, it also
+    serves root word submissions and the browser scripts, so that one
+    port and one IOLoop carry everything.
+    '''
+    
+    def __init__(self, allServices=False):
+        '''
+        @param allServices: if True, add the submission and script routes.
+        @type allServices: boolean
+        '''
+        handlers = [(ECHO_TREE_SUBSCRIBE_PATH, EchoTreeService),
+                    (ECHO_TREE_SUBSCRIBE_PATH + "/(" + CHANNEL_ID_PATTERN + ")", EchoTreeService),
+                    (TREE_QUERY_URI_PATH, TreeQueryHandler),
+                    (STATS_URI_PATH, StatsHandler),
+                    (PROMETHEUS_STATS_URI_PATH, StatsHandler, {'defaultFormat' : 'prometheus'}),
+                    (ADMIN_SWAP_DATABASE_URI_PATH, DatabaseSwapHandler),
+                    ];
+        if allServices:
+            handlers.extend([(NEW_TREE_SUBMISSION_URI_PATH, RootWordSubmissionHandler),
+                             (NEW_TREE_SUBMISSION_URI_PATH + "/(" + CHANNEL_ID_PATTERN + ")", RootWordSubmissionHandler),
+                             (r"/", EchoTreeScriptHandler),
+                             (SCRIPT_REQUEST_URI_PATH, EchoTreeScriptHandler),
+                             (r"/([A-Za-z0-9_\-][A-Za-z0-9_.\-]*)", EchoTreeScriptHandler),
+                             ]);
+        super(EchoTreeApplication, self).__init__(handlers);
+
 # --------------------  Helper class for spawning the services in their own threads ---------------
                 
 class SocketServerThreadStarter(Thread):
     '''
-    Used to fire up the three services each in its own thread.
+    Used to fire up the submission and script services each in its own thread,
+    or, via startOnIOLoop(), on an existing IOLoop.
     '''
     
     def __init__(self, socketServerClassName, port):
@@ -323,10 +1637,30 @@ class SocketServerThreadStarter(Thread):
         super(SocketServerThreadStarter, self).__init__();
         self.socketServerClassName = socketServerClassName;
         self.port = port;
-        self.ioLoop = None;
+        self.ioLoop = IOLoop();
 
     def stop(self):
-        self.ioLoop.stop();
+        # IOLoop.stop() is not thread safe; add_callback() is:
+        self.ioLoop.add_callback(self.ioLoop.stop);
+    
+    def startOnIOLoop(self, ioLoop):
+        '''
+        Listen on the port from the given IOLoop, without starting a thread.
+        @param ioLoop: a loop that is run elsewhere.
+        @type ioLoop: IOLoop
+        '''
+        self.ioLoop = ioLoop;
+        self.makeServer().listen(self.port);
+    
+    def makeServer(self):
+        if  self.socketServerClassName == 'RootWordSubmissionService':
+            EchoTreeService.log("Starting EchoTree new tree submissions server %d: accepts word trees submitted from connecting clients." % self.port);
+            return RootWordSubmissionService(RootWordSubmissionService.handle_request, io_loop=self.ioLoop);
+        elif self.socketServerClassName == 'EchoTreeScriptRequestHandler':
+            EchoTreeService.log("Starting EchoTree script server %d: Returns one script that listens to the new-tree events in the browser." % self.port);
+            return EchoTreeScriptRequestHandler(EchoTreeScriptRequestHandler.handle_request, io_loop=self.ioLoop);
+        else:
+            raise ValueError("Service class %s is unknown." % self.socketServerClassName);
        
     def run(self):
         '''
@@ -335,37 +1669,16 @@ class SocketServerThreadStarter(Thread):
         '''
         super(SocketServerThreadStarter, self).run();
         try:
-            if  self.socketServerClassName == 'RootWordSubmissionService':
-                EchoTreeService.log("Starting EchoTree new tree submissions server %d: accepts word trees submitted from connecting clients." % self.port);
-                http_server = RootWordSubmissionService(RootWordSubmissionService.handle_request);
-                http_server.listen(self.port);
-                self.ioLoop = IOLoop();
-                self.ioLoop.start();
-                self.ioLoop.close(all_fds=True);
-                return;
-            elif self.socketServerClassName == 'EchoTreeScriptRequestHandler':
-                EchoTreeService.log("Starting EchoTree script server %d: Returns one script that listens to the new-tree events in the browser." % self.port);
-                http_server = EchoTreeScriptRequestHandler(EchoTreeScriptRequestHandler.handle_request);
-                http_server.listen(self.port);
-                self.ioLoop = IOLoop();
-                self.ioLoop.start();
-                self.ioLoop.close(all_fds=True);
-                return;
-            else:
-                raise ValueError("Service class %s is unknown." % self.socketServerClassName);
+            self.makeServer().listen(self.port);
+            self.ioLoop.start();
         except Exception:
-            # Typically an exception is caught here that complains about 'socket in use'
-            # Should avoid that by sensing busy socket and timing out:
-#            if e.errno == 98:
-#                print "Exception: %s. You need to try starting this service again. Socket busy condition will time out within 30 secs or so." % `e`
-#            else:
-#                print `e`;
-            #raise e;
-            pass
+            # Typically 'socket in use'; the socket times out within 30 secs or so:
+            errMsg = "Service %s on port %d stopped by error: %s" % (self.socketServerClassName, self.port, traceback.format_exc());
+            EchoTreeService.log(errMsg);
+            if EchoTreeService.logWriter is None:
+                sys.stderr.write(errMsg + '\n');
         finally:
-            if self.ioLoop is not None and self.ioLoop.running():
-                self.ioLoop.stop();
-                return;
+            self.ioLoop.close(all_fds=True);
 
 
 if __name__ == '__main__':
@@ -375,6 +1688,41 @@ if __name__ == '__main__':
     parser.add_argument("-v", "--verbose, help=print operational info to console.", 
                         dest='verbose',
                         action='store_true');
+    parser.add_argument("-g", "--inMemoryGraph", help="load the word database into memory at startup, and never query SQLite afterwards.", 
+                        dest='inMemoryGraph',
+                        action='store_true');
+    parser.add_argument("-w", "--workers", help="number of tree computation processes. 0: compute trees in a thread of the server process, and tree queries on its IOLoop, which blocks it. Default: number of CPUs.", 
+                        dest='numWorkers',
+                        type=int,
+                        default=DEFAULT_NUM_TREE_WORKERS);
+    parser.add_argument("-s", "--slowClientTimeout", help="seconds a browser may take to receive a tree before it is disconnected. Default: %d." % SLOW_CONSUMER_TIMEOUT, 
+                        dest='slowClientTimeout',
+                        type=float,
+                        default=SLOW_CONSUMER_TIMEOUT);
+    parser.add_argument("-z", "--compressionLevel", help="zlib level (1-9) for trees sent to browsers that support compression. 0: no compression. Default: %d." % TREE_COMPRESSION_LEVEL, 
+                        dest='compressionLevel',
+                        type=int,
+                        default=TREE_COMPRESSION_LEVEL);
+    parser.add_argument("-t", "--contextTakeover", help="keep a compression context per browser across trees. Smaller trees on the wire, more memory and CPU per browser.", 
+                        dest='contextTakeover',
+                        action='store_true');
+    parser.add_argument("-n", "--noPrefetch", help="do not precompute the trees of words shown in the current tree. Only applies with -w > 0.", 
+                        dest='noPrefetch',
+                        action='store_true');
+    parser.add_argument("-e", "--singleLoop", help="serve subscriptions, submissions, and scripts as routes on port %d, all from one IOLoop. With -w 0, trees are computed on that loop as well." % ECHO_TREE_GET_PORT, 
+                        dest='singleLoop',
+                        action='store_true');
+    parser.add_argument("-j", "--treeLogSampling", help="log the JSON of every Nth computed tree, truncated. 0: never. Default: %d." % TREE_LOG_SAMPLE_INTERVAL, 
+                        dest='treeLogSampling',
+                        type=int,
+                        default=TREE_LOG_SAMPLE_INTERVAL);
+    parser.add_argument("-k", "--treeStore", help="file of precomputed trees made by make_tree_store.py. Default: %s, if it exists." % TREE_STORE_PATH, 
+                        dest='treeStore');
+    parser.add_argument("-p", "--legacyPorts", help="with -e, also accept submissions on port %d and script requests on port %d, from the same IOLoop." % (ECHO_TREE_NEW_ROOT_PORT, ECHO_TREE_SCRIPT_SERVER_PORT), 
+                        dest='legacyPorts',
+                        action='store_true');
+    parser.add_argument("-a", "--adminTokenFile", help="file holding the secret that admin requests send in the %s header. Default: admin routes are closed." % ADMIN_TOKEN_HEADER, 
+                        dest='adminTokenFile');
     
     
     args = parser.parse_args();
@@ -387,44 +1735,107 @@ if __name__ == '__main__':
     
     if args.verbose:
         EchoTreeService.logToConsole = True;
+    EchoTreeService.treeLogSampleInterval = args.treeLogSampling;
+    EchoTreeService.prepareLogging();
+    EchoTreeService.log("SQLite word databases are opened read-only via %s." % getReadOnlyOpenMethod());
+        
+    if args.inMemoryGraph:
+        RootWordSubmissionService.TreeComputer.useInMemoryGraph = True;
+        
+    if args.noPrefetch:
+        RootWordSubmissionService.prefetchTrees = False;
+        
+    if args.adminTokenFile is not None:
+        try:
+            with open(args.adminTokenFile) as adminTokenFD:
+                DatabaseSwapHandler.adminToken = adminTokenFD.read().strip();
+        except IOError, e:
+            print "Cannot read admin token file '%s'. Server not started." % args.adminTokenFile;
+            sys.exit();
+        if len(DatabaseSwapHandler.adminToken) == 0:
+            print "Admin token file '%s' is empty. Server not started." % args.adminTokenFile;
+            sys.exit();
+        
+    EchoTreeService.slowConsumerTimeout = args.slowClientTimeout;
+    EchoTreeService.compressionLevel = args.compressionLevel;
+    EchoTreeService.compressionContextTakeover = args.contextTakeover;
+        
+    RootWordSubmissionService.treeStorePath = args.treeStore;
+    treeStorePath = args.treeStore if args.treeStore is not None else TREE_STORE_PATH;
+    if args.treeStore is not None or os.path.isfile(treeStorePath):
+        try:
+            RootWordSubmissionService.treeStore = PrecomputedTreeStore(treeStorePath, DBPATH);
+            EchoTreeService.log("Loaded %d precomputed trees from %s." % (len(RootWordSubmissionService.treeStore), treeStorePath));
+        except (IOError, ValueError) as e:
+            EchoTreeService.log("Precomputed trees not used: %s" % str(e));
+    
+    # Worker processes are forked, so start them before any threads, 
+    # including the log writer's. Log records are queued until it starts:
+    if args.numWorkers > 0:
+        EchoTreeService.log("Starting %d tree computation processes." % args.numWorkers);
+        RootWordSubmissionService.treeWorkerPool = TreeWorkerPool(DBPATH, numWorkers=args.numWorkers, useInMemoryGraph=args.inMemoryGraph,
+                                                                  treeStore=RootWordSubmissionService.treeStore);
+    EchoTreeService.startLogging();
 
-    # Create the service that accepts new words, and distributes the corresponding
-    # JSON tree to all connected browsers:
-    EchoTreeService.log('Starting listener for new root words via HTTP at port %d' % ECHO_TREE_NEW_ROOT_PORT);
-    rootWordAcceptor = SocketServerThreadStarter('RootWordSubmissionService', ECHO_TREE_NEW_ROOT_PORT); 
-    rootWordAcceptor.start();
-    
-    # Create the service that serves out a small JS script that listens to the new-tree events:
-    EchoTreeService.log('Starting EchoTree script server at port %d' % ECHO_TREE_SCRIPT_SERVER_PORT);
-    scriptServer = SocketServerThreadStarter('EchoTreeScriptRequestHandler', ECHO_TREE_SCRIPT_SERVER_PORT); 
-    scriptServer.start();
-    
-    EchoTreeService.log("Starting TreeComputer thread: computes new tree from Web-submitted words, using echo_tree.");
-    treeComputerThread = RootWordSubmissionService.TreeComputer(); 
-    treeComputerThread.start();    
-    
-    EchoTreeService.log("Starting EchoTree server at port %s: pushes new word trees to all connecting clients." % "/subscribe_to_echo_trees");
-    application = tornado.web.Application([(r"/subscribe_to_echo_trees", EchoTreeService),
-                                           ]);
-                                           
+    EchoTreeScriptRequestHandler.preloadScripts();
+    ioLoop = IOLoop.instance();
+    
+    serviceThreads = [];
+    if not args.singleLoop or args.legacyPorts:
+        # Create the service that accepts new words, and distributes the corresponding
+        # JSON tree to all connected browsers:
+        EchoTreeService.log('Starting listener for new root words via HTTP at port %d' % ECHO_TREE_NEW_ROOT_PORT);
+        rootWordAcceptor = SocketServerThreadStarter('RootWordSubmissionService', ECHO_TREE_NEW_ROOT_PORT); 
+        
+        # Create the service that serves out a small JS script that listens to the new-tree events:
+        EchoTreeService.log('Starting EchoTree script server at port %d' % ECHO_TREE_SCRIPT_SERVER_PORT);
+        scriptServer = SocketServerThreadStarter('EchoTreeScriptRequestHandler', ECHO_TREE_SCRIPT_SERVER_PORT); 
+        
+        if args.singleLoop:
+            rootWordAcceptor.startOnIOLoop(ioLoop);
+            scriptServer.startOnIOLoop(ioLoop);
+        else:
+            serviceThreads = [rootWordAcceptor, scriptServer];
+            rootWordAcceptor.start();
+            scriptServer.start();
+    
+    treeComputer = None;
+    if RootWordSubmissionService.treeWorkerPool is None:
+        treeComputer = RootWordSubmissionService.TreeComputer(); 
+        if args.singleLoop:
+            EchoTreeService.log("Computing trees from Web-submitted words on the IOLoop, using echo_tree.");
+            treeComputer.runOnIOLoop(ioLoop);
+        else:
+            EchoTreeService.log("Starting TreeComputer thread: computes new tree from Web-submitted words, using echo_tree.");
+            treeComputer.start();
+    
+    EchoTreeService.log("Starting EchoTree server at port %s: pushes new word trees to all connecting clients." % ECHO_TREE_SUBSCRIBE_PATH);
+    application = EchoTreeApplication(allServices=args.singleLoop);
     application.listen(ECHO_TREE_GET_PORT);
+    EchoTreeStats.lagMonitor = IOLoopLagMonitor(ioLoop, EchoTreeStats.ioLoopLag);
+    EchoTreeStats.lagMonitor.start();
+    EchoTreeService.watchSlowConsumers(ioLoop);
+    DatabaseSwapper.watchHangups(ioLoop);
     try:
-        ioLoop = IOLoop.instance();
         try:
             ioLoop.start()
             ioLoop.close(all_fds=True);
-        except Exception, e:
-            ioLoop.stop();
-            if e.__class__ == KeyboardInterrupt:
-                raise e;
+        except Exception:
+            EchoTreeService.log("EchoTree server stopped by error: %s" % traceback.format_exc());
+            EchoTreeService.stopLogging();
+            raise;
     except KeyboardInterrupt:
         EchoTreeService.log("Stopping EchoTree servers...");
         if ioLoop.running():
             ioLoop.stop();
-        rootWordAcceptor.stop();
-        scriptServer.stop();
-        treeComputerThread.stop();
+        for serviceThread in serviceThreads:
+            serviceThread.stop();
+        if treeComputer is not None:
+            treeComputer.stop();
+        if RootWordSubmissionService.treeWorkerPool is not None:
+            RootWordSubmissionService.treeWorkerPool.stop();
         EchoTreeService.log("EchoTree servers stopped.");
+        EchoTreeService.stopLogging();
         if EchoTreeService.logFD is not None:
             EchoTreeService.logFD.close();
         os._exit(0);
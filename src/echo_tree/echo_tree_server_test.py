@@ -0,0 +1,794 @@
+#!/usr/bin/env python
+
+'''
+Tests of the EchoTree server's HTTP tree query API, run against
+EchoTreeApplication on a test IOLoop, of database swaps, and of
+tree broadcasts to subscribed browsers, which are played by IOStreams
+that speak just enough of the websocket protocol.
+'''
+
+import os;
+import re;
+import gzip;
+import json;
+import email.utils;
+import time;
+import socket;
+import struct;
+import threading;
+import unittest;
+from StringIO import StringIO;
+
+from tornado.ioloop import IOLoop;
+from tornado.iostream import IOStream;
+from tornado.websocket import WebSocketProtocol, WebSocketProtocol13;
+from tornado.testing import AsyncTestCase, AsyncHTTPTestCase, get_unused_port;
+
+from echo_tree import WordExplorer, WORD_TREE_BREADTH;
+from tree_worker_pool import TreeWorkerPool;
+from root_word_pusher import RootWordPusher;
+from tree_codec import decodeBinaryTree, BINARY_TREE_SUBPROTOCOL;
+from server_stats import PROMETHEUS_CONTENT_TYPE;
+from echo_tree_server import EchoTreeApplication, EchoTreeChannel, EchoTreeService, TreeBroadcast, TreeQueryHandler, RootWordSubmissionService, DatabaseSwapper, \
+                             DatabaseSwapHandler, ADMIN_SWAP_DATABASE_URI_PATH, ADMIN_TOKEN_HEADER, ECHO_TREE_SUBSCRIBE_PATH, DEFAULT_CHANNEL_ID, \
+                             NEW_TREE_SUBMISSION_URI_PATH, EchoTreeScriptRequestHandler, TREE_EVENT_LISTEN_SCRIPT_NAME, SCRIPT_RECHECK_INTERVAL, \
+                             SocketServerThreadStarter, EchoTreeStats, STATS_URI_PATH, PROMETHEUS_STATS_URI_PATH;
+from echo_tree_testing import EchoTreeTestCase, makeWordDatabase;
+
+class ServerTestCase(EchoTreeTestCase):
+    '''
+    Points the server's class level settings at the test database,
+    and restores them afterwards. List it before AsyncTestCase among
+    the base classes, so that the worker pool is stopped before the
+    IOLoop its result thread wakes is closed.
+    '''
+
+    def setUp(self):
+        super(ServerTestCase, self).setUp();
+        TreeComputer = RootWordSubmissionService.TreeComputer;
+        self.savedSettings = (RootWordSubmissionService.dbPath, RootWordSubmissionService.treeWorkerPool,
+                              RootWordSubmissionService.treeStore, RootWordSubmissionService.treeStorePath,
+                              TreeQueryHandler.dbVersion, TreeComputer.instance, TreeComputer.singletonRunning);
+        RootWordSubmissionService.dbPath = self.dbPath;
+        RootWordSubmissionService.treeStore = None;
+        RootWordSubmissionService.treeStorePath = None;
+        TreeQueryHandler.dbVersion = None;
+        TreeComputer.instance = None;
+        TreeComputer.singletonRunning = False;
+
+    def tearDown(self):
+        if RootWordSubmissionService.treeWorkerPool is not None:
+            RootWordSubmissionService.treeWorkerPool.stop();
+        TreeComputer = RootWordSubmissionService.TreeComputer;
+        (RootWordSubmissionService.dbPath, RootWordSubmissionService.treeWorkerPool,
+         RootWordSubmissionService.treeStore, RootWordSubmissionService.treeStorePath,
+         TreeQueryHandler.dbVersion, TreeComputer.instance, TreeComputer.singletonRunning) = self.savedSettings;
+        super(ServerTestCase, self).tearDown();
+
+class SubscriberTestCase(ServerTestCase, AsyncHTTPTestCase):
+    '''
+    Serves EchoTreeApplication with all its routes, and subscribes
+    browsers to its channels. Channels made by a test are removed afterwards.
+    '''
+
+    def setUp(self):
+        super(SubscriberTestCase, self).setUp();
+        self.savedChannels = dict(EchoTreeChannel.channels);
+        self.clients = [];
+
+    def tearDown(self):
+        for client in self.clients:
+            client.close();
+        with EchoTreeChannel.channelsLock:
+            EchoTreeChannel.channels.clear();
+            EchoTreeChannel.channels.update(self.savedChannels);
+        super(SubscriberTestCase, self).tearDown();
+
+    def get_app(self):
+        return EchoTreeApplication(allServices=True);
+
+    def runLoopUntil(self, condition, timeout=5):
+        deadline = time.time() + timeout;
+        while not condition() and time.time() < deadline:
+            self.io_loop.add_timeout(time.time() + 0.05, self.stop);
+            self.wait();
+        self.assertTrue(condition());
+
+    def subscribe(self, channelId=None, subprotocol=None, draft76=False):
+        '''
+        Subscribe a browser to the given channel, or to the default channel,
+        and read the tree it gets on subscribing.
+        @param subprotocol: websocket subprotocol the browser offers, if any.
+        @type subprotocol: {string | None}
+        @param draft76: if True, the browser speaks the draft 76 protocol rather than RFC 6455.
+        @type draft76: boolean
+        @return: the browser's stream, and the payload of that tree's message.
+        @rtype: (IOStream, string)
+        '''
+        path = ECHO_TREE_SUBSCRIBE_PATH if channelId is None else ECHO_TREE_SUBSCRIBE_PATH + '/' + channelId;
+        channel = EchoTreeChannel.getChannel(channelId if channelId is not None else DEFAULT_CHANNEL_ID);
+        numSubscribers = len(channel.subscribers);
+        client = IOStream(socket.socket(), io_loop=self.io_loop);
+        self.clients.append(client);
+        client.connect(('localhost', self.get_http_port()), self.stop);
+        self.wait();
+        headers = 'GET %s HTTP/1.1\r\nHost: localhost\r\nConnection: Upgrade\r\n' % path;
+        if subprotocol is not None:
+            headers += 'Sec-WebSocket-Protocol: %s\r\n' % subprotocol;
+        if draft76:
+            # The example handshake of the draft:
+            client.write(headers + 'Upgrade: WebSocket\r\nOrigin: http://localhost\r\n'
+                         'Sec-WebSocket-Key1: 4 @1  46546xW%0l 1 5\r\nSec-WebSocket-Key2: 12998 5 Y3 1  .P00\r\n\r\n^n:ds[4U');
+        else:
+            client.write(headers + 'Upgrade: websocket\r\nSec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\n'
+                         'Sec-WebSocket-Version: 13\r\n\r\n');
+        client.read_until('\r\n\r\n', self.stop);
+        self.assertTrue(self.wait().startswith('HTTP/1.1 101'));
+        if draft76:
+            client.read_bytes(16, self.stop);
+            self.assertEqual(self.wait(), "8jKS'y:G*Co,Wxa-");
+        self.runLoopUntil(lambda: len(channel.subscribers) == numSubscribers + 1);
+        return (client, self.readMessage(client, draft76)[1]);
+
+    def readMessage(self, client, draft76=False):
+        '''
+        Read one websocket message from the server, which sends each in one
+        frame, and does not mask its frames.
+        @param draft76: if True, read a draft 76 frame.
+        @type draft76: boolean
+        @return: the frame's first header byte, None for draft 76, and its payload.
+        @rtype: ({int | None}, string)
+        '''
+        if draft76:
+            client.read_until('\xff', self.stop);
+            frame = self.wait();
+            self.assertEqual(frame[0], '\x00');
+            return (None, frame[1:-1]);
+        client.read_bytes(2, self.stop);
+        (header, length) = struct.unpack('BB', self.wait());
+        if length == 126:
+            client.read_bytes(2, self.stop);
+            (length,) = struct.unpack('!H', self.wait());
+        elif length == 127:
+            client.read_bytes(8, self.stop);
+            (length,) = struct.unpack('!Q', self.wait());
+        client.read_bytes(length, self.stop);
+        return (header, self.wait());
+
+    def readTree(self, client, draft76=False):
+        (header, tree) = self.readMessage(client, draft76);
+        if not draft76:
+            # A single text frame:
+            self.assertEqual(header, 0x81);
+        return tree;
+
+class BroadcastTest(SubscriberTestCase):
+
+    def setUp(self):
+        super(BroadcastTest, self).setUp();
+        self.channel = EchoTreeChannel.getChannel('broadcastTest');
+        self.tree = WordExplorer(self.dbPath).makeWordTreeAndJSON('the')[1];
+
+    def get_new_ioloop(self):
+        # The loop that publishNewEchoTree() hands trees to:
+        return IOLoop.instance();
+
+    def test_tree_from_other_thread_reaches_all_subscribers(self):
+        numThreads = threading.active_count();
+        clients = [];
+        for i in range(3):
+            (client, currentTree) = self.subscribe(self.channel.channelId);
+            self.assertEqual(currentTree, '');
+            clients.append(client);
+        # No thread per subscriber:
+        self.assertEqual(threading.active_count(), numThreads);
+        publisher = threading.Thread(target=EchoTreeService.publishNewEchoTree, args=(self.channel, self.tree));
+        publisher.start();
+        publisher.join();
+        for client in clients:
+            self.assertEqual(self.readTree(client), self.tree);
+        self.assertEqual(self.channel.currentEchoTree, self.tree);
+        # Later subscribers get the current tree at once:
+        self.assertEqual(self.subscribe(self.channel.channelId)[1], self.tree);
+
+    def test_closed_subscribers_are_removed(self):
+        (closingClient, dummyTree) = self.subscribe(self.channel.channelId);
+        (client, dummyTree) = self.subscribe(self.channel.channelId);
+        closingHandler = [handler for handler in self.channel.subscribers if handler.stream.socket.getpeername() == closingClient.socket.getsockname()][0];
+        closingClient.close();
+        self.runLoopUntil(lambda: len(self.channel.subscribers) == 1);
+        self.assertFalse(closingHandler in self.channel.subscribers);
+        EchoTreeService.broadcastNewEchoTree(self.channel, self.tree);
+        self.assertEqual(self.readTree(client), self.tree);
+        self.assertFalse(closingHandler.sendTree(self.channel.currentTreeBroadcast));
+
+class EncodeOnceTest(SubscriberTestCase):
+
+    def setUp(self):
+        super(EncodeOnceTest, self).setUp();
+        self.channel = EchoTreeChannel.getChannel('encodeOnceTest');
+        (self.wordTree, self.tree) = WordExplorer(self.dbPath).makeWordTreeAndJSON('the');
+        # (protocol class name, binary) of each encoding of a message:
+        self.encodings = [];
+        self.savedEncoders = (WebSocketProtocol._encode_for_connection, WebSocketProtocol13._encode_for_connection);
+        for protocolClass in (WebSocketProtocol, WebSocketProtocol13):
+            protocolClass._encode_for_connection = self.makeCountingEncoder(protocolClass._encode_for_connection);
+
+    def tearDown(self):
+        (WebSocketProtocol._encode_for_connection, WebSocketProtocol13._encode_for_connection) = self.savedEncoders;
+        super(EncodeOnceTest, self).tearDown();
+
+    def makeCountingEncoder(self, encode):
+        def countingEncode(connection, message, binary=False):
+            self.encodings.append((connection.__class__.__name__, binary));
+            return encode(connection, message, binary);
+        return countingEncode;
+
+    def test_each_encoding_is_built_once(self):
+        clients = {};
+        for (kind, subprotocol, draft76) in (('json', None, False), ('binary', BINARY_TREE_SUBPROTOCOL, False), ('draft76', None, True)):
+            clients[kind] = [self.subscribe(self.channel.channelId, subprotocol, draft76)[0] for i in range(2)];
+        for wordTree in (self.wordTree, None):
+            self.encodings = [];
+            EchoTreeService.broadcastNewEchoTree(self.channel, self.tree, wordTree);
+            self.assertEqual(sorted(self.encodings), [('WebSocketProtocol13', False), ('WebSocketProtocol13', True), ('WebSocketProtocol76', False)]);
+            for client in clients['json']:
+                self.assertEqual(self.readTree(client), self.tree);
+            for client in clients['draft76']:
+                self.assertEqual(self.readTree(client, draft76=True), self.tree);
+            # Without the Python tree, the binary tree is made from the JSON:
+            for client in clients['binary']:
+                (header, binaryTree) = self.readMessage(client);
+                self.assertEqual(header, 0x82);
+                self.assertEqual(decodeBinaryTree(binaryTree), json.loads(self.tree));
+
+class ChannelTest(SubscriberTestCase):
+
+    def setUp(self):
+        super(ChannelTest, self).setUp();
+        self.pool = RootWordSubmissionService.treeWorkerPool = TreeWorkerPool(self.dbPath, numWorkers=1, ioLoop=self.io_loop);
+        self.explorer = WordExplorer(self.dbPath);
+
+    def submit(self, word, channelId=None):
+        path = NEW_TREE_SUBMISSION_URI_PATH if channelId is None else NEW_TREE_SUBMISSION_URI_PATH + '/' + channelId;
+        return self.fetch(path, method='POST', body=word).code;
+
+    def getTree(self, word):
+        return self.explorer.makeWordTreeAndJSON(word)[1];
+
+    def test_trees_reach_only_their_channel(self):
+        alphaClients = [self.subscribe('alpha')[0] for i in range(2)];
+        (betaClient, dummyTree) = self.subscribe('beta');
+        (defaultClient, dummyTree) = self.subscribe();
+        self.assertEqual(self.submit('cat', 'alpha'), 200);
+        for client in alphaClients:
+            self.assertEqual(self.readTree(client), self.getTree('cat'));
+        # Had the other channels been sent alpha's tree, it would arrive first:
+        self.submit('dog', 'beta');
+        self.assertEqual(self.readTree(betaClient), self.getTree('dog'));
+        self.submit('the');
+        self.assertEqual(self.readTree(defaultClient), self.getTree('the'));
+        currentTrees = dict((channelId, EchoTreeChannel.getChannel(channelId).currentEchoTree) for channelId in ('alpha', 'beta', DEFAULT_CHANNEL_ID));
+        self.assertEqual(currentTrees, {'alpha' : self.getTree('cat'), 'beta' : self.getTree('dog'), DEFAULT_CHANNEL_ID : self.getTree('the')});
+        self.assertEqual(self.subscribe('alpha')[1], self.getTree('cat'));
+
+    def test_channels_share_the_tree_cache(self):
+        (alphaClient, dummyTree) = self.subscribe('alpha');
+        (betaClient, dummyTree) = self.subscribe('beta');
+        self.submit('cat', 'alpha');
+        self.readTree(alphaClient);
+        numHits = self.pool.getStats()['treeCache']['hits'];
+        # A resubmission on the same channel is ignored, the same word on another channel is not:
+        self.submit('cat', 'alpha');
+        self.submit('cat', 'beta');
+        self.assertEqual(self.readTree(betaClient), self.getTree('cat'));
+        self.assertEqual(self.pool.getStats()['treeCache']['hits'], numHits + 1);
+        self.assertEqual(EchoTreeChannel.getChannel('alpha').latestSubmissionSeq, 1);
+
+    def test_invalid_channel_ids(self):
+        self.assertEqual(self.submit('cat', 'no%20spaces'), 404);
+        self.assertEqual(self.submit('cat', 'x' * 65), 404);
+        self.assertRaises(ValueError, EchoTreeChannel.getChannel, 'no spaces');
+        self.assertFalse('no spaces' in EchoTreeChannel.channels);
+
+class SingleLoopTest(SubscriberTestCase):
+    '''
+    Runs submissions, tree computation, and broadcasts on the test IOLoop, as with -e -w 0.
+    '''
+
+    def setUp(self):
+        super(SingleLoopTest, self).setUp();
+        TreeComputer = RootWordSubmissionService.TreeComputer;
+        self.savedLoopComputer = (TreeComputer.loopComputer, TreeComputer.computeScheduled);
+        self.treeComputer = TreeComputer();
+        self.treeComputer.runOnIOLoop(self.io_loop);
+        self.channel = EchoTreeChannel.getChannel('singleLoopTest');
+        # Threads that computed trees:
+        self.computeThreads = [];
+        makeWordTreeAndJSON = self.treeComputer.wordExplorer.makeWordTreeAndJSON;
+        def recordingMakeWordTreeAndJSON(*args, **kwargs):
+            self.computeThreads.append(threading.current_thread());
+            return makeWordTreeAndJSON(*args, **kwargs);
+        self.treeComputer.wordExplorer.makeWordTreeAndJSON = recordingMakeWordTreeAndJSON;
+        self.explorer = WordExplorer(self.dbPath);
+
+    def tearDown(self):
+        TreeComputer = RootWordSubmissionService.TreeComputer;
+        (TreeComputer.loopComputer, TreeComputer.computeScheduled) = self.savedLoopComputer;
+        TreeComputer.pendingChannels.clear();
+        self.treeComputer.wordExplorer.close();
+        super(SingleLoopTest, self).tearDown();
+
+    def getTree(self, word):
+        return self.explorer.makeWordTreeAndJSON(word)[1];
+
+    def test_submission_to_broadcast_on_one_thread(self):
+        numThreads = threading.active_count();
+        (client, dummyTree) = self.subscribe(self.channel.channelId);
+        response = self.fetch(NEW_TREE_SUBMISSION_URI_PATH + '/' + self.channel.channelId, method='POST', body='cat');
+        self.assertEqual(response.code, 200);
+        self.assertEqual(self.readTree(client), self.getTree('cat'));
+        self.assertEqual(self.computeThreads, [threading.current_thread()]);
+        self.assertEqual(threading.active_count(), numThreads);
+        self.assertFalse(self.treeComputer.is_alive());
+
+    def test_newest_word_wins(self):
+        (client, dummyTree) = self.subscribe(self.channel.channelId);
+        # Submitted before the loop runs again:
+        for word in ('the', 'cat', 'dog'):
+            RootWordSubmissionService.triggerTreeComputationAndDistrib(word, self.channel);
+        self.assertEqual(self.readTree(client), self.getTree('dog'));
+        RootWordSubmissionService.triggerTreeComputationAndDistrib('on', self.channel);
+        self.assertEqual(self.readTree(client), self.getTree('on'));
+        self.assertEqual(len(self.computeThreads), 2);
+
+    def test_legacy_submission_port(self):
+        port = get_unused_port();
+        SocketServerThreadStarter('RootWordSubmissionService', port).startOnIOLoop(self.io_loop);
+        (client, dummyTree) = self.subscribe(self.channel.channelId);
+        # The legacy port does not answer; the pusher only sends:
+        self.assertEqual(RootWordPusher('localhost', port, self.channel.channelId).pushEchoTreeToServer('cat'), None);
+        self.assertEqual(self.readTree(client), self.getTree('cat'));
+        self.assertEqual(self.computeThreads, [threading.current_thread()]);
+
+class StatsTest(SubscriberTestCase):
+
+    def setUp(self):
+        super(StatsTest, self).setUp();
+        RootWordSubmissionService.treeWorkerPool = TreeWorkerPool(self.dbPath, numWorkers=1, ioLoop=self.io_loop);
+        self.channel = EchoTreeChannel.getChannel('statsTest');
+
+    def fetchStats(self):
+        response = self.fetch(STATS_URI_PATH);
+        self.assertEqual(response.code, 200);
+        self.assertEqual(response.headers['Content-Type'], 'application/json');
+        self.assertEqual(response.headers['Cache-Control'], 'no-cache');
+        return json.loads(response.body);
+
+    def test_json(self):
+        clients = [self.subscribe(self.channel.channelId)[0] for i in range(2)];
+        before = self.fetchStats();
+        self.fetch(NEW_TREE_SUBMISSION_URI_PATH + '/' + self.channel.channelId, method='POST', body='cat');
+        for client in clients:
+            self.readTree(client);
+        stats = self.fetchStats();
+        counterChanges = dict((name, stats['counters'][name] - before['counters'][name]) 
+                              for name in ('submissions', 'treesComputed', 'broadcasts', 'treesSent'));
+        self.assertEqual(counterChanges, {'submissions' : 1, 'treesComputed' : 1, 'broadcasts' : 1, 'treesSent' : 2});
+        for histogramName in ('submissionLatencySeconds', 'treeComputeSeconds', 'broadcastFanOutSeconds'):
+            histogram = stats['histograms'][histogramName];
+            self.assertEqual(histogram['count'], before['histograms'][histogramName]['count'] + 1, histogramName);
+            self.assertEqual(histogram['buckets'][-1], ['+Inf', histogram['count']]);
+        gauges = stats['gauges'];
+        self.assertEqual(gauges['subscribers'][self.channel.channelId], 2);
+        self.assertEqual(gauges['writeBufferBytes'][self.channel.channelId], 0);
+        self.assertEqual(gauges['channels'], len(EchoTreeChannel.channels));
+        self.assertEqual(gauges['poolWorkers'], 1);
+        self.assertEqual(gauges['treeCacheMisses'], 1);
+
+    def test_prometheus(self):
+        self.subscribe(self.channel.channelId);
+        EchoTreeService.broadcastNewEchoTree(self.channel, '{}');
+        response = self.fetch(PROMETHEUS_STATS_URI_PATH);
+        self.assertEqual(response.headers['Content-Type'], PROMETHEUS_CONTENT_TYPE);
+        lines = response.body.split('\n');
+        numBroadcasts = EchoTreeStats.registry.counters['broadcasts'];
+        for line in ('# TYPE echotree_broadcasts_total counter',
+                     'echotree_broadcasts_total %d' % numBroadcasts,
+                     '# TYPE echotree_broadcast_fan_out_seconds histogram',
+                     'echotree_broadcast_fan_out_seconds_count %d' % EchoTreeStats.fanOutTime.count,
+                     'echotree_broadcast_fan_out_seconds_bucket{le="+Inf"} %d' % EchoTreeStats.fanOutTime.count,
+                     '# TYPE echotree_subscribers gauge',
+                     'echotree_subscribers{channel="statsTest"} 1',
+                     'echotree_pool_workers 1'):
+            self.assertTrue(line in lines, line);
+        # Every sample has a type:
+        types = set(line.split()[2] for line in lines if line.startswith('# TYPE '));
+        for line in lines:
+            if line and not line.startswith('#'):
+                metricName = line.split('{')[0].split()[0];
+                self.assertTrue(metricName in types or re.sub('_(bucket|sum|count)$', '', metricName) in types, line);
+        self.assertEqual(self.fetch(STATS_URI_PATH + '?format=prometheus').headers['Content-Type'], PROMETHEUS_CONTENT_TYPE);
+
+class ScriptServerTest(EchoTreeTestCase, AsyncHTTPTestCase):
+    '''
+    Serves browser scripts from a test directory via the script route of the single-loop application.
+    '''
+
+    def setUp(self):
+        super(ScriptServerTest, self).setUp();
+        self.scriptDir = os.path.join(self.tmpDir, 'browser_scripts');
+        os.mkdir(self.scriptDir);
+        self.writeScript(TREE_EVENT_LISTEN_SCRIPT_NAME, '<html>listener</html>\n' * 50);
+        self.writeScript('tree.js', 'var tree;\n');
+        self.writeScript('notes.txt', 'not served');
+        self.savedCachedFiles = dict(EchoTreeScriptRequestHandler.cachedFiles);
+        EchoTreeScriptRequestHandler.cachedFiles.clear();
+        EchoTreeScriptRequestHandler.preloadScripts(self.scriptDir);
+
+    def tearDown(self):
+        EchoTreeScriptRequestHandler.cachedFiles.clear();
+        EchoTreeScriptRequestHandler.cachedFiles.update(self.savedCachedFiles);
+        super(ScriptServerTest, self).tearDown();
+
+    def get_app(self):
+        return EchoTreeApplication(allServices=True);
+
+    def writeScript(self, fileName, content):
+        with open(os.path.join(self.scriptDir, fileName), 'w') as scriptFile:
+            scriptFile.write(content);
+
+    def readScript(self, fileName):
+        with open(os.path.join(self.scriptDir, fileName)) as scriptFile:
+            return scriptFile.read();
+
+    def fetchScript(self, path='/', method='GET', **headers):
+        return self.fetch(path, method=method, headers=headers, use_gzip=False);
+
+    def test_page_and_assets(self):
+        for (path, fileName, contentType) in (('/', TREE_EVENT_LISTEN_SCRIPT_NAME, 'text/html; charset=UTF-8'),
+                                              ('/tree.js', 'tree.js', 'application/javascript'),
+                                              # Unknown and unserved files get the page:
+                                              ('/other.js', TREE_EVENT_LISTEN_SCRIPT_NAME, 'text/html; charset=UTF-8'),
+                                              ('/notes.txt', TREE_EVENT_LISTEN_SCRIPT_NAME, 'text/html; charset=UTF-8')):
+            response = self.fetchScript(path);
+            self.assertEqual(response.code, 200);
+            self.assertEqual(response.body, self.readScript(fileName));
+            self.assertEqual(response.headers['Content-Type'], contentType);
+            self.assertEqual(response.headers['Content-Length'], str(len(response.body)));
+            self.assertEqual(response.headers['Cache-Control'], 'no-cache');
+            self.assertFalse('Content-Encoding' in response.headers);
+
+    def test_gzip(self):
+        plainResponse = self.fetchScript();
+        response = self.fetchScript(**{'Accept-Encoding' : 'deflate, gzip'});
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip');
+        self.assertEqual(response.headers['Vary'], 'Accept-Encoding');
+        self.assertTrue(len(response.body) < len(plainResponse.body));
+        self.assertEqual(gzip.GzipFile(fileobj=StringIO(response.body)).read(), plainResponse.body);
+        # The two encodings are different representations:
+        self.assertNotEqual(response.headers['Etag'], plainResponse.headers['Etag']);
+
+    def test_conditional_get(self):
+        response = self.fetchScript();
+        for (header, value) in (('If-None-Match', response.headers['Etag']),
+                                ('If-None-Match', '"other", ' + response.headers['Etag']),
+                                ('If-None-Match', '*'),
+                                ('If-Modified-Since', response.headers['Last-Modified'])):
+            notModified = self.fetchScript(**{header : value});
+            self.assertEqual(notModified.code, 304, header + ': ' + value);
+            self.assertEqual(notModified.body, '');
+            self.assertEqual(notModified.headers['Etag'], response.headers['Etag']);
+        modifiedTime = email.utils.mktime_tz(email.utils.parsedate_tz(response.headers['Last-Modified']));
+        self.assertEqual(self.fetchScript(**{'If-Modified-Since' : email.utils.formatdate(modifiedTime - 1, usegmt=True)}).code, 200);
+        # If-None-Match takes precedence:
+        self.assertEqual(self.fetchScript(**{'If-None-Match' : '"other"', 'If-Modified-Since' : response.headers['Last-Modified']}).code, 200);
+
+    def test_changed_file_is_reloaded(self):
+        etag = self.fetchScript('/tree.js').headers['Etag'];
+        self.writeScript('tree.js', 'var newTree;\n');
+        scriptPath = os.path.join(self.scriptDir, 'tree.js');
+        os.utime(scriptPath, (time.time(), os.path.getmtime(scriptPath) + 10));
+        # Not looked at again within SCRIPT_RECHECK_INTERVAL:
+        self.assertEqual(self.fetchScript('/tree.js', **{'If-None-Match' : etag}).code, 304);
+        EchoTreeScriptRequestHandler.cachedFiles['tree.js'].lastCheckTime -= SCRIPT_RECHECK_INTERVAL;
+        response = self.fetchScript('/tree.js', **{'If-None-Match' : etag});
+        self.assertEqual(response.code, 200);
+        self.assertEqual(response.body, 'var newTree;\n');
+        # A file that disappears is still served:
+        os.remove(scriptPath);
+        EchoTreeScriptRequestHandler.cachedFiles['tree.js'].lastCheckTime -= SCRIPT_RECHECK_INTERVAL;
+        self.assertEqual(self.fetchScript('/tree.js').body, 'var newTree;\n');
+
+    def test_head(self):
+        response = self.fetchScript(method='HEAD');
+        self.assertEqual(response.code, 200);
+        self.assertEqual(response.body, '');
+        self.assertEqual(response.headers['Content-Length'], str(len(self.readScript(TREE_EVENT_LISTEN_SCRIPT_NAME))));
+
+    def test_other_methods(self):
+        self.assertEqual(self.fetch('/', method='POST', body='').code, 405);
+
+class LegacyScriptServerTest(ScriptServerTest):
+    '''
+    The same tests, against the script server of the separate script port.
+    '''
+
+    def get_app(self):
+        return EchoTreeScriptRequestHandler.handle_request;
+
+class TreeQueryTest(ServerTestCase, AsyncHTTPTestCase):
+
+    def setUp(self):
+        super(TreeQueryTest, self).setUp();
+        # As with -w 0, once the TreeComputer thread opened the database:
+        self.treeComputer = RootWordSubmissionService.TreeComputer();
+        self.treeComputer.wordExplorer = self.treeComputer.makeWordExplorer();
+
+    def get_app(self):
+        return EchoTreeApplication();
+
+    def fetchTree(self, query='word=the', etag=None):
+        headers = {};
+        if etag is not None:
+            headers['If-None-Match'] = etag;
+        return self.fetch('/tree?' + query, headers=headers);
+
+    def test_tree_with_cache_headers(self):
+        response = self.fetchTree('word=the&depth=2&breadth=3');
+        self.assertEqual(response.code, 200);
+        self.assertEqual(response.headers['Content-Type'], 'application/json');
+        self.assertTrue(response.headers['Cache-Control'].startswith('public, max-age='));
+        expectedTree = WordExplorer(self.dbPath).makeWordTree('the', maxDepth=2, maxBranch=3);
+        self.assertEqual(self.getTreeShape(json.loads(response.body)), self.getTreeShape(expectedTree));
+
+    def test_matching_etag_gets_not_modified(self):
+        etag = self.fetchTree().headers['Etag'];
+        response = self.fetchTree(etag=etag);
+        self.assertEqual(response.code, 304);
+        self.assertEqual(response.body, '');
+        self.assertEqual(self.fetchTree(etag='*').code, 304);
+        self.assertEqual(self.fetchTree(etag='"other", ' + etag).code, 304);
+        self.assertEqual(self.fetchTree(etag='"other"').code, 200);
+
+    def test_etags_are_compared_whole(self):
+        etag = self.fetchTree().headers['Etag'];
+        self.assertEqual(self.fetchTree(etag='W/' + etag).code, 304);
+        self.assertEqual(self.fetchTree(etag='"other",W/%s ' % etag).code, 304);
+        # Tags that merely contain the ETag, or a quoted '*', do not match:
+        self.assertEqual(self.fetchTree(etag='x' + etag).code, 200);
+        self.assertEqual(self.fetchTree(etag='"x' + etag + '"').code, 200);
+        self.assertEqual(self.fetchTree(etag=etag[:-1] + 'x"').code, 200);
+        self.assertEqual(self.fetchTree(etag='"*"').code, 200);
+
+    def test_etag_depends_on_tree_parameters(self):
+        etags = set(self.fetchTree(query).headers['Etag'] for query in ('word=the', 'word=cat', 'word=the&depth=2', 'word=the&breadth=2'));
+        self.assertEqual(len(etags), 4);
+        self.assertEqual(self.fetchTree('word=the&depth=2').headers['Etag'], self.fetchTree('word=the&depth=2').headers['Etag']);
+
+    def test_etag_changes_with_database(self):
+        etag = self.fetchTree().headers['Etag'];
+        newDbPath = os.path.join(self.tmpDir, 'new.db');
+        makeWordDatabase(newDbPath, {'the' : [('cat', 2)]});
+        os.rename(newDbPath, self.dbPath);
+        # As DatabaseSwapper does when the swap is done:
+        TreeQueryHandler.dbVersion = None;
+        self.treeComputer.wordExplorer = WordExplorer(self.dbPath);
+        response = self.fetchTree(etag=etag);
+        self.assertEqual(response.code, 200);
+        self.assertNotEqual(response.headers['Etag'], etag);
+
+    def test_tree_from_tree_computer_explorer(self):
+        self.assertEqual(self.fetchTree('word=cat&depth=2').code, 200);
+        # Cached by the explorer that also computes the channels' trees:
+        self.assertTrue(('cat', 2, WORD_TREE_BREADTH) in self.treeComputer.wordExplorer.treeCache);
+        self.treeComputer.wordExplorer = None;
+        self.assertEqual(self.fetchTree('word=cat').code, 503);
+
+    def test_invalid_parameters(self):
+        self.assertEqual(self.fetchTree('word=the&depth=0').code, 400);
+        self.assertEqual(self.fetchTree('word=the&breadth=x').code, 400);
+        self.assertEqual(self.fetchTree('depth=2').code, 400);
+
+    def test_tree_from_worker_pool(self):
+        RootWordSubmissionService.treeWorkerPool = TreeWorkerPool(self.dbPath, numWorkers=1, ioLoop=self.io_loop);
+        response = self.fetchTree('word=cat');
+        self.assertEqual(response.code, 200);
+        self.assertEqual(response.body, WordExplorer(self.dbPath).makeWordTreeAndJSON('cat')[1]);
+        self.assertEqual(self.fetchTree('word=cat', etag=response.headers['Etag']).code, 304);
+
+class DatabaseSwapperTest(ServerTestCase, AsyncTestCase):
+
+    def setUp(self):
+        super(DatabaseSwapperTest, self).setUp();
+        self.pool = RootWordSubmissionService.treeWorkerPool = TreeWorkerPool(self.dbPath, numWorkers=1, ioLoop=self.io_loop);
+        # Makes 'the' a hot tree to warm up:
+        self.computeTree('the');
+
+    def stopWithArgs(self, *args):
+        self.stop(args);
+
+    def swap(self, dbPath):
+        swapper = DatabaseSwapper.startSwap(self.io_loop, dbPath, doneCallback=self.stopWithArgs);
+        self.assertTrue(swapper is not None);
+        (result, errorMsg) = self.wait(timeout=10);
+        # The IOLoop must not be closed while the thread may still wake it:
+        swapper.join();
+        self.assertTrue(DatabaseSwapper.current is None);
+        return (result, errorMsg);
+
+    def computeTree(self, word):
+        self.pool.computeTree(word, self.stopWithArgs);
+        return self.wait(timeout=10)[1];
+
+    def test_swap(self):
+        newDbPath = os.path.join(self.tmpDir, 'new.db');
+        makeWordDatabase(newDbPath, {'the' : [('new', 5)], 'cat' : [('mouse', 3)]});
+        (result, errorMsg) = self.swap(newDbPath);
+        self.assertEqual(errorMsg, None);
+        self.assertEqual((result['dbPath'], result['treesWarmedUp']), (newDbPath, 1));
+        self.assertEqual(RootWordSubmissionService.dbPath, newDbPath);
+        self.assertEqual(TreeQueryHandler.dbVersion, result['dbVersion']);
+        # The warmed up tree is served from the new cache, other trees are computed from the new database:
+        self.assertEqual(self.computeTree('the'), WordExplorer(newDbPath).makeWordTreeAndJSON('the')[1]);
+        self.assertEqual(self.pool.getStats()['treeCache']['hits'], 1);
+        self.assertEqual(self.computeTree('cat'), WordExplorer(newDbPath).makeWordTreeAndJSON('cat')[1]);
+
+    def test_swap_to_database_rebuilt_in_place(self):
+        # As make_database_from_emails.py would rebuild it, then SIGHUP:
+        self.assertTrue(self.computeTree('dog') is not None);
+        newDbPath = os.path.join(self.tmpDir, 'new.db');
+        makeWordDatabase(newDbPath, {'the' : [('new', 5)], 'dog' : [('bone', 3)]});
+        os.rename(newDbPath, self.dbPath);
+        (result, errorMsg) = self.swap(self.dbPath);
+        self.assertEqual(errorMsg, None);
+        self.assertEqual(TreeQueryHandler.dbVersion, result['dbVersion']);
+        # Neither a warmed up nor an uncached tree comes from the old database:
+        for word in ('the', 'dog', 'cat'):
+            self.assertEqual(self.computeTree(word), WordExplorer(self.dbPath).makeWordTreeAndJSON(word)[1]);
+
+    def test_missing_database(self):
+        (result, errorMsg) = self.swap(os.path.join(self.tmpDir, 'missing.db'));
+        self.assertEqual(result, None);
+        self.assertTrue('does not exist' in errorMsg);
+        self.assertEqual(RootWordSubmissionService.dbPath, self.dbPath);
+
+    def test_unreadable_database_keeps_old_one(self):
+        badDbPath = os.path.join(self.tmpDir, 'bad.db');
+        with open(badDbPath, 'w') as badDbFile:
+            badDbFile.write('not a database' * 100);
+        (result, errorMsg) = self.swap(badDbPath);
+        self.assertEqual(result, None);
+        self.assertTrue('Cannot compute trees' in errorMsg);
+        self.assertEqual((RootWordSubmissionService.dbPath, self.pool.dbPath, self.pool.generation), (self.dbPath, self.dbPath, 0));
+        self.assertEqual(self.computeTree('cat'), WordExplorer(self.dbPath).makeWordTreeAndJSON('cat')[1]);
+
+    def test_one_swap_at_a_time(self):
+        swapper = DatabaseSwapper.startSwap(self.io_loop, self.dbPath, doneCallback=self.stopWithArgs);
+        self.assertTrue(DatabaseSwapper.startSwap(self.io_loop, self.dbPath) is None);
+        (result, errorMsg) = self.wait(timeout=10);
+        swapper.join();
+        self.assertEqual(errorMsg, None);
+
+class SlowConsumerTest(SubscriberTestCase):
+
+    def setUp(self):
+        super(SlowConsumerTest, self).setUp();
+        self.savedTimeout = EchoTreeService.slowConsumerTimeout;
+        EchoTreeService.slowConsumerTimeout = 0.2;
+        self.channel = EchoTreeChannel.getChannel('slowConsumerTest');
+        self.client = None;
+
+    def tearDown(self):
+        if EchoTreeService.slowConsumerChecker is not None:
+            EchoTreeService.slowConsumerChecker.stop();
+            EchoTreeService.slowConsumerChecker = None;
+        if self.client is not None:
+            self.client.close();
+        EchoTreeService.slowConsumerTimeout = self.savedTimeout;
+        super(SlowConsumerTest, self).tearDown();
+
+    def subscribeStuckClient(self):
+        '''
+        Subscribe a browser that never reads, and return its handler.
+        '''
+        self.client = socket.socket();
+        # Lets the server's writes back up sooner:
+        self.client.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096);
+        self.client.connect(('127.0.0.1', self.get_http_port()));
+        self.client.sendall('GET %s/%s HTTP/1.1\r\nHost: localhost\r\nUpgrade: websocket\r\n'
+                            'Connection: Upgrade\r\nSec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\n'
+                            'Sec-WebSocket-Version: 13\r\n\r\n' % (ECHO_TREE_SUBSCRIBE_PATH, self.channel.channelId));
+        self.runLoopUntil(lambda: len(self.channel.subscribers) == 1);
+        return list(self.channel.subscribers)[0];
+
+    def test_stuck_browser_on_quiet_channel_is_dropped(self):
+        subscriber = self.subscribeStuckClient();
+        EchoTreeService.watchSlowConsumers(self.io_loop);
+        # Idle browsers are kept:
+        self.runLoopUntil(lambda: not subscriber.stream.writing());
+        time.sleep(EchoTreeService.slowConsumerTimeout * 2);
+        self.runLoopUntil(lambda: True, timeout=0.5);
+        self.assertTrue(subscriber in self.channel.subscribers);
+        # One tree too large for the socket buffers, and none after it:
+        self.assertTrue(subscriber.sendTree(TreeBroadcast(os.urandom(8 * 1024 * 1024).encode('hex'), None)));
+        self.assertTrue(subscriber.stream.writing());
+        self.runLoopUntil(lambda: subscriber not in self.channel.subscribers);
+        self.assertTrue(subscriber.stream.closed());
+
+class TreeComputerTest(ServerTestCase):
+
+    def setUp(self):
+        super(TreeComputerTest, self).setUp();
+        self.treeComputer = RootWordSubmissionService.TreeComputer();
+        self.oldExplorer = self.treeComputer.wordExplorer = self.treeComputer.makeWordExplorer();
+        self.newExplorer = WordExplorer(self.dbPath);
+        self.published = [];
+
+    def tearDown(self):
+        self.treeComputer.wordExplorer.close();
+        super(TreeComputerTest, self).tearDown();
+
+    def publish(self, channel, newJSONEchoTreeStr, newWordTree):
+        self.published.append((channel, newJSONEchoTreeStr));
+
+    def test_idle_explorer_closed_at_once(self):
+        self.treeComputer.useWordExplorer(self.newExplorer);
+        self.assertEqual(self.oldExplorer.db, None);
+        self.assertTrue(self.treeComputer.wordExplorer is self.newExplorer);
+
+    def test_busy_explorer_closed_after_its_tree(self):
+        makeWordTreeAndJSON = self.oldExplorer.makeWordTreeAndJSON;
+        def swapWhileComputing(*args, **kwargs):
+            self.treeComputer.useWordExplorer(self.newExplorer);
+            # Still serves the tree in progress:
+            self.assertTrue(self.oldExplorer.db is not None);
+            return makeWordTreeAndJSON(*args, **kwargs);
+        self.oldExplorer.makeWordTreeAndJSON = swapWhileComputing;
+        channel = EchoTreeChannel('test');
+        self.treeComputer.computeAndPublish('the', [channel], self.publish);
+        self.assertEqual(self.published, [(channel, makeWordTreeAndJSON('the')[1])]);
+        self.assertEqual(self.oldExplorer.db, None);
+        self.assertTrue(self.newExplorer.db is not None);
+
+class DatabaseSwapHandlerTest(ServerTestCase, AsyncHTTPTestCase):
+
+    def setUp(self):
+        super(DatabaseSwapHandlerTest, self).setUp();
+        self.savedAdminToken = DatabaseSwapHandler.adminToken;
+        DatabaseSwapHandler.adminToken = 'secret';
+        self.treeComputer = RootWordSubmissionService.TreeComputer();
+        self.treeComputer.wordExplorer = self.treeComputer.makeWordExplorer();
+
+    def tearDown(self):
+        DatabaseSwapHandler.adminToken = self.savedAdminToken;
+        self.treeComputer.wordExplorer.close();
+        super(DatabaseSwapHandlerTest, self).tearDown();
+
+    def get_app(self):
+        return EchoTreeApplication();
+
+    def postSwap(self, adminToken=None):
+        headers = {};
+        if adminToken is not None:
+            headers[ADMIN_TOKEN_HEADER] = adminToken;
+        return self.fetch(ADMIN_SWAP_DATABASE_URI_PATH, method='POST', body='', headers=headers);
+
+    def test_swap_needs_admin_token(self):
+        oldExplorer = self.treeComputer.wordExplorer;
+        self.assertEqual(self.postSwap().code, 403);
+        self.assertEqual(self.postSwap('secreT').code, 403);
+        self.assertTrue(self.treeComputer.wordExplorer is oldExplorer);
+        response = self.postSwap('secret');
+        self.assertEqual(response.code, 200);
+        self.assertEqual(json.loads(response.body)['dbPath'], self.dbPath);
+        self.assertFalse(self.treeComputer.wordExplorer is oldExplorer);
+        self.assertEqual(oldExplorer.db, None);
+
+    def test_swap_closed_without_admin_token(self):
+        DatabaseSwapHandler.adminToken = None;
+        self.assertEqual(self.postSwap('').code, 403);
+        self.assertEqual(self.postSwap('None').code, 403);
+
+if __name__ == '__main__':
+    unittest.main();
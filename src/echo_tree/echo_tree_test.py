@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+
+'''
+Tests of the bounded caches in echo_tree.py, of WordExplorer's use
+of its tree cache, of its level by level tree construction, and of
+the compact tree nodes and their JSON encoder.
+'''
+
+import json;
+import unittest;
+from collections import OrderedDict;
+
+import os;
+import sqlite3;
+
+import echo_tree;
+from echo_tree import LRUCache, FollowerCache, TreeCache, WordExplorer, WordDatabase, WordFollowerBatch, WordTreeNode, encodeWordTree, \
+                      getReadOnlyOpenMethod, \
+                      READ_ONLY_VIA_URI, READ_ONLY_VIA_SQLITE_URI, READ_ONLY_VIA_PRAGMA;
+from echo_tree_testing import EchoTreeTestCase, TEST_FOLLOWERS;
+
+class LRUCacheTest(unittest.TestCase):
+
+    def test_entry_budget_evicts_least_recently_used(self):
+        cache = LRUCache(maxEntries=2);
+        cache.store('a', 1, 10);
+        cache.store('b', 2, 10);
+        # Using 'a' makes 'b' the least recently used entry:
+        self.assertEqual(cache.lookup('a'), 1);
+        cache.store('c', 3, 10);
+        self.assertTrue('a' in cache);
+        self.assertFalse('b' in cache);
+        self.assertTrue('c' in cache);
+        self.assertEqual(cache.getKeys(), ['c', 'a']);
+        self.assertEqual(cache.getStats()['evictions'], 1);
+
+    def test_byte_budget(self):
+        cache = LRUCache(maxBytes=25);
+        cache.store('a', 1, 10);
+        cache.store('b', 2, 10);
+        cache.store('c', 3, 10);
+        self.assertEqual(cache.getKeys(), ['c', 'b']);
+        self.assertEqual(cache.getStats()['bytes'], 20);
+        # Replacing an entry releases its old size:
+        cache.store('b', 4, 5);
+        self.assertEqual(cache.getStats()['bytes'], 15);
+        self.assertEqual(cache.getKeys(), ['b', 'c']);
+
+    def test_newest_entry_is_kept(self):
+        cache = LRUCache(maxBytes=5);
+        cache.store('a', 1, 3);
+        cache.store('big', 2, 100);
+        self.assertEqual(cache.getKeys(), ['big']);
+        self.assertEqual(cache.getKeys(0), []);
+
+    def test_miss(self):
+        cache = LRUCache();
+        self.assertRaises(KeyError, cache.lookup, 'a');
+        self.assertEqual(cache.getStats()['misses'], 1);
+
+    def test_invalid_budget(self):
+        self.assertRaises(ValueError, LRUCache, 0);
+        self.assertRaises(ValueError, LRUCache, None, -1);
+
+class FollowerCacheTest(unittest.TestCase):
+
+    def test_truncated_entries(self):
+        cache = FollowerCache();
+        self.assertRaises(KeyError, cache.get, 'the', 2);
+        cache.put('the', ['cat', 'dog', 'end']);
+        # Only as many followers as the largest request so far are kept:
+        self.assertEqual(cache.get('the', 2), ['cat', 'dog']);
+        self.assertRaises(KeyError, cache.get, 'the', 3);
+        stats = cache.getStats();
+        self.assertEqual((stats['hits'], stats['misses']), (1, 2));
+
+    def test_complete_entries(self):
+        cache = FollowerCache(truncate=False);
+        self.assertRaises(KeyError, cache.get, 'the', 1);
+        cache.put('the', ['cat', 'dog']);
+        self.assertEqual(cache.get('the', 5), ['cat', 'dog']);
+        self.assertEqual(cache.get('the'), ['cat', 'dog']);
+        # Incomplete arrays cannot answer requests for more followers:
+        cache.put('on', ['the'], isComplete=False);
+        self.assertRaises(KeyError, cache.get, 'on', 2);
+
+class TreeCacheTest(EchoTreeTestCase):
+
+    def test_explorer_caches_trees(self):
+        treeCache = TreeCache(maxEntries=2);
+        explorer = WordExplorer(self.dbPath, treeCache=treeCache);
+        (wordTree, jsonTree) = explorer.makeWordTreeAndJSON('the', maxDepth=3, maxBranch=2);
+        self.assertEqual(self.getTreeShape(json.loads(jsonTree)), self.getTreeShape(wordTree));
+        self.assertEqual(explorer.makeWordTreeAndJSON('the', maxDepth=3, maxBranch=2), (wordTree, jsonTree));
+        # Other tree shapes are separate entries:
+        explorer.makeWordTreeAndJSON('the', maxDepth=2, maxBranch=2);
+        explorer.makeWordTreeAndJSON('cat', maxDepth=3, maxBranch=2);
+        self.assertEqual(treeCache.getKeys(), [('cat', 3, 2), ('the', 2, 2)]);
+        stats = treeCache.getStats();
+        self.assertEqual((stats['hits'], stats['misses'], stats['evictions']), (1, 3, 1));
+
+    def test_switching_database_clears_caches(self):
+        explorer = WordExplorer(self.dbPath);
+        explorer.makeWordTreeAndJSON('the');
+        explorer.useDatabase(self.dbPath);
+        self.assertEqual(len(explorer.treeCache), 0);
+        self.assertEqual(len(explorer.cache), 0);
+
+    def test_switching_database_closes_old_one(self):
+        explorer = WordExplorer(self.dbPath);
+        oldConn = explorer.db.conn;
+        explorer.useDatabase(self.dbPath);
+        self.assertRaises(sqlite3.ProgrammingError, oldConn.execute, 'SELECT 1;');
+        self.assertEqual(explorer.makeWordTree('the', maxDepth=1)['word'], 'the');
+        explorer.close();
+        self.assertEqual(explorer.db, None);
+
+class BreadthFirstTreeTest(EchoTreeTestCase):
+
+    def setUp(self):
+        super(BreadthFirstTreeTest, self).setUp();
+        # Words of each batched follower query:
+        self.batches = [];
+        self.savedEnter = savedEnter = WordFollowerBatch.__enter__;
+        def recordingEnter(batch):
+            self.batches.append(sorted(batch.words));
+            return savedEnter(batch);
+        WordFollowerBatch.__enter__ = recordingEnter;
+        self.savedMaxWords = echo_tree.MAX_WORDS_PER_BATCH_QUERY;
+
+    def tearDown(self):
+        WordFollowerBatch.__enter__ = self.savedEnter;
+        echo_tree.MAX_WORDS_PER_BATCH_QUERY = self.savedMaxWords;
+        super(BreadthFirstTreeTest, self).tearDown();
+
+    def test_same_trees_as_recursion(self):
+        explorers = [WordExplorer(self.dbPath, breadthFirst=False),
+                     WordExplorer(self.dbPath, compactTrees=True),
+                     WordExplorer(self.dbPath, compactTrees=False)];
+        for word in sorted(TEST_FOLLOWERS.keys()) + ['unknown']:
+            for (maxDepth, maxBranch) in ((1, 3), (2, 1), (3, 2), (5, 5)):
+                trees = [self.getTreeShape(explorer.makeWordTree(word, maxDepth=maxDepth, maxBranch=maxBranch))
+                         for explorer in explorers];
+                self.assertEqual(trees[1], trees[0]);
+                self.assertEqual(trees[2], trees[0]);
+
+    def test_one_query_per_level(self):
+        explorer = WordExplorer(self.dbPath);
+        explorer.makeWordTree('the', maxDepth=4, maxBranch=2);
+        # The bottom level's followers are not looked up:
+        self.assertEqual(self.batches, [['the'], ['cat', 'dog'], ['barked', 'ran', 'sat']]);
+        # Followers come from the cache the next time:
+        explorer.makeWordTree('the', maxDepth=4, maxBranch=2);
+        self.assertEqual(len(self.batches), 3);
+
+    def test_large_levels_are_split(self):
+        expectedTree = self.getTreeShape(WordExplorer(self.dbPath).makeWordTree('the', maxDepth=3, maxBranch=2));
+        self.batches = [];
+        echo_tree.MAX_WORDS_PER_BATCH_QUERY = 1;
+        self.assertEqual(self.getTreeShape(WordExplorer(self.dbPath).makeWordTree('the', maxDepth=3, maxBranch=2)), expectedTree);
+        self.assertEqual(self.batches, [['the'], ['cat'], ['dog']]);
+
+    def test_cancellation_between_levels(self):
+        levels = [];
+        def isCancelled():
+            levels.append(len(self.batches));
+            return len(self.batches) == 2;
+        explorer = WordExplorer(self.dbPath);
+        self.assertRaises(echo_tree.TreeComputationCancelled, explorer.makeWordTree, 'the', maxDepth=4, isCancelled=isCancelled);
+        self.assertEqual(levels, [0, 1, 2]);
+
+class WordTreeNodeTest(EchoTreeTestCase):
+
+    def makeNode(self, word, followers=()):
+        node = WordTreeNode(word);
+        node.followWordObjs.extend(followers);
+        return node;
+
+    def test_encoding_matches_json_dumps(self):
+        # Quotes, backslashes, control and non-ASCII characters, and NULL words:
+        tree = self.makeNode(u'caf\xe9', [self.makeNode('say"', [self.makeNode('back\\slash'), self.makeNode(None)]),
+                                          self.makeNode('new\nline'),
+                                          self.makeNode(u'\u2603')]);
+        self.assertEqual(encodeWordTree(tree), json.dumps(tree.toDict()));
+        self.assertEqual(json.loads(encodeWordTree(tree)), json.loads(json.dumps(tree.toDict())));
+        self.assertEqual(encodeWordTree(self.makeNode('the')), '{"word": "the", "followWordObjs": []}');
+
+    def test_node_reads_like_dict(self):
+        node = self.makeNode('the', [self.makeNode('cat')]);
+        self.assertEqual(node['word'], 'the');
+        self.assertEqual(node['followWordObjs'][0]['word'], 'cat');
+        self.assertRaises(KeyError, node.__getitem__, 'count');
+        self.assertEqual(node.toDict(), OrderedDict([('word', 'the'),
+                                                     ('followWordObjs', [OrderedDict([('word', 'cat'), ('followWordObjs', [])])])]));
+
+    def test_compact_and_dict_trees_encode_alike(self):
+        compactExplorer = WordExplorer(self.dbPath, compactTrees=True);
+        dictExplorer = WordExplorer(self.dbPath, compactTrees=False);
+        for word in TEST_FOLLOWERS.keys() + ['unknown']:
+            for (maxDepth, maxBranch) in ((1, 2), (3, 2), (4, 3)):
+                (compactTree, compactJSON) = compactExplorer.makeWordTreeAndJSON(word, maxDepth=maxDepth, maxBranch=maxBranch);
+                (dictTree, dictJSON) = dictExplorer.makeWordTreeAndJSON(word, maxDepth=maxDepth, maxBranch=maxBranch);
+                self.assertTrue(isinstance(compactTree, WordTreeNode));
+                self.assertTrue(isinstance(dictTree, OrderedDict));
+                self.assertEqual(compactJSON, dictJSON);
+                self.assertEqual(compactJSON, json.dumps(dictTree));
+        # The tree cache can size both kinds of trees:
+        self.assertTrue(compactExplorer.treeCache.getStats()['bytes'] > 0);
+        self.assertTrue(dictExplorer.treeCache.getStats()['bytes'] > 0);
+        compactExplorer.close();
+        dictExplorer.close();
+
+class WordDatabaseTest(EchoTreeTestCase):
+
+    def tearDown(self):
+        echo_tree.readOnlyOpenMethod = None;
+        super(WordDatabaseTest, self).tearDown();
+
+    def assertReadOnly(self, db):
+        self.assertRaises(sqlite3.DatabaseError, db.conn.execute, 'CREATE TABLE Other (a int);');
+        self.assertEqual(db.conn.execute('SELECT count(*) FROM EnronWords WHERE word=?;', ('the',)).fetchone()[0], 5);
+
+    def test_connections_are_read_only(self):
+        self.assertTrue(getReadOnlyOpenMethod() in (READ_ONLY_VIA_URI, READ_ONLY_VIA_SQLITE_URI, READ_ONLY_VIA_PRAGMA));
+        db = WordDatabase(self.dbPath);
+        self.assertEqual(db.readOnlyMethod, getReadOnlyOpenMethod());
+        self.assertReadOnly(db);
+        db.close();
+
+    def test_each_method_opens_the_database_file(self):
+        cwdFiles = set(os.listdir('.'));
+        for method in (getReadOnlyOpenMethod(), READ_ONLY_VIA_PRAGMA):
+            echo_tree.readOnlyOpenMethod = method;
+            db = WordDatabase(self.dbPath);
+            self.assertReadOnly(db);
+            self.assertEqual(db.conn.execute('PRAGMA database_list;').fetchone()[2], os.path.realpath(self.dbPath));
+            db.close();
+        # URIs were not taken for file names:
+        self.assertEqual(set(os.listdir('.')), cwdFiles);
+
+if __name__ == '__main__':
+    unittest.main();
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+
+'''
+Support for the EchoTree unit tests, which live next to the modules
+they test in files named <module>_test.py. Run a test module directly,
+e.g. python follower_graph_test.py. The vendored tornado package has
+its own tests in tornado/test.
+'''
+
+import os;
+import shutil;
+import sqlite3;
+import tempfile;
+import unittest;
+
+# Word --> [(follower, followingCount)] of a small word database. Counts
+# are distinct among the followers of a word, so that every backend
+# orders followers the same way. Includes a word with a double quote:
+TEST_FOLLOWERS = {
+    'the'   : [('cat', 9), ('dog', 7), ('end', 3), ('say"', 2)],
+    'cat'   : [('sat', 8), ('ran', 5), ('the', 1)],
+    'dog'   : [('ran', 6), ('barked', 4)],
+    'sat'   : [('on', 5)],
+    'on'    : [('the', 9), ('a', 2)],
+    'ran'   : [('away', 3), ('home', 2)],
+    'say"'  : [('hello', 4)],
+    'a'     : [('cat', 2)],
+    }
+
+def makeWordDatabase(dbPath, followers=TEST_FOLLOWERS):
+    '''
+    Create an SQLite word database with an EnronWords table as made by
+    make_database_from_emails.py. Like there, each word has one row with
+    a NULL follower, which carries the word's metadata.
+    @param dbPath: file to create.
+    @type dbPath: string
+    @param followers: word --> [(follower, followingCount)]
+    @type followers: {string : [(string, int)]}
+    '''
+    conn = sqlite3.connect(dbPath);
+    try:
+        conn.execute('CREATE TABLE EnronWords (word text, follower text, followingCount int, ' +
+                     'metaTotalOcc int, metaNumSuccessors int, metaWordLen int);');
+        for (word, wordFollowers) in sorted(followers.items()):
+            conn.execute('INSERT INTO EnronWords VALUES (?,NULL,NULL,?,?,?);',
+                         (word, sum(count for (dummyFollower, count) in wordFollowers), len(wordFollowers), len(word)));
+            for (follower, count) in wordFollowers:
+                conn.execute('INSERT INTO EnronWords VALUES (?,?,?,NULL,NULL,NULL);', (word, follower, str(count)));
+        conn.execute('CREATE INDEX wordFollCountIndx ON EnronWords (word, followingCount);');
+        conn.commit();
+    finally:
+        conn.close();
+
+# ------------------------------- class Echo Tree Test Case ---------------------
+class EchoTreeTestCase(unittest.TestCase):
+    '''
+    Test case with a temporary directory, self.tmpDir, that holds the
+    word database self.dbPath built from TEST_FOLLOWERS.
+    '''
+
+    def setUp(self):
+        super(EchoTreeTestCase, self).setUp();
+        self.tmpDir = tempfile.mkdtemp(prefix='echo_tree_test');
+        self.dbPath = os.path.join(self.tmpDir, 'words.db');
+        makeWordDatabase(self.dbPath);
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir, ignore_errors=True);
+        super(EchoTreeTestCase, self).tearDown();
+
+    def getTreeShape(self, tree):
+        '''
+        Return the tree as nested (word, [children]) tuples, whether it is made of
+        WordTreeNodes, OrderedDicts, or the dicts json.loads() returns.
+        '''
+        return (tree['word'], [self.getTreeShape(child) for child in tree['followWordObjs']]);
@@ -182,6 +182,25 @@ class Evaluator(object):
         flatSet = set(flatList[1:]);
         return (rootWord, flatSet);
     
+    def extractWordSetFromTree(self, pythonEchoTree):
+        '''
+        Like extractWordSet(), but works directly on a Python EchoTree
+        as returned by WordExplorer, without JSON decoding. Only the
+        flat set of follow-on words is returned, which is what
+        tallyWordCapture() needs.
+        @param pythonEchoTree: Python EchoTree, made of dicts or WordTreeNode instances.
+        @type pythonEchoTree: {dict | WordTreeNode}
+        @return: set of all words in the tree, except for the root word.
+        @rtype: set
+        '''
+        flatSet = set();
+        subtrees = list(pythonEchoTree['followWordObjs']);
+        while len(subtrees) > 0:
+            subtree = subtrees.pop();
+            flatSet.add(subtree['word']);
+            subtrees.extend(subtree['followWordObjs']);
+        return flatSet;
+    
     def getDepthFromWord(self, pythonEchoTree, word):
         '''
         Given a word, return its depth in the tree. Root postion is 0.
@@ -365,8 +384,8 @@ class Evaluator(object):
         sentencePerf = SentencePerformance(self, sentenceTokens, emailID=emailID, sentenceID=sentenceID);
         
         # Start for real:
-        tree = self.wordExplorer.makeWordTree(sentenceTokens[0]);
-        treeWords = self.extractWordSet(self.wordExplorer.makeJSONTree(tree));
+        (tree, dummyJsonTree) = self.wordExplorer.makeWordTreeAndJSON(sentenceTokens[0]);
+        treeWords = self.extractWordSetFromTree(tree);
         for wordPos, word in enumerate(sentenceTokens[1:]):
             word = word.lower();
             wordDepth = self.getDepthFromWord(tree, word);
@@ -379,8 +398,8 @@ class Evaluator(object):
                         if futureWord in treeWords:
                             sentencePerf.addOutOfSeq();
                 # Build a new tree by (virtually) typing in the word
-                tree =  self.wordExplorer.makeWordTree(word);
-                treeWords = self.extractWordSet(self.wordExplorer.makeJSONTree(tree));
+                (tree, dummyJsonTree) = self.wordExplorer.makeWordTreeAndJSON(word);
+                treeWords = self.extractWordSetFromTree(tree);
                 continue;
             # Found word in tree:
             sentencePerf.addWordDepth(wordDepth);
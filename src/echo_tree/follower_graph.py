@@ -0,0 +1,488 @@
+#!/usr/bin/env python
+
+'''
+In-memory word co-occurrence graph. Holds the information of the
+EnronWords table in a few flat arrays, so that follower lookups
+are pure array indexing, without database access. WordExplorer
+instances may be given a FollowerGraph instead of an SQLite file.
+
+Layout (compressed sparse rows):
+   - vocab:     word ID --> word. IDs are indexes into this list.
+   - offsets:   for word ID i, the followers of the word are
+                followers[offsets[i]:offsets[i+1]]
+   - followers: follower word IDs, grouped by word, and within each
+                group ordered by decreasing followingCount.
+   - counts:    followingCount of each entry in followers.
+
+A graph can be saved in a binary graph file (see writeGraphFile()). 
+MappedFollowerGraph serves lookups directly from such a file via
+mmap. The file is not read into process memory, so startup is
+instant, and all processes on a host that open the same file share
+one copy of it in the OS page cache.
+
+Graph file layout. All numbers little-endian, sections 8-byte aligned:
+   - header:       GRAPH_FILE_HEADER_SIZE bytes; see GRAPH_FILE_HEADER_STRUCT.
+                   Magic, version, numWords, numEntries, start of each section,
+                   CRC32 of all bytes after the header, and finally a 
+                   CRC32 of the preceding header bytes.
+   - vocab index:  numWords+1 uint32; word i is vocabData[index[i]:index[i+1]]
+   - vocab data:   UTF-8 encoded words, concatenated, in byte order. A word's
+                   ID is its position in this order.
+   - offsets:      numWords+1 int32, as in the in-memory layout.
+   - followers:    numEntries int32. GRAPH_FILE_NULL_WORD_ID for followers
+                   that are NULL in the database.
+   - counts:       numEntries int32.
+'''
+
+import os;
+import sys;
+import mmap;
+import zlib;
+import struct;
+import sqlite3;
+from array import array;
+
+# Typecode of the arrays holding word IDs, offsets, and counts.
+# A C int, i.e. 4 bytes on all the platforms we run on:
+GRAPH_ARRAY_TYPECODE = 'i';
+
+GRAPH_FILE_MAGIC   = 'ECHOGRPH';
+GRAPH_FILE_VERSION = 1;
+# magic, version, numWords, numEntries, vocabIndexPos, vocabDataPos,
+# vocabDataLen, offsetsPos, followersPos, countsPos, payloadCRC:
+GRAPH_FILE_HEADER_STRUCT = struct.Struct('<8sIII6QI');
+GRAPH_FILE_HEADER_CRC_STRUCT = struct.Struct('<I');
+GRAPH_FILE_HEADER_SIZE = 80;
+GRAPH_FILE_NULL_WORD_ID = -1;
+# Bytes per read when computing the payload checksum:
+GRAPH_FILE_CRC_CHUNK_SIZE = 16 * 1024 * 1024;
+
+# ------------------------------- class Follower Graph ---------------------
+class FollowerGraph(object):
+    '''
+    Read-only follower graph. Provides the follower lookup methods
+    that WordExplorer otherwise implements on top of WordDatabase.
+    Create instances from an EchoTree SQLite database via fromSQLite().
+    '''
+
+    def __init__(self, vocab, offsets, followers, counts):
+        '''
+        Create a graph from already built arrays. See module
+        comment for the layout.
+        @param vocab: word for each word ID.
+        @type vocab: [string]
+        @param offsets: start of each word's followers in the followers array; len(vocab)+1 entries.
+        @type offsets: array.array
+        @param followers: follower word IDs, in decreasing frequency order for each word.
+        @type followers: array.array
+        @param counts: followingCount for each entry of followers.
+        @type counts: array.array
+        '''
+        if len(offsets) != len(vocab) + 1:
+            raise ValueError("Offsets array must have one more entry than the vocabulary (%d), but has %d." % (len(vocab), len(offsets)));
+        if len(followers) != len(counts):
+            raise ValueError("Followers and counts arrays must be of equal length (%d vs. %d)." % (len(followers), len(counts)));
+        self.vocab     = vocab;
+        self.offsets   = offsets;
+        self.followers = followers;
+        self.counts    = counts;
+        self.wordIDs   = dict((word, wordID) for (wordID, word) in enumerate(vocab));
+
+    @staticmethod
+    def fromSQLite(SQLiteDbPath, logFD=None):
+        '''
+        Build a graph from the EnronWords table of an SQLite database.
+        Follower order, including the order among followers with equal
+        counts, is the same as when WordFollower reads the table.
+        @param SQLiteDbPath: SQLite database file with an EnronWords table.
+        @type SQLiteDbPath: string
+        @param logFD: file for progress reports. None for no reports.
+        @type logFD: file
+        @return: the new graph
+        @rtype: FollowerGraph
+        '''
+        try:
+            conn = sqlite3.connect(SQLiteDbPath);
+        except Exception as e:
+            raise IOError(`e` + ": %s" % SQLiteDbPath);
+        try:
+            cursor = conn.cursor();
+            # Words that have followers get the low IDs, in the
+            # same order in which the follower scan below visits
+            # them. That way the scan fills the CSR arrays in order:
+            cursor.execute('SELECT DISTINCT word from EnronWords ORDER BY word;');
+            vocab = [row[0] for row in cursor];
+            wordIDs = dict((word, wordID) for (wordID, word) in enumerate(vocab));
+            numWordsWithFollowers = len(vocab);
+            if logFD is not None:
+                logFD.write("Loading followers of %d words...\n" % numWordsWithFollowers);
+
+            offsets   = array(GRAPH_ARRAY_TYPECODE, [0]);
+            followers = array(GRAPH_ARRAY_TYPECODE);
+            counts    = array(GRAPH_ARRAY_TYPECODE);
+            # The *1 sorts numerically, as in WordFollower:
+            cursor.execute('SELECT word,follower,followingCount*1 from EnronWords ORDER BY word, followingCount*1 desc;');
+            currWordID = 0;
+            for (word, follower, followingCount) in cursor:
+                wordID = wordIDs[word];
+                while currWordID < wordID:
+                    offsets.append(len(followers));
+                    currWordID += 1;
+                try:
+                    followerID = wordIDs[follower];
+                except KeyError:
+                    # Word that never occurs as a root:
+                    followerID = len(vocab);
+                    vocab.append(follower);
+                    wordIDs[follower] = followerID;
+                followers.append(followerID);
+                counts.append(int(followingCount or 0));
+            cursor.close();
+            while currWordID < numWordsWithFollowers:
+                offsets.append(len(followers));
+                currWordID += 1;
+            # Words that only occur as followers have no followers themselves:
+            for dummy in range(len(vocab) - numWordsWithFollowers):
+                offsets.append(len(followers));
+        finally:
+            conn.close();
+        if logFD is not None:
+            logFD.write("Loaded %d words, %d follower entries.\n" % (len(vocab), len(followers)));
+        return FollowerGraph(vocab, offsets, followers, counts);
+
+    def getNumWords(self):
+        return len(self.vocab);
+
+    def getNumFollowerEntries(self):
+        return len(self.followers);
+
+    def getFollowerIDRange(self, word):
+        '''
+        Return start and end index into the followers and counts arrays
+        for the given word. Start equals end for unknown words.
+        @param word: root word
+        @type word: string
+        @rtype: (int, int)
+        '''
+        try:
+            wordID = self.wordIDs[word];
+        except KeyError:
+            return (0, 0);
+        return (self.offsets[wordID], self.offsets[wordID + 1]);
+
+    def getSortedFollowers(self, word, maxFollowers=None):
+        '''
+        Return an array of follow-words for the given root word,
+        sorted by decreasing frequency. Same semantics as
+        WordExplorer.getSortedFollowers().
+        @param word: root word.
+        @type word: string
+        @param maxFollowers: max number of followers to return. None for all followers.
+        @type maxFollowers: {int | None}
+        @rtype: [string]
+        '''
+        (start, end) = self.getFollowerIDRange(word);
+        if maxFollowers is not None:
+            end = min(end, start + maxFollowers);
+        vocab = self.vocab;
+        return [vocab[followerID] for followerID in self.followers[start:end]];
+
+    def getSortedFollowersBatch(self, words, maxFollowers=None):
+        '''
+        Return a dict mapping each of the given words to its array
+        of follow-words. Same semantics as WordExplorer.getSortedFollowersBatch().
+        @param words: root words. Duplicates are allowed.
+        @type words: [string]
+        @param maxFollowers: max number of followers to return per word. None for all followers.
+        @type maxFollowers: {int | None}
+        @rtype: {string : [string]}
+        '''
+        followersByWord = {};
+        for word in words:
+            if word not in followersByWord:
+                followersByWord[word] = self.getSortedFollowers(word, maxFollowers);
+        return followersByWord;
+
+    def getFollowerCounts(self, word, maxFollowers=None):
+        '''
+        Return the followingCount values that correspond to the
+        result of getSortedFollowers() for the same arguments.
+        @param word: root word.
+        @type word: string
+        @param maxFollowers: max number of counts to return. None for all.
+        @type maxFollowers: {int | None}
+        @rtype: [int]
+        '''
+        (start, end) = self.getFollowerIDRange(word);
+        if maxFollowers is not None:
+            end = min(end, start + maxFollowers);
+        return self.counts[start:end].tolist();
+
+    def writeGraphFile(self, graphFilePath):
+        '''
+        Save this graph in the binary graph file format described
+        in the module comment. The file is written under a temporary
+        name, and then renamed, so readers never see a partial file.
+        @param graphFilePath: path of the graph file to create or replace.
+        @type graphFilePath: string
+        '''
+        # Words in the file are ordered by their UTF-8 bytes, so
+        # that readers can find them by binary search. Map the 
+        # in-memory word IDs to the file's word IDs:
+        encodedVocab = {};
+        for (wordID, word) in enumerate(self.vocab):
+            if word is None:
+                continue;
+            encodedVocab[wordID] = word.encode('utf-8') if isinstance(word, unicode) else word;
+        fileOrder = sorted(encodedVocab.keys(), key=lambda wordID: encodedVocab[wordID]);
+        fileWordIDs = array(GRAPH_ARRAY_TYPECODE, [GRAPH_FILE_NULL_WORD_ID]) * len(self.vocab);
+        for (fileWordID, wordID) in enumerate(fileOrder):
+            fileWordIDs[wordID] = fileWordID;
+        
+        vocabIndex = array('I', [0]);
+        vocabData  = [];
+        offsets    = array(GRAPH_ARRAY_TYPECODE, [0]);
+        followers  = array(GRAPH_ARRAY_TYPECODE);
+        counts     = array(GRAPH_ARRAY_TYPECODE);
+        for wordID in fileOrder:
+            vocabData.append(encodedVocab[wordID]);
+            vocabIndex.append(vocabIndex[-1] + len(encodedVocab[wordID]));
+            (start, end) = (self.offsets[wordID], self.offsets[wordID + 1]);
+            followers.extend(fileWordIDs[followerID] for followerID in self.followers[start:end]);
+            counts.extend(self.counts[start:end]);
+            offsets.append(len(followers));
+        vocabData = ''.join(vocabData);
+        
+        if sys.byteorder != 'little':
+            for arr in (vocabIndex, offsets, followers, counts):
+                arr.byteswap();
+        # Sections in file order:
+        sections = [vocabIndex.tostring(), vocabData, offsets.tostring(), followers.tostring(), counts.tostring()];
+        sectionPositions = [];
+        pos = GRAPH_FILE_HEADER_SIZE;
+        payload = [];
+        for section in sections:
+            padding = -pos % 8;
+            payload.append('\0' * padding);
+            pos += padding;
+            sectionPositions.append(pos);
+            payload.append(section);
+            pos += len(section);
+        payloadCRC = 0;
+        for chunk in payload:
+            payloadCRC = zlib.crc32(chunk, payloadCRC);
+        
+        (vocabIndexPos, vocabDataPos, offsetsPos, followersPos, countsPos) = sectionPositions;
+        header = GRAPH_FILE_HEADER_STRUCT.pack(GRAPH_FILE_MAGIC, GRAPH_FILE_VERSION, 
+                                               len(fileOrder), len(followers),
+                                               vocabIndexPos, vocabDataPos, len(vocabData), 
+                                               offsetsPos, followersPos, countsPos, 
+                                               payloadCRC & 0xffffffff);
+        header += GRAPH_FILE_HEADER_CRC_STRUCT.pack(zlib.crc32(header) & 0xffffffff);
+        header += '\0' * (GRAPH_FILE_HEADER_SIZE - len(header));
+        
+        tmpPath = graphFilePath + '.tmp';
+        with open(tmpPath, 'wb') as fd:
+            fd.write(header);
+            for chunk in payload:
+                fd.write(chunk);
+        os.rename(tmpPath, graphFilePath);
+
+# ------------------------------- class Mapped Follower Graph ---------------------
+class MappedFollowerGraph(object):
+    '''
+    Read-only follower graph served from a memory mapped graph file,
+    as created by FollowerGraph.writeGraphFile(). Provides the same 
+    lookup methods as FollowerGraph. Only the header is read at startup;
+    words and followers are decoded from the mapped file as they are
+    looked up. Words are found by binary search over the vocabulary.
+    '''
+
+    def __init__(self, graphFilePath, verifyPayload=False):
+        '''
+        Map the given graph file, and check its header.
+        @param graphFilePath: path to a graph file.
+        @type graphFilePath: string
+        @param verifyPayload: if True, also check the checksum over the
+                              whole file. This reads the entire file.
+        @type verifyPayload: boolean
+        @raise IOError: if the file cannot be opened or mapped.
+        @raise ValueError: if the file is not a graph file of the supported 
+                           version, or is corrupted.
+        '''
+        self.graphFilePath = graphFilePath;
+        try:
+            self.fd = open(graphFilePath, 'rb');
+            self.mm = mmap.mmap(self.fd.fileno(), 0, access=mmap.ACCESS_READ);
+        except (IOError, EnvironmentError, ValueError) as e:
+            raise IOError(`e` + ": %s" % graphFilePath);
+        try:
+            self.readHeader(verifyPayload);
+        except ValueError:
+            self.close();
+            raise;
+
+    def readHeader(self, verifyPayload):
+        fileSize = len(self.mm);
+        if fileSize < GRAPH_FILE_HEADER_SIZE or self.mm[0:len(GRAPH_FILE_MAGIC)] != GRAPH_FILE_MAGIC:
+            raise ValueError("File %s is not an EchoTree graph file." % self.graphFilePath);
+        headerFields = GRAPH_FILE_HEADER_STRUCT.unpack_from(self.mm, 0);
+        (headerCRC,) = GRAPH_FILE_HEADER_CRC_STRUCT.unpack_from(self.mm, GRAPH_FILE_HEADER_STRUCT.size);
+        if zlib.crc32(self.mm[0:GRAPH_FILE_HEADER_STRUCT.size]) & 0xffffffff != headerCRC:
+            raise ValueError("Header checksum mismatch in graph file %s." % self.graphFilePath);
+        (dummyMagic, version, self.numWords, self.numEntries, 
+         self.vocabIndexPos, self.vocabDataPos, vocabDataLen, 
+         self.offsetsPos, self.followersPos, self.countsPos, payloadCRC) = headerFields;
+        if version != GRAPH_FILE_VERSION:
+            raise ValueError("Graph file %s has version %d; only version %d is supported." % (self.graphFilePath, version, GRAPH_FILE_VERSION));
+        if self.vocabIndexPos + 4 * (self.numWords + 1) > fileSize or \
+           self.vocabDataPos + vocabDataLen > fileSize or \
+           self.offsetsPos + 4 * (self.numWords + 1) > fileSize or \
+           self.followersPos + 4 * self.numEntries > fileSize or \
+           self.countsPos + 4 * self.numEntries > fileSize:
+            raise ValueError("Graph file %s is truncated." % self.graphFilePath);
+        if verifyPayload:
+            crc = 0;
+            for chunkStart in xrange(GRAPH_FILE_HEADER_SIZE, fileSize, GRAPH_FILE_CRC_CHUNK_SIZE):
+                crc = zlib.crc32(self.mm[chunkStart:min(chunkStart + GRAPH_FILE_CRC_CHUNK_SIZE, fileSize)], crc);
+            if crc & 0xffffffff != payloadCRC:
+                raise ValueError("Payload checksum mismatch in graph file %s." % self.graphFilePath);
+
+    def close(self):
+        self.mm.close();
+        self.fd.close();
+
+    def getNumWords(self):
+        return self.numWords;
+
+    def getNumFollowerEntries(self):
+        return self.numEntries;
+
+    def getEncodedWord(self, wordID):
+        (start, end) = struct.unpack_from('<II', self.mm, self.vocabIndexPos + 4 * wordID);
+        return self.mm[self.vocabDataPos + start:self.vocabDataPos + end];
+
+    def getWord(self, wordID):
+        '''
+        Return the word with the given file word ID, or None for 
+        GRAPH_FILE_NULL_WORD_ID.
+        @rtype: {unicode | None}
+        '''
+        if wordID == GRAPH_FILE_NULL_WORD_ID:
+            return None;
+        return self.getEncodedWord(wordID).decode('utf-8');
+
+    def getWordID(self, word):
+        '''
+        Return the file word ID of the given word, or None if the
+        word is not in the vocabulary.
+        @param word: word to look up. Byte strings are assumed to be UTF-8.
+        @type word: {str | unicode}
+        @rtype: {int | None}
+        '''
+        if word is None:
+            return None;
+        if isinstance(word, unicode):
+            word = word.encode('utf-8');
+        low = 0;
+        high = self.numWords;
+        while low < high:
+            middle = (low + high) // 2;
+            if self.getEncodedWord(middle) < word:
+                low = middle + 1;
+            else:
+                high = middle;
+        if low < self.numWords and self.getEncodedWord(low) == word:
+            return low;
+        return None;
+
+    def getFollowerIDRange(self, word):
+        '''
+        Return start and end index into the followers and counts sections
+        for the given word. Start equals end for unknown words.
+        @param word: root word
+        @type word: string
+        @rtype: (int, int)
+        '''
+        wordID = self.getWordID(word);
+        if wordID is None:
+            return (0, 0);
+        return struct.unpack_from('<ii', self.mm, self.offsetsPos + 4 * wordID);
+
+    def getSortedFollowers(self, word, maxFollowers=None):
+        '''
+        Return an array of follow-words for the given root word,
+        sorted by decreasing frequency. Same semantics as
+        FollowerGraph.getSortedFollowers().
+        @param word: root word.
+        @type word: string
+        @param maxFollowers: max number of followers to return. None for all followers.
+        @type maxFollowers: {int | None}
+        @rtype: [string]
+        '''
+        (start, end) = self.getFollowerIDRange(word);
+        if maxFollowers is not None:
+            end = min(end, start + maxFollowers);
+        followerIDs = struct.unpack_from('<%di' % (end - start), self.mm, self.followersPos + 4 * start);
+        return [self.getWord(followerID) for followerID in followerIDs];
+
+    def getSortedFollowersBatch(self, words, maxFollowers=None):
+        '''
+        Return a dict mapping each of the given words to its array
+        of follow-words. Same semantics as FollowerGraph.getSortedFollowersBatch().
+        @param words: root words. Duplicates are allowed.
+        @type words: [string]
+        @param maxFollowers: max number of followers to return per word. None for all followers.
+        @type maxFollowers: {int | None}
+        @rtype: {string : [string]}
+        '''
+        followersByWord = {};
+        for word in words:
+            if word not in followersByWord:
+                followersByWord[word] = self.getSortedFollowers(word, maxFollowers);
+        return followersByWord;
+
+    def getFollowerCounts(self, word, maxFollowers=None):
+        '''
+        Return the followingCount values that correspond to the
+        result of getSortedFollowers() for the same arguments.
+        @rtype: [int]
+        '''
+        (start, end) = self.getFollowerIDRange(word);
+        if maxFollowers is not None:
+            end = min(end, start + maxFollowers);
+        return list(struct.unpack_from('<%di' % (end - start), self.mm, self.countsPos + 4 * start));
+
+def isGraphFile(path):
+    '''
+    Return True if the given file starts with the graph file magic
+    string. Does not check the file's integrity.
+    @param path: file to check
+    @type path: string
+    @rtype: boolean
+    '''
+    try:
+        with open(path, 'rb') as fd:
+            return fd.read(len(GRAPH_FILE_MAGIC)) == GRAPH_FILE_MAGIC;
+    except IOError:
+        return False;
+
+if __name__ == '__main__':
+
+    import time;
+    import argparse;
+
+    parser = argparse.ArgumentParser(prog='follower_graph');
+    parser.add_argument("dbFile", help="fully qualified path to SQLite database with an EnronWords table.");
+    parser.add_argument("-o", "--graphFile", dest='graphFile',
+                        help="graph file to create from the database. If omitted, the graph is only loaded, to measure load time.");
+    args = parser.parse_args();
+
+    startTime = time.time();
+    graph = FollowerGraph.fromSQLite(args.dbFile, logFD=sys.stdout);
+    print "Load time: %.1f seconds." % (time.time() - startTime);
+    if args.graphFile is not None:
+        graph.writeGraphFile(args.graphFile);
+        # Check that the new file is intact:
+        MappedFollowerGraph(args.graphFile, verifyPayload=True).close();
+        print "Wrote graph file %s." % args.graphFile;
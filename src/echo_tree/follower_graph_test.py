@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+
+'''
+Tests that FollowerGraph and MappedFollowerGraph answer follower
+lookups, and thus build trees, exactly as the SQLite database does.
+'''
+
+import os;
+import zlib;
+import unittest;
+
+from echo_tree import WordExplorer, WordDatabase, WordFollower;
+from follower_graph import FollowerGraph, MappedFollowerGraph, isGraphFile, \
+                           GRAPH_FILE_HEADER_STRUCT, GRAPH_FILE_HEADER_CRC_STRUCT, GRAPH_FILE_VERSION;
+from echo_tree_testing import EchoTreeTestCase, TEST_FOLLOWERS;
+
+class FollowerGraphTest(EchoTreeTestCase):
+
+    def setUp(self):
+        super(FollowerGraphTest, self).setUp();
+        self.graph = FollowerGraph.fromSQLite(self.dbPath);
+        self.graphFilePath = os.path.join(self.tmpDir, 'words.graph');
+        self.graph.writeGraphFile(self.graphFilePath);
+        self.mappedGraph = MappedFollowerGraph(self.graphFilePath, verifyPayload=True);
+
+    def tearDown(self):
+        self.mappedGraph.close();
+        super(FollowerGraphTest, self).tearDown();
+
+    def getAllWords(self):
+        # Root words, followers, a NULL word, and a word that is not in the database:
+        words = set(TEST_FOLLOWERS.keys());
+        for wordFollowers in TEST_FOLLOWERS.values():
+            words.update(follower for (follower, dummyCount) in wordFollowers);
+        return sorted(words) + ['unknown'];
+
+    def test_followers_match_database(self):
+        explorer = WordExplorer(self.dbPath);
+        for word in self.getAllWords():
+            for maxFollowers in (None, 1, 2):
+                expected = explorer.getSortedFollowers(word, maxFollowers)[:maxFollowers];
+                self.assertEqual(self.graph.getSortedFollowers(word, maxFollowers), expected);
+                self.assertEqual(self.mappedGraph.getSortedFollowers(word, maxFollowers), expected);
+
+    def test_batch_followers_match_database(self):
+        words = self.getAllWords();
+        explorer = WordExplorer(self.dbPath);
+        for maxFollowers in (None, 1, 2):
+            expected = explorer.getSortedFollowersBatch(words + words[:3], maxFollowers);
+            for graph in (self.graph, self.mappedGraph):
+                followersByWord = graph.getSortedFollowersBatch(words + words[:3], maxFollowers);
+                self.assertEqual(sorted(followersByWord.keys()), sorted(expected.keys()));
+                for word in words:
+                    self.assertEqual(followersByWord[word], expected[word][:maxFollowers]);
+
+    def test_counts_match_database(self):
+        db = WordDatabase(self.dbPath);
+        for word in self.getAllWords():
+            with WordFollower(db, word) as followers:
+                # The NULL count of the metadata row is stored as 0:
+                expected = [int(count or 0) for (dummyFollower, count) in followers];
+            self.assertEqual(self.graph.getFollowerCounts(word), expected);
+            self.assertEqual(self.mappedGraph.getFollowerCounts(word), expected);
+            self.assertEqual(self.mappedGraph.getFollowerCounts(word, 1), expected[:1]);
+        db.close();
+
+    def test_database_order(self):
+        self.assertEqual(self.graph.getSortedFollowers('the'), ['cat', 'dog', 'end', 'say"', None]);
+        self.assertEqual(self.graph.getFollowerCounts('the'), [9, 7, 3, 2, 0]);
+        self.assertEqual(self.mappedGraph.getFollowerCounts('the', 2), [9, 7]);
+        self.assertEqual(self.graph.getSortedFollowers('unknown'), []);
+
+    def test_quoted_word(self):
+        db = WordDatabase(self.dbPath);
+        with WordFollower(db, 'say"') as followers:
+            self.assertEqual([follower for (follower, dummyCount) in followers], ['hello', None]);
+        self.assertEqual(self.mappedGraph.getSortedFollowers('say"'), ['hello', None]);
+
+    def test_trees_match_database(self):
+        explorers = [WordExplorer(self.dbPath, breadthFirst=False),
+                     WordExplorer(self.dbPath, breadthFirst=True),
+                     WordExplorer(self.dbPath, breadthFirst=True, compactTrees=False),
+                     WordExplorer(self.dbPath, graph=self.graph),
+                     WordExplorer(self.graphFilePath)];
+        for word in self.getAllWords():
+            for (maxDepth, maxBranch) in ((1, 3), (3, 2), (4, 3)):
+                trees = [self.getTreeShape(explorer.makeWordTree(word, maxDepth=maxDepth, maxBranch=maxBranch))
+                         for explorer in explorers];
+                for tree in trees[1:]:
+                    self.assertEqual(tree, trees[0], "Tree of '%s' (%d, %d) differs: %s vs. %s" % (word, maxDepth, maxBranch, tree, trees[0]));
+
+    def test_graph_file_detection(self):
+        self.assertTrue(isGraphFile(self.graphFilePath));
+        self.assertFalse(isGraphFile(self.dbPath));
+
+    def test_explorer_closes_only_graphs_it_mapped(self):
+        explorer = WordExplorer(self.graphFilePath);
+        mappedGraph = explorer.graph;
+        explorer.useDatabase(self.dbPath, graph=self.mappedGraph);
+        self.assertTrue(mappedGraph.fd.closed);
+        explorer.close();
+        self.assertFalse(self.mappedGraph.fd.closed);
+
+    def test_corrupt_graph_file(self):
+        with open(self.graphFilePath, 'r+b') as graphFile:
+            graphFile.seek(-1, os.SEEK_END);
+            lastByte = graphFile.read(1);
+            graphFile.seek(-1, os.SEEK_END);
+            graphFile.write(chr(ord(lastByte) ^ 0xff));
+        self.assertRaises(ValueError, MappedFollowerGraph, self.graphFilePath, True);
+        # Without the payload check, the file still opens:
+        MappedFollowerGraph(self.graphFilePath).close();
+
+    def writeModifiedGraphFile(self, modify):
+        '''
+        Write a copy of the graph file, after passing its contents through modify().
+        '''
+        with open(self.graphFilePath, 'rb') as graphFile:
+            contents = graphFile.read();
+        modifiedPath = os.path.join(self.tmpDir, 'modified.graph');
+        with open(modifiedPath, 'wb') as graphFile:
+            graphFile.write(modify(contents));
+        return modifiedPath;
+
+    def test_header_checks(self):
+        headerSize = GRAPH_FILE_HEADER_STRUCT.size;
+        def withVersion(contents, version):
+            header = list(GRAPH_FILE_HEADER_STRUCT.unpack_from(contents, 0));
+            header[1] = version;
+            header = GRAPH_FILE_HEADER_STRUCT.pack(*header);
+            return header + GRAPH_FILE_HEADER_CRC_STRUCT.pack(zlib.crc32(header) & 0xffffffff) + contents[len(header) + 4:];
+        badFiles = {'magic'     : lambda contents: 'X' + contents[1:],
+                    'version'   : lambda contents: withVersion(contents, GRAPH_FILE_VERSION + 1),
+                    'checksum'  : lambda contents: contents[:headerSize - 1] + chr(ord(contents[headerSize - 1]) ^ 0xff) + contents[headerSize:],
+                    'truncated' : lambda contents: contents[:-4],
+                    'short'     : lambda contents: contents[:headerSize]};
+        for modify in badFiles.values():
+            self.assertRaises(ValueError, MappedFollowerGraph, self.writeModifiedGraphFile(modify));
+        self.assertRaises(IOError, MappedFollowerGraph, os.path.join(self.tmpDir, 'missing.graph'));
+        # The unchanged header passes the same checks:
+        MappedFollowerGraph(self.writeModifiedGraphFile(lambda contents: withVersion(contents, GRAPH_FILE_VERSION)), True).close();
+
+if __name__ == '__main__':
+    unittest.main();
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+
+'''
+Adds a table of each word's most frequent followers to an existing
+EchoTree SQLite database. WordExplorer reads followers from that table
+whenever it needs no more than the table's top-K followers of a word.
+Rows in the table are already in frequency order, and are retrieved via
+a covering index. This avoids the sort over all of a word's followers
+that lookups in the EnronWords table require.
+
+Usage: make_top_followers_table.py [-k <topK>] <dbFile>
+'''
+
+import os;
+import sys;
+import argparse;
+import sqlite3;
+
+from echo_tree import TOP_FOLLOWERS_TABLE, TOP_FOLLOWERS_INFO_TABLE, TOP_FOLLOWERS_K;
+
+# Number of rows handed to one executemany() call:
+INSERT_BATCH_SIZE = 10000;
+
+class TopFollowersTableCreator(object):
+    '''
+    Creates (or re-creates) table TOP_FOLLOWERS_TABLE from the EnronWords
+    table of an existing database. Schema:
+       (word, rank, follower, followingCount)
+    where rank 0 is the most frequent follower of word. Only the top-K
+    followers of each word are included. K is recorded in
+    TOP_FOLLOWERS_INFO_TABLE.
+    '''
+
+    def __init__(self, dbPath, topK=TOP_FOLLOWERS_K, logFD=sys.stdout):
+        '''
+        Build the top-K follower table.
+        @param dbPath: SQLite database file that holds an EnronWords table.
+        @type dbPath: string
+        @param topK: max number of followers stored for each word.
+        @type topK: int
+        @param logFD: file for progress reports. None for no reports.
+        @type logFD: file
+        '''
+        if not os.path.isfile(dbPath):
+            raise IOError("Database file %s does not exist." % dbPath);
+        if topK <= 0:
+            raise ValueError("Number of followers to keep per word must be a positive integer.");
+        self.dbPath = dbPath;
+        self.topK   = topK;
+        self.logFD  = logFD;
+        self.conn   = sqlite3.connect(self.dbPath);
+        try:
+            self.createTables();
+            self.fillTable();
+        finally:
+            self.conn.close();
+
+    def log(self, msg):
+        if self.logFD is not None:
+            self.logFD.write(msg + '\n');
+            self.logFD.flush();
+
+    def createTables(self):
+        cursor = self.conn.cursor();
+        cursor.execute('DROP TABLE IF EXISTS %s;' % TOP_FOLLOWERS_TABLE);
+        cursor.execute('DROP TABLE IF EXISTS %s;' % TOP_FOLLOWERS_INFO_TABLE);
+        cursor.execute('CREATE TABLE %s (word text, rank int, follower text, followingCount int);' % TOP_FOLLOWERS_TABLE);
+        cursor.execute('CREATE TABLE %s (topK int);' % TOP_FOLLOWERS_INFO_TABLE);
+        cursor.close();
+
+    def fillTable(self):
+        '''
+        Scan EnronWords once in (word, decreasing count) order, and copy
+        the first topK rows of each word into the new table. The *1 in
+        the ORDER BY clause sorts the counts numerically; see WordFollower.
+        The covering index is created after the inserts, which is much
+        faster than maintaining it during the load.
+        '''
+        readCursor  = self.conn.cursor();
+        writeCursor = self.conn.cursor();
+        readCursor.execute('SELECT word,follower,followingCount from EnronWords ORDER BY word, followingCount*1 desc;');
+        rows = [];
+        numWords = 0;
+        currWord = None;
+        rank = 0;
+        for (word, follower, followingCount) in readCursor:
+            if word != currWord or numWords == 0:
+                currWord = word;
+                rank = 0;
+                numWords += 1;
+                if numWords % 100000 == 0:
+                    self.log("Processed %d words..." % numWords);
+            if rank < self.topK:
+                rows.append((word, rank, follower, followingCount));
+            rank += 1;
+            if len(rows) >= INSERT_BATCH_SIZE:
+                writeCursor.executemany('INSERT INTO %s VALUES (?,?,?,?);' % TOP_FOLLOWERS_TABLE, rows);
+                rows = [];
+        if len(rows) > 0:
+            writeCursor.executemany('INSERT INTO %s VALUES (?,?,?,?);' % TOP_FOLLOWERS_TABLE, rows);
+        readCursor.close();
+        self.log("Creating index on %s..." % TOP_FOLLOWERS_TABLE);
+        writeCursor.execute('CREATE UNIQUE INDEX %sIndx ON %s (word, rank, follower, followingCount);' % (TOP_FOLLOWERS_TABLE, TOP_FOLLOWERS_TABLE));
+        writeCursor.execute('INSERT INTO %s VALUES (?);' % TOP_FOLLOWERS_INFO_TABLE, (self.topK,));
+        writeCursor.close();
+        self.conn.commit();
+        self.log("Stored top %d followers of %d words in %s." % (self.topK, numWords, TOP_FOLLOWERS_TABLE));
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(prog='make_top_followers_table');
+    parser.add_argument("dbFile", help="fully qualified path to SQLite database with an EnronWords table. The new table is added to this file.");
+    parser.add_argument("-k", "--topK", type=int, default=TOP_FOLLOWERS_K, dest='topK',
+                        help="number of followers to keep for each word. Default: %d." % TOP_FOLLOWERS_K);
+
+    args = parser.parse_args();
+    TopFollowersTableCreator(args.dbFile, topK=args.topK);
+    sys.exit();
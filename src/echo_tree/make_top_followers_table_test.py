@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+
+'''
+Tests that TopFollowersTableCreator stores each word's most frequent
+followers, and that WordExplorer builds the same trees from that table
+as from the EnronWords table alone.
+'''
+
+import os;
+import shutil;
+import sqlite3;
+import unittest;
+
+from echo_tree import WordExplorer, WordDatabase, FollowerCache, TOP_FOLLOWERS_TABLE, TOP_FOLLOWERS_INFO_TABLE;
+from make_top_followers_table import TopFollowersTableCreator;
+from echo_tree_testing import EchoTreeTestCase, TEST_FOLLOWERS;
+
+class TopFollowersTableTest(EchoTreeTestCase):
+
+    def setUp(self):
+        super(TopFollowersTableTest, self).setUp();
+        # The same words, without the top-followers table:
+        self.plainDbPath = os.path.join(self.tmpDir, 'plainWords.db');
+        shutil.copyfile(self.dbPath, self.plainDbPath);
+        TopFollowersTableCreator(self.dbPath, topK=2, logFD=None);
+
+    def test_table_holds_top_k_followers_in_rank_order(self):
+        conn = sqlite3.connect(self.dbPath);
+        try:
+            rows = conn.execute('SELECT word,rank,follower from %s ORDER BY word,rank;' % TOP_FOLLOWERS_TABLE).fetchall();
+            topK = conn.execute('SELECT topK from %s;' % TOP_FOLLOWERS_INFO_TABLE).fetchall();
+        finally:
+            conn.close();
+        self.assertEqual(topK, [(2,)]);
+        # Words with fewer than K followers also get their metadata row, whose follower is NULL:
+        expected = [];
+        for (word, wordFollowers) in TEST_FOLLOWERS.items():
+            followers = [follower for (follower, dummyCount) in wordFollowers] + [None];
+            expected.extend([(word, rank, follower) for (rank, follower) in enumerate(followers[:2])]);
+        self.assertEqual(rows, sorted(expected));
+
+    def test_database_reports_k(self):
+        db = WordDatabase(self.dbPath);
+        self.assertEqual(db.topK, 2);
+        self.assertTrue(db.coversNumFollowers(2));
+        self.assertFalse(db.coversNumFollowers(3));
+        self.assertFalse(db.coversNumFollowers(None));
+        db.close();
+        plainDb = WordDatabase(self.plainDbPath);
+        self.assertEqual(plainDb.topK, None);
+        self.assertFalse(plainDb.coversNumFollowers(1));
+        plainDb.close();
+
+    def test_same_trees_as_without_table(self):
+        for breadthFirst in (True, False):
+            explorer = WordExplorer(self.dbPath, breadthFirst=breadthFirst);
+            plainExplorer = WordExplorer(self.plainDbPath, breadthFirst=breadthFirst);
+            for maxBranch in (1, 2, 3):
+                for word in TEST_FOLLOWERS.keys():
+                    self.assertEqual(self.getTreeShape(explorer.makeWordTree(word, maxDepth=4, maxBranch=maxBranch)),
+                                     self.getTreeShape(plainExplorer.makeWordTree(word, maxDepth=4, maxBranch=maxBranch)),
+                                     "%s, maxBranch %d, breadthFirst %s" % (word, maxBranch, breadthFirst));
+            explorer.close();
+            plainExplorer.close();
+
+    def test_only_requests_up_to_k_read_the_table(self):
+        conn = sqlite3.connect(self.dbPath);
+        conn.execute("UPDATE %s SET follower='marker' WHERE word='the' AND rank=0;" % TOP_FOLLOWERS_TABLE);
+        conn.commit();
+        conn.close();
+        explorer = WordExplorer(self.dbPath, cache=FollowerCache(truncate=False));
+        self.assertEqual(explorer.getSortedFollowers('the', 2), ['marker', 'dog']);
+        self.assertEqual(explorer.getSortedFollowersBatch(['the', 'cat'], 2)['the'], ['marker', 'dog']);
+        # A cached top-K entry does not cut short a request for more followers:
+        self.assertEqual(explorer.getSortedFollowers('the', 3), ['cat', 'dog', 'end', 'say"', None]);
+        explorer.close();
+
+    def test_invalid_arguments(self):
+        self.assertRaises(ValueError, TopFollowersTableCreator, self.dbPath, topK=0, logFD=None);
+        self.assertRaises(IOError, TopFollowersTableCreator, os.path.join(self.tmpDir, 'missing.db'), logFD=None);
+
+if __name__ == '__main__':
+    unittest.main();
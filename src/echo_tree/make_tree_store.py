@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+
+'''
+Precomputes the JSON trees of the most frequent words of an EchoTree
+SQLite database, and writes them to a tree store: a separate SQLite
+file with one zlib compressed JSON tree per root word. The EchoTree
+server loads the store at startup (see PrecomputedTreeStore in
+echo_tree.py), and answers requests for those roots without touching
+the database.
+
+Trees are computed by one worker process per core. Runs are incremental:
+if the store was computed from the database's current version with the
+same tree shape, only words missing from the store are computed. Otherwise
+the store is rebuilt in a temporary file, which then replaces the old store.
+
+Usage: make_tree_store.py [-n <numWords>] [-d <depth>] [-b <breadth>] [-w <numWorkers>] [-o <storeFile>] [-f] <dbFile>
+'''
+
+import os;
+import sys;
+import zlib;
+import time;
+import argparse;
+import sqlite3;
+import multiprocessing;
+
+from echo_tree import WordExplorer, getDatabaseVersion, WORD_TREE_DEPTH, WORD_TREE_BREADTH, \
+                      PRECOMPUTED_TREES_TABLE, PRECOMPUTED_TREES_INFO_TABLE, PRECOMPUTED_TREES_SUFFIX;
+
+# Number of most frequent words whose trees are stored by default:
+DEFAULT_NUM_STORED_TREES = 5000;
+# Number of rows handed to one executemany() call:
+INSERT_BATCH_SIZE = 500;
+# Words handed to a worker at a time:
+WORDS_PER_WORKER_CHUNK = 16;
+
+# The WordExplorer of a worker process. Set by initStoreWorker():
+workerExplorer = None;
+
+def initStoreWorker(dbPath):
+    global workerExplorer;
+    workerExplorer = WordExplorer(dbPath);
+
+def computeStoredTree(job):
+    '''
+    Runs in a worker process.
+    @param job: root word, tree depth, and tree breadth.
+    @type job: (string, int, int)
+    @return: the root word, and its compressed JSON tree.
+    @rtype: (string, string)
+    '''
+    (word, maxDepth, maxBranch) = job;
+    (dummyWordTree, jsonTree) = workerExplorer.makeWordTreeAndJSON(word, maxDepth=maxDepth, maxBranch=maxBranch);
+    return (word, zlib.compress(jsonTree, 9));
+
+class TreeStoreBuilder(object):
+    '''
+    Creates or updates the tree store of a database. Schema:
+       PRECOMPUTED_TREES_TABLE (word, compressedTree)
+       PRECOMPUTED_TREES_INFO_TABLE (sourceVersion, maxDepth, maxBranch, numWords, created)
+    sourceVersion is getDatabaseVersion() of the database the trees came from.
+    '''
+
+    def __init__(self, dbPath, storePath=None, numWords=DEFAULT_NUM_STORED_TREES,
+                 maxDepth=WORD_TREE_DEPTH, maxBranch=WORD_TREE_BREADTH,
+                 numWorkers=None, force=False, logFD=sys.stdout):
+        '''
+        Bring the tree store up to date.
+        @param dbPath: SQLite database file that holds an EnronWords table.
+        @type dbPath: string
+        @param storePath: tree store file. Default: dbPath + PRECOMPUTED_TREES_SUFFIX.
+        @type storePath: {string | None}
+        @param numWords: number of most frequent words, by metaTotalOcc, whose trees are stored.
+        @type numWords: int
+        @param maxDepth: depth of the stored trees.
+        @type maxDepth: int
+        @param maxBranch: breadth of the stored trees.
+        @type maxBranch: int
+        @param numWorkers: number of worker processes. Default: number of CPUs.
+        @type numWorkers: {int | None}
+        @param force: if True, rebuild the store even if it is up to date.
+        @type force: boolean
+        @param logFD: file for progress reports. None for no reports.
+        @type logFD: file
+        '''
+        if not os.path.isfile(dbPath):
+            raise IOError("Database file %s does not exist." % dbPath);
+        if numWords <= 0:
+            raise ValueError("Number of stored trees must be a positive integer.");
+        if storePath is None:
+            storePath = dbPath + PRECOMPUTED_TREES_SUFFIX;
+        self.dbPath     = dbPath;
+        self.storePath  = storePath;
+        self.numWords   = numWords;
+        self.maxDepth   = maxDepth;
+        self.maxBranch  = maxBranch;
+        self.numWorkers = numWorkers if numWorkers is not None else multiprocessing.cpu_count();
+        self.logFD      = logFD;
+        self.sourceVersion = getDatabaseVersion(dbPath);
+        if force or not self.isStoreCurrent():
+            self.rebuildStore();
+        else:
+            self.updateStore(self.storePath);
+
+    def log(self, msg):
+        if self.logFD is not None:
+            self.logFD.write(msg + '\n');
+            self.logFD.flush();
+
+    def isStoreCurrent(self):
+        '''
+        Return True if the store exists, and holds trees of the requested
+        shape computed from the database's current version.
+        '''
+        if not os.path.isfile(self.storePath):
+            return False;
+        conn = sqlite3.connect(self.storePath);
+        try:
+            info = conn.execute('SELECT sourceVersion, maxDepth, maxBranch FROM %s;' % PRECOMPUTED_TREES_INFO_TABLE).fetchone();
+        except sqlite3.DatabaseError:
+            return False;
+        finally:
+            conn.close();
+        return info is not None and (str(info[0]), info[1], info[2]) == (self.sourceVersion, self.maxDepth, self.maxBranch);
+
+    def rebuildStore(self):
+        '''
+        Build a new store next to the old one, and replace the old store
+        with it. Servers that open the store never see a partial file.
+        '''
+        tmpPath = self.storePath + '.tmp';
+        if os.path.exists(tmpPath):
+            os.remove(tmpPath);
+        conn = sqlite3.connect(tmpPath);
+        conn.execute('CREATE TABLE %s (word text PRIMARY KEY, compressedTree blob);' % PRECOMPUTED_TREES_TABLE);
+        conn.execute('CREATE TABLE %s (sourceVersion text, maxDepth int, maxBranch int, numWords int, created real);' % PRECOMPUTED_TREES_INFO_TABLE);
+        conn.commit();
+        conn.close();
+        self.log("Rebuilding tree store %s." % self.storePath);
+        self.updateStore(tmpPath);
+        os.rename(tmpPath, self.storePath);
+
+    def updateStore(self, storePath):
+        '''
+        Add the trees of the most frequent words that the store lacks.
+        '''
+        conn = sqlite3.connect(storePath);
+        try:
+            storedWords = set([row[0] for row in conn.execute('SELECT word FROM %s;' % PRECOMPUTED_TREES_TABLE)]);
+            missingWords = [];
+            for word in self.getTopWords():
+                if word not in storedWords:
+                    storedWords.add(word);
+                    missingWords.append(word);
+            numPreviouslyStored = len(storedWords) - len(missingWords);
+            if len(missingWords) == 0:
+                self.log("Tree store %s is up to date." % self.storePath);
+                return;
+            self.log("Computing %d trees with %d processes..." % (len(missingWords), self.numWorkers));
+            startTime = time.time();
+            pool = multiprocessing.Pool(self.numWorkers, initStoreWorker, (self.dbPath,));
+            try:
+                jobs = [(word.encode('utf-8'), self.maxDepth, self.maxBranch) for word in missingWords];
+                rows = [];
+                numStored = 0;
+                for (word, compressedTree) in pool.imap_unordered(computeStoredTree, jobs, WORDS_PER_WORKER_CHUNK):
+                    rows.append((word.decode('utf-8'), sqlite3.Binary(compressedTree)));
+                    if len(rows) >= INSERT_BATCH_SIZE:
+                        numStored += self.insertTrees(conn, rows);
+                        rows = [];
+                        self.log("Stored %d trees..." % numStored);
+                numStored += self.insertTrees(conn, rows);
+            finally:
+                pool.close();
+                pool.join();
+            conn.execute('DELETE FROM %s;' % PRECOMPUTED_TREES_INFO_TABLE);
+            conn.execute('INSERT INTO %s VALUES (?,?,?,?,?);' % PRECOMPUTED_TREES_INFO_TABLE,
+                         (self.sourceVersion, self.maxDepth, self.maxBranch, numPreviouslyStored + numStored, time.time()));
+            conn.commit();
+            self.log("Stored %d trees in %.1f seconds." % (numStored, time.time() - startTime));
+        finally:
+            conn.close();
+
+    def insertTrees(self, conn, rows):
+        conn.executemany('INSERT INTO %s VALUES (?,?);' % PRECOMPUTED_TREES_TABLE, rows);
+        return len(rows);
+
+    def getTopWords(self):
+        '''
+        Return the numWords most frequent words. The *1 in the ORDER BY
+        clause sorts the counts numerically; see WordFollower.
+        @rtype: [unicode]
+        '''
+        conn = sqlite3.connect(self.dbPath);
+        try:
+            return [row[0] for row in conn.execute('SELECT word FROM EnronWords WHERE metaTotalOcc IS NOT NULL ORDER BY metaTotalOcc*1 DESC LIMIT ?;',
+                                                   (self.numWords,))];
+        finally:
+            conn.close();
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(prog='make_tree_store');
+    parser.add_argument("dbFile", help="fully qualified path to SQLite database with an EnronWords table.");
+    parser.add_argument("-o", "--storeFile", dest='storeFile',
+                        help="tree store to create or update. Default: dbFile%s." % PRECOMPUTED_TREES_SUFFIX);
+    parser.add_argument("-n", "--numWords", type=int, default=DEFAULT_NUM_STORED_TREES, dest='numWords',
+                        help="number of most frequent words whose trees are stored. Default: %d." % DEFAULT_NUM_STORED_TREES);
+    parser.add_argument("-d", "--depth", type=int, default=WORD_TREE_DEPTH, dest='maxDepth',
+                        help="depth of the stored trees. Default: %d." % WORD_TREE_DEPTH);
+    parser.add_argument("-b", "--breadth", type=int, default=WORD_TREE_BREADTH, dest='maxBranch',
+                        help="breadth of the stored trees. Default: %d." % WORD_TREE_BREADTH);
+    parser.add_argument("-w", "--workers", type=int, default=multiprocessing.cpu_count(), dest='numWorkers',
+                        help="number of worker processes. Default: number of CPUs.");
+    parser.add_argument("-f", "--force", action='store_true', dest='force',
+                        help="rebuild the store even if it is up to date.");
+
+    args = parser.parse_args();
+    TreeStoreBuilder(args.dbFile, storePath=args.storeFile, numWords=args.numWords,
+                     maxDepth=args.maxDepth, maxBranch=args.maxBranch,
+                     numWorkers=args.numWorkers, force=args.force);
+    sys.exit();
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+
+'''
+Tests that TreeStoreBuilder stores the trees WordExplorer computes,
+updates stores incrementally, and rebuilds stale ones.
+'''
+
+import os;
+import sqlite3;
+import unittest;
+from StringIO import StringIO;
+
+from echo_tree import WordExplorer, PrecomputedTreeStore, PRECOMPUTED_TREES_TABLE;
+from make_tree_store import TreeStoreBuilder;
+from echo_tree_testing import EchoTreeTestCase, makeWordDatabase, TEST_FOLLOWERS;
+
+# Stands in for a stored tree, to tell whether a run recomputed it:
+MARKER_TREE = '{"word": "marker", "followWordObjs": []}';
+
+class TreeStoreBuilderTest(EchoTreeTestCase):
+
+    def setUp(self):
+        super(TreeStoreBuilderTest, self).setUp();
+        self.storePath = os.path.join(self.tmpDir, 'words.trees');
+
+    def buildStore(self, numWords, maxDepth=3, maxBranch=2, force=False):
+        logFD = StringIO();
+        TreeStoreBuilder(self.dbPath, self.storePath, numWords=numWords, maxDepth=maxDepth, maxBranch=maxBranch,
+                         numWorkers=1, force=force, logFD=logFD);
+        return logFD.getvalue();
+
+    def markStoredTree(self, word):
+        conn = sqlite3.connect(self.storePath);
+        conn.execute('UPDATE %s SET compressedTree=? WHERE word=?;' % PRECOMPUTED_TREES_TABLE,
+                     (sqlite3.Binary(MARKER_TREE.encode('zlib')), word));
+        conn.commit();
+        conn.close();
+
+    def test_stores_most_frequent_words(self):
+        self.buildStore(3);
+        store = PrecomputedTreeStore(self.storePath, self.dbPath);
+        # By total occurrences; see makeWordDatabase():
+        self.assertEqual(sorted(store.trees.keys()), ['cat', 'on', 'the']);
+        explorer = WordExplorer(self.dbPath);
+        for word in store.trees.keys():
+            self.assertEqual(store.get(word, 3, 2), explorer.makeWordTreeAndJSON(word, maxDepth=3, maxBranch=2)[1]);
+        self.assertEqual(store.get('the', 3, 3), None);
+        self.assertEqual(store.get('dog', 3, 2), None);
+
+    def test_incremental_update(self):
+        self.buildStore(3);
+        self.markStoredTree('the');
+        self.assertTrue('up to date' in self.buildStore(3));
+        log = self.buildStore(4);
+        self.assertTrue('Computing 1 trees' in log);
+        store = PrecomputedTreeStore(self.storePath, self.dbPath);
+        self.assertEqual(len(store), 4);
+        # Earlier trees are kept:
+        self.assertEqual(store.get('the', 3, 2), MARKER_TREE);
+
+    def test_rebuilds_for_other_shape(self):
+        self.buildStore(3);
+        self.markStoredTree('the');
+        self.assertTrue('Rebuilding' in self.buildStore(3, maxBranch=3));
+        store = PrecomputedTreeStore(self.storePath, self.dbPath);
+        self.assertNotEqual(store.get('the', 3, 3), MARKER_TREE);
+        self.assertFalse(os.path.exists(self.storePath + '.tmp'));
+
+    def test_rebuilds_for_new_database(self):
+        self.buildStore(3);
+        newDbPath = os.path.join(self.tmpDir, 'new.db');
+        followers = dict(TEST_FOLLOWERS);
+        followers['the'] = [('dog', 30)];
+        makeWordDatabase(newDbPath, followers);
+        os.rename(newDbPath, self.dbPath);
+        self.assertRaises(ValueError, PrecomputedTreeStore, self.storePath, self.dbPath);
+        self.assertTrue('Rebuilding' in self.buildStore(3));
+        store = PrecomputedTreeStore(self.storePath, self.dbPath);
+        self.assertEqual(store.get('the', 3, 2), WordExplorer(self.dbPath).makeWordTreeAndJSON('the', maxDepth=3, maxBranch=2)[1]);
+
+    def test_forced_rebuild(self):
+        self.buildStore(3);
+        self.markStoredTree('the');
+        self.buildStore(3, force=True);
+        self.assertNotEqual(PrecomputedTreeStore(self.storePath).get('the', 3, 2), MARKER_TREE);
+
+if __name__ == '__main__':
+    unittest.main();
@@ -5,13 +5,16 @@ import socket;
 
 from echo_tree_server import ECHO_TREE_NEW_ROOT_PORT;
 from echo_tree_server import NEW_TREE_SUBMISSION_URI_PATH;
+from echo_tree_server import DEFAULT_CHANNEL_ID;
 
 class RootWordPusher(object):
 
-    def __init__(self, serverHostNameOrIP, port=ECHO_TREE_NEW_ROOT_PORT):
+    def __init__(self, serverHostNameOrIP, port=ECHO_TREE_NEW_ROOT_PORT, channelId=DEFAULT_CHANNEL_ID):
         
         self.serverHostNameOrIP = serverHostNameOrIP;
         self.port = port;
+        # EchoTree channel whose tree the pushed words replace:
+        self.channelId = channelId;
 
     def pushEchoTreeToServer(self, rootWord):
         '''
@@ -28,7 +31,7 @@ class RootWordPusher(object):
         try:
             sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM);
             sock.connect((self.serverHostNameOrIP, self.port));
-            treeMsg = "POST " + NEW_TREE_SUBMISSION_URI_PATH + " HTTP/1.0\r\n" +\
+            treeMsg = "POST " + NEW_TREE_SUBMISSION_URI_PATH + "/" + self.channelId + " HTTP/1.0\r\n" +\
                       "User-Agent: EchoTree_PushTool\r\n" +\
                       "Content-Type: application/json\r\n" +\
                       "Content-Length: " + str(len(rootWord)) + "\r\n" +\
@@ -0,0 +1,721 @@
+#!/usr/bin/env python
+
+'''
+Load generator and latency benchmark for echo_tree_server.py. Opens
+numSubscribers websocket subscriptions, spread over numChannels channels,
+and has numSubmitters clients submit root words at a fixed rate each,
+either via HTTP POST to the submission port, or as websocket messages.
+For every tree a subscriber receives, the time from the submission of
+its root word to the delivery is recorded.
+
+All clients run on one IOLoop, on tornado.iostream connections. Tornado
+2.3 has no websocket client, so BenchmarkSubscriber speaks the RFC 6455
+protocol itself, without extensions.
+
+The report is a JSON object on stdout, or in the file given with -o:
+throughput, latency percentiles, delivery counts, and the CPU time and
+memory of the server's process tree, read from /proc (Linux only). The
+server is either started by the benchmark (-x), or identified by its
+pid (-i). The server's own /stats are included when available.
+
+Usage: server_benchmark.py [-n <numSubscribers>] [-m <numSubmitters>] [-r <rate>] [-c <numChannels>]
+                           [-t <seconds>] [-s {http|websocket}] [-x <serverArgs> | -i <serverPid>] [-o <reportFile>]
+'''
+
+import os;
+import sys;
+import json;
+import time;
+import shlex;
+import base64;
+import socket;
+import signal;
+import struct;
+import urllib2;
+import sqlite3;
+import argparse;
+import functools;
+import subprocess;
+from collections import deque;
+
+from tornado.ioloop import IOLoop, PeriodicCallback;
+from tornado.iostream import IOStream;
+
+from echo_tree_server import ECHO_TREE_GET_PORT, ECHO_TREE_NEW_ROOT_PORT, ECHO_TREE_SUBSCRIBE_PATH, \
+                             NEW_TREE_SUBMISSION_URI_PATH, STATS_URI_PATH, DEFAULT_CHANNEL_ID, DBPATH;
+
+# Seconds to wait for late trees after the last submission:
+DRAIN_TIME = 2.0;
+# Seconds to wait for all subscribers to connect before submissions start anyway:
+CONNECT_TIMEOUT = 10.0;
+# Seconds to wait for a server started with -x to accept connections:
+SERVER_START_TIMEOUT = 60.0;
+# Seconds between two samples of the server's memory:
+SERVER_SAMPLE_INTERVAL = 0.5;
+# Number of most frequent words of the database that are submitted by default:
+DEFAULT_NUM_WORDS = 200;
+
+WEBSOCKET_OPCODE_CONTINUATION = 0x0;
+WEBSOCKET_OPCODE_TEXT         = 0x1;
+WEBSOCKET_OPCODE_CLOSE        = 0x8;
+WEBSOCKET_OPCODE_PING         = 0x9;
+WEBSOCKET_OPCODE_PONG         = 0xA;
+
+def getPercentile(sortedValues, fraction):
+    '''
+    Return the nearest-rank percentile of a sorted list.
+    @param fraction: between 0 and 1, e.g. 0.99 for the 99th percentile.
+    @type fraction: float
+    @rtype: {float | None}
+    '''
+    if len(sortedValues) == 0:
+        return None;
+    rank = int(fraction * len(sortedValues) + 0.5);
+    return sortedValues[min(max(rank, 1), len(sortedValues)) - 1];
+
+def getRootWord(jsonTree):
+    '''
+    Return the root word of a JSON tree as sent by the server, without
+    decoding the whole tree. The root word is the tree's first key.
+    @rtype: {string | None}
+    '''
+    try:
+        start = jsonTree.index(':') + 1;
+        while jsonTree[start:start + 1].isspace():
+            start += 1;
+        (word, dummyEnd) = json.JSONDecoder().raw_decode(jsonTree, start);
+    except ValueError:
+        return None;
+    if isinstance(word, unicode):
+        word = word.encode('utf-8');
+    return word;
+
+# ------------------------------- class Benchmark Subscriber ---------------------
+class BenchmarkSubscriber(object):
+    '''
+    One websocket connection to ECHO_TREE_SUBSCRIBE_PATH. Reports each
+    received tree to the benchmark. Also used by websocket submitters,
+    which send their root words over it.
+    '''
+
+    def __init__(self, benchmark, channelId, recordDeliveries=True):
+        '''
+        @param benchmark: the benchmark the connection belongs to.
+        @type benchmark: ServerBenchmark
+        @param channelId: channel to subscribe to.
+        @type channelId: string
+        @param recordDeliveries: if False, received trees are read and dropped.
+        @type recordDeliveries: boolean
+        '''
+        self.benchmark = benchmark;
+        self.channelId = channelId;
+        self.recordDeliveries = recordDeliveries;
+        # Root word --> times of its submissions on the channel whose trees
+        # this connection has yet to receive, oldest first:
+        self.submitTimes = {};
+        self.isOpen = False;
+        self.wasOpen = False;
+        # Payloads of the fragments of the message being received:
+        self.fragments = [];
+        self.opcode = None;
+        self.stream = IOStream(socket.socket(socket.AF_INET, socket.SOCK_STREAM), io_loop=benchmark.ioLoop);
+        self.stream.set_close_callback(self.onClose);
+        self.stream.connect((benchmark.host, benchmark.port), self.sendHandshake);
+
+    def sendHandshake(self):
+        self.key = base64.b64encode(os.urandom(16));
+        self.stream.write("GET %s/%s HTTP/1.1\r\n" % (ECHO_TREE_SUBSCRIBE_PATH, self.channelId) +\
+                          "Host: %s:%d\r\n" % (self.benchmark.host, self.benchmark.port) +\
+                          "Upgrade: websocket\r\n" +\
+                          "Connection: Upgrade\r\n" +\
+                          "Sec-WebSocket-Key: %s\r\n" % self.key +\
+                          "Sec-WebSocket-Version: 13\r\n" +\
+                          "\r\n");
+        self.stream.read_until("\r\n\r\n", self.onHandshakeResponse);
+
+    def onHandshakeResponse(self, response):
+        if response.split(' ', 2)[1] != '101':
+            self.benchmark.log("Subscription refused: %s" % response.split('\r\n')[0]);
+            self.stream.close();
+            return;
+        self.isOpen = self.wasOpen = True;
+        self.benchmark.onSubscriberOpen(self);
+        self.readFrame();
+
+    def readFrame(self):
+        self.stream.read_bytes(2, self.onFrameStart);
+
+    def onFrameStart(self, header):
+        (byte1, byte2) = struct.unpack('BB', header);
+        isFinal = byte1 & 0x80;
+        opcode = byte1 & 0x0F;
+        payloadLen = byte2 & 0x7F;
+        onLength = functools.partial(self.onFrameLength, isFinal, opcode);
+        if payloadLen == 126:
+            self.stream.read_bytes(2, lambda data: onLength(struct.unpack('!H', data)[0]));
+        elif payloadLen == 127:
+            self.stream.read_bytes(8, lambda data: onLength(struct.unpack('!Q', data)[0]));
+        else:
+            onLength(payloadLen);
+
+    def onFrameLength(self, isFinal, opcode, payloadLen):
+        # The server does not mask its frames:
+        if payloadLen == 0:
+            self.onFramePayload(isFinal, opcode, '');
+        else:
+            self.stream.read_bytes(payloadLen, functools.partial(self.onFramePayload, isFinal, opcode));
+
+    def onFramePayload(self, isFinal, opcode, payload):
+        if opcode == WEBSOCKET_OPCODE_CLOSE:
+            self.stream.close();
+            return;
+        if opcode == WEBSOCKET_OPCODE_PING:
+            self.sendFrame(WEBSOCKET_OPCODE_PONG, payload);
+        elif opcode != WEBSOCKET_OPCODE_PONG:
+            if opcode != WEBSOCKET_OPCODE_CONTINUATION:
+                self.opcode = opcode;
+            self.fragments.append(payload);
+            if isFinal:
+                message = ''.join(self.fragments);
+                self.fragments = [];
+                self.onMessage(message);
+        if not self.stream.closed():
+            self.readFrame();
+
+    def onMessage(self, message):
+        receiveTime = time.time();
+        if self.recordDeliveries and self.opcode == WEBSOCKET_OPCODE_TEXT:
+            self.benchmark.onTreeDelivered(self, getRootWord(message), len(message), receiveTime);
+
+    def sendText(self, text):
+        self.sendFrame(WEBSOCKET_OPCODE_TEXT, text);
+
+    def sendFrame(self, opcode, payload):
+        '''
+        Send one frame. Clients must mask their frames.
+        '''
+        if isinstance(payload, unicode):
+            payload = payload.encode('utf-8');
+        if len(payload) < 126:
+            header = struct.pack('BB', 0x80 | opcode, 0x80 | len(payload));
+        elif len(payload) < 0x10000:
+            header = struct.pack('!BBH', 0x80 | opcode, 0x80 | 126, len(payload));
+        else:
+            header = struct.pack('!BBQ', 0x80 | opcode, 0x80 | 127, len(payload));
+        mask = os.urandom(4);
+        maskedPayload = ''.join([chr(ord(char) ^ ord(mask[i % 4])) for (i, char) in enumerate(payload)]);
+        self.stream.write(header + mask + maskedPayload);
+
+    def close(self):
+        if not self.stream.closed():
+            self.stream.close();
+
+    def onClose(self):
+        wasOpen = self.isOpen;
+        self.isOpen = False;
+        self.benchmark.onSubscriberClosed(self, wasOpen);
+
+# ------------------------------- class Benchmark Submitter ---------------------
+class BenchmarkSubmitter(object):
+    '''
+    Submits root words to one channel at a fixed rate, via HTTP POST
+    or via its own websocket connection.
+    '''
+
+    def __init__(self, benchmark, submitterIndex, channelId):
+        '''
+        @param benchmark: the benchmark the submitter belongs to.
+        @type benchmark: ServerBenchmark
+        @param submitterIndex: position of this submitter among all submitters.
+                               Selects the submitter's words; see nextWord().
+        @type submitterIndex: int
+        @param channelId: channel on which root words are submitted.
+        @type channelId: string
+        '''
+        self.benchmark = benchmark;
+        self.submitterIndex = submitterIndex;
+        self.channelId = channelId;
+        self.numSubmitted = 0;
+        self.nextSubmitTime = None;
+        self.timeout = None;
+        self.websocket = None;
+        if benchmark.submitVia == 'websocket':
+            self.websocket = BenchmarkSubscriber(benchmark, channelId, recordDeliveries=False);
+
+    def start(self, startTime):
+        # Spread the submitters over one interval, so that they do not submit in bursts:
+        self.nextSubmitTime = startTime + self.benchmark.submitInterval * self.submitterIndex / self.benchmark.numSubmitters;
+        self.timeout = self.benchmark.ioLoop.add_timeout(self.nextSubmitTime, self.submit);
+
+    def stop(self):
+        if self.timeout is not None:
+            self.benchmark.ioLoop.remove_timeout(self.timeout);
+            self.timeout = None;
+        if self.websocket is not None:
+            self.websocket.close();
+
+    def nextWord(self):
+        '''
+        Submitters take turns through the word list, so that no two of
+        them submit the same word at the same time, as long as there are
+        more words than submitters.
+        '''
+        words = self.benchmark.words;
+        return words[(self.submitterIndex + self.benchmark.numSubmitters * self.numSubmitted) % len(words)];
+
+    def submit(self):
+        word = self.nextWord();
+        self.numSubmitted += 1;
+        if self.websocket is not None:
+            if self.websocket.isOpen:
+                self.benchmark.onSubmitted(self.channelId, word);
+                self.websocket.sendText(word);
+            else:
+                self.benchmark.numSubmissionErrors += 1;
+        else:
+            self.post(word);
+        # Absolute times, so that slow callbacks do not lower the rate:
+        self.nextSubmitTime += self.benchmark.submitInterval;
+        self.timeout = self.benchmark.ioLoop.add_timeout(self.nextSubmitTime, self.submit);
+
+    def post(self, word):
+        '''
+        POST the word, and close the connection once it is written. The
+        submission port does not answer, much like root_word_pusher.py expects.
+        '''
+        stream = IOStream(socket.socket(socket.AF_INET, socket.SOCK_STREAM), io_loop=self.benchmark.ioLoop);
+        request = "POST %s/%s HTTP/1.0\r\n" % (NEW_TREE_SUBMISSION_URI_PATH, self.channelId) +\
+                  "User-Agent: EchoTree_Benchmark\r\n" +\
+                  "Content-Length: %d\r\n" % len(word) +\
+                  "\r\n" +\
+                  word;
+        posted = [];
+        def onConnected():
+            self.benchmark.onSubmitted(self.channelId, word);
+            posted.append(True);
+            stream.write(request, stream.close);
+        def onClosed():
+            if len(posted) == 0:
+                self.benchmark.numSubmissionErrors += 1;
+        stream.set_close_callback(onClosed);
+        stream.connect((self.benchmark.host, self.benchmark.submitPort), onConnected);
+
+# ------------------------------- class Server Process Monitor ---------------------
+class ServerProcessMonitor(object):
+    '''
+    Reads the CPU time and resident memory of a process and its child
+    processes, such as the TreeWorkerPool's workers, from /proc.
+    '''
+
+    def __init__(self, pid):
+        self.pid = pid;
+        self.clockTicks = os.sysconf('SC_CLK_TCK');
+        self.pageSize = os.sysconf('SC_PAGE_SIZE');
+        self.startCPUSeconds = None;
+        self.startTime = None;
+        self.lastRSS = 0;
+        self.peakRSS = 0;
+        self.numProcesses = 0;
+
+    def getProcessIDs(self):
+        '''
+        Return the monitored process, and its children.
+        @rtype: [int]
+        '''
+        pids = [self.pid];
+        for entry in os.listdir('/proc'):
+            if entry.isdigit():
+                try:
+                    with open('/proc/%s/stat' % entry) as statFile:
+                        # The command name may contain blanks; the fields after it do not:
+                        fields = statFile.read().rsplit(')', 1)[1].split();
+                except (IOError, IndexError):
+                    continue;
+                if int(fields[1]) == self.pid:
+                    pids.append(int(entry));
+        return pids;
+
+    def getCPUSeconds(self):
+        '''
+        Return the CPU time used so far by the process, its children, and
+        its exited children.
+        @rtype: float
+        '''
+        cpuTicks = 0;
+        for pid in self.getProcessIDs():
+            try:
+                with open('/proc/%d/stat' % pid) as statFile:
+                    fields = statFile.read().rsplit(')', 1)[1].split();
+            except IOError:
+                continue;
+            # utime and stime, plus cutime and cstime for the server itself:
+            cpuTicks += int(fields[11]) + int(fields[12]);
+            if pid == self.pid:
+                cpuTicks += int(fields[13]) + int(fields[14]);
+        return float(cpuTicks) / self.clockTicks;
+
+    def sample(self):
+        rss = 0;
+        pids = self.getProcessIDs();
+        for pid in pids:
+            try:
+                with open('/proc/%d/statm' % pid) as statmFile:
+                    rss += int(statmFile.read().split()[1]) * self.pageSize;
+            except IOError:
+                continue;
+        self.lastRSS = rss;
+        self.peakRSS = max(self.peakRSS, rss);
+        self.numProcesses = len(pids);
+
+    def start(self):
+        self.startTime = time.time();
+        self.startCPUSeconds = self.getCPUSeconds();
+        self.sample();
+
+    def getReport(self):
+        '''
+        @return: CPU and memory use since start().
+        @rtype: {string : number}
+        '''
+        cpuSeconds = self.getCPUSeconds() - self.startCPUSeconds;
+        return {'pid'          : self.pid,
+                'processes'    : self.numProcesses,
+                'cpuSeconds'   : cpuSeconds,
+                'cpuPercent'   : 100.0 * cpuSeconds / max(time.time() - self.startTime, 0.001),
+                'rssBytes'     : self.lastRSS,
+                'peakRssBytes' : self.peakRSS
+                };
+
+# ------------------------------- class Server Benchmark ---------------------
+class ServerBenchmark(object):
+    '''
+    Runs one benchmark: connects the subscribers, runs the submitters for
+    the given duration, waits DRAIN_TIME for late trees, and reports.
+    '''
+
+    def __init__(self, words, host='localhost', port=ECHO_TREE_GET_PORT, submitPort=ECHO_TREE_NEW_ROOT_PORT,
+                 numSubscribers=100, numSubmitters=1, rate=1.0, numChannels=1, duration=10.0,
+                 submitVia='http', serverPid=None, logFD=sys.stderr):
+        '''
+        @param words: root words to submit. Use more words than submitters.
+        @type words: [string]
+        @param host: server host.
+        @type host: string
+        @param port: port of the subscription service.
+        @type port: int
+        @param submitPort: port to which HTTP submissions are posted.
+        @type submitPort: int
+        @param numSubscribers: number of websocket subscribers.
+        @type numSubscribers: int
+        @param numSubmitters: number of submitters.
+        @type numSubmitters: int
+        @param rate: submissions per second of each submitter.
+        @type rate: float
+        @param numChannels: subscribers and submitters are spread over this many channels.
+                            With one channel, DEFAULT_CHANNEL_ID is used.
+        @type numChannels: int
+        @param duration: seconds during which words are submitted.
+        @type duration: float
+        @param submitVia: 'http' or 'websocket'.
+        @type submitVia: string
+        @param serverPid: process whose CPU and memory use are reported, or None.
+        @type serverPid: {int | None}
+        @param logFD: file for progress reports. None for no reports.
+        @type logFD: file
+        '''
+        if len(words) == 0:
+            raise ValueError("No words to submit.");
+        if numSubscribers < 0 or numSubmitters <= 0 or numChannels <= 0 or rate <= 0 or duration <= 0:
+            raise ValueError("Numbers of submitters and channels, rate, and duration must be positive; number of subscribers must not be negative.");
+        if submitVia not in ('http', 'websocket'):
+            raise ValueError("Submissions are made via 'http' or 'websocket', not '%s'." % submitVia);
+        self.words = words;
+        self.host = host;
+        self.port = port;
+        self.submitPort = submitPort;
+        self.numSubscribers = numSubscribers;
+        self.numSubmitters = numSubmitters;
+        self.rate = rate;
+        self.submitInterval = 1.0 / rate;
+        self.numChannels = numChannels;
+        self.duration = duration;
+        self.submitVia = submitVia;
+        self.logFD = logFD;
+        self.serverMonitor = ServerProcessMonitor(serverPid) if serverPid is not None else None;
+        self.serverReport = None;
+        self.ioLoop = IOLoop();
+        self.subscribers = [];
+        self.submitters = [];
+        # channelId --> subscribers that record deliveries:
+        self.channelSubscribers = {};
+        # channelId --> number of open subscribers that record deliveries:
+        self.numOpenSubscribers = {};
+        self.latencies = [];
+        self.numSubmissions = 0;
+        self.numSubmissionErrors = 0;
+        self.numExpectedDeliveries = 0;
+        self.numUnmatchedMessages = 0;
+        self.numBytesReceived = 0;
+        self.numConnected = 0;
+        self.numConnectFailures = 0;
+        self.numDisconnects = 0;
+        self.started = False;
+        self.submitStartTime = None;
+        self.submitEndTime = None;
+
+    def log(self, msg):
+        if self.logFD is not None:
+            self.logFD.write(msg + '\n');
+            self.logFD.flush();
+
+    def getChannelId(self, index):
+        if self.numChannels == 1:
+            return DEFAULT_CHANNEL_ID;
+        return 'bench%d' % (index % self.numChannels);
+
+    def run(self):
+        '''
+        Run the benchmark to completion.
+        @return: the report.
+        @rtype: {string : object}
+        '''
+        self.log("Connecting %d subscribers to %s:%d..." % (self.numSubscribers, self.host, self.port));
+        self.subscribers = [BenchmarkSubscriber(self, self.getChannelId(i)) for i in range(self.numSubscribers)];
+        for subscriber in self.subscribers:
+            self.channelSubscribers.setdefault(subscriber.channelId, []).append(subscriber);
+        self.submitters = [BenchmarkSubmitter(self, i, self.getChannelId(i)) for i in range(self.numSubmitters)];
+        self.connectTimeout = self.ioLoop.add_timeout(time.time() + CONNECT_TIMEOUT, self.startSubmitting);
+        self.maybeStartSubmitting();
+        clientCPUStart = sum(os.times()[:2]);
+        self.ioLoop.start();
+        clientCPUSeconds = sum(os.times()[:2]) - clientCPUStart;
+        for subscriber in self.subscribers:
+            subscriber.close();
+        self.ioLoop.close(all_fds=True);
+        return self.makeReport(clientCPUSeconds);
+
+    def onSubscriberOpen(self, subscriber):
+        if subscriber.recordDeliveries:
+            self.numConnected += 1;
+            self.numOpenSubscribers[subscriber.channelId] = self.numOpenSubscribers.get(subscriber.channelId, 0) + 1;
+        self.maybeStartSubmitting();
+
+    def onSubscriberClosed(self, subscriber, wasOpen):
+        if not subscriber.recordDeliveries:
+            return;
+        if wasOpen:
+            self.numOpenSubscribers[subscriber.channelId] -= 1;
+            if self.started:
+                self.numDisconnects += 1;
+        elif not subscriber.wasOpen:
+            self.numConnectFailures += 1;
+        self.maybeStartSubmitting();
+
+    def maybeStartSubmitting(self):
+        numWebsocketSubmitters = len([submitter for submitter in self.submitters if submitter.websocket is not None and submitter.websocket.isOpen]);
+        if self.numConnected + self.numConnectFailures >= self.numSubscribers and \
+           numWebsocketSubmitters == (self.numSubmitters if self.submitVia == 'websocket' else 0):
+            self.startSubmitting();
+
+    def startSubmitting(self):
+        if self.started:
+            return;
+        self.started = True;
+        self.ioLoop.remove_timeout(self.connectTimeout);
+        self.log("%d subscribers connected, %d failed. Submitting for %.1f seconds..." % (self.numConnected, self.numConnectFailures, self.duration));
+        if self.serverMonitor is not None:
+            self.serverMonitor.start();
+            self.monitorCallback = PeriodicCallback(self.serverMonitor.sample, SERVER_SAMPLE_INTERVAL * 1000, io_loop=self.ioLoop);
+            self.monitorCallback.start();
+        self.submitStartTime = time.time();
+        for submitter in self.submitters:
+            submitter.start(self.submitStartTime);
+        self.ioLoop.add_timeout(self.submitStartTime + self.duration, self.stopSubmitting);
+
+    def stopSubmitting(self):
+        self.submitEndTime = time.time();
+        for submitter in self.submitters:
+            submitter.stop();
+        self.log("Submitted %d words. Waiting for late trees..." % self.numSubmissions);
+        self.ioLoop.add_timeout(self.submitEndTime + DRAIN_TIME, self.finish);
+
+    def finish(self):
+        if self.serverMonitor is not None:
+            self.monitorCallback.stop();
+            self.serverReport = self.serverMonitor.getReport();
+        self.ioLoop.stop();
+
+    def onSubmitted(self, channelId, word):
+        submitTime = time.time();
+        # Each subscriber pairs its trees of the word with these submissions in
+        # order, so that a resubmitted word's trees are not all timed from its 
+        # latest submission:
+        for subscriber in self.channelSubscribers.get(channelId, ()):
+            if subscriber.isOpen:
+                subscriber.submitTimes.setdefault(word, deque()).append(submitTime);
+        self.numSubmissions += 1;
+        self.numExpectedDeliveries += self.numOpenSubscribers.get(channelId, 0);
+
+    def onTreeDelivered(self, subscriber, rootWord, numBytes, receiveTime):
+        self.numBytesReceived += numBytes;
+        try:
+            self.latencies.append(receiveTime - subscriber.submitTimes[rootWord].popleft());
+        except (KeyError, IndexError):
+            # The channel's tree from before the benchmark, or an empty tree:
+            self.numUnmatchedMessages += 1;
+
+    def makeReport(self, clientCPUSeconds):
+        latencies = sorted(self.latencies);
+        submitSeconds = (self.submitEndTime or time.time()) - (self.submitStartTime or time.time());
+        return {'time'       : self.submitStartTime,
+                'config'     : {'host'           : self.host,
+                                'port'           : self.port,
+                                'submitPort'     : self.submitPort,
+                                'submitVia'      : self.submitVia,
+                                'numSubscribers' : self.numSubscribers,
+                                'numSubmitters'  : self.numSubmitters,
+                                'numChannels'    : self.numChannels,
+                                'ratePerSubmitter' : self.rate,
+                                'durationSeconds'  : self.duration,
+                                'numWords'       : len(self.words)
+                                },
+                'subscribers' : {'connected'      : self.numConnected,
+                                 'connectFailures': self.numConnectFailures,
+                                 'disconnects'    : self.numDisconnects
+                                 },
+                'submissions'         : self.numSubmissions,
+                'submissionErrors'    : self.numSubmissionErrors,
+                'deliveries'          : len(latencies),
+                'expectedDeliveries'  : self.numExpectedDeliveries,
+                'unmatchedMessages'   : self.numUnmatchedMessages,
+                'bytesReceived'       : self.numBytesReceived,
+                'throughput'  : {'submissionsPerSecond' : self.numSubmissions / max(submitSeconds, 0.001),
+                                 'deliveriesPerSecond'  : len(latencies) / max(submitSeconds, 0.001)
+                                 },
+                'latencySeconds' : {'mean' : sum(latencies) / len(latencies) if len(latencies) > 0 else None,
+                                    'p50'  : getPercentile(latencies, 0.5),
+                                    'p90'  : getPercentile(latencies, 0.9),
+                                    'p99'  : getPercentile(latencies, 0.99),
+                                    'max'  : latencies[-1] if len(latencies) > 0 else None
+                                    },
+                'client'      : {'cpuSeconds' : clientCPUSeconds},
+                'server'      : self.serverReport
+                };
+
+def getTopWords(dbPath, numWords):
+    '''
+    Return the most frequent words of a database, by metaTotalOcc.
+    @rtype: [string]
+    '''
+    conn = sqlite3.connect(dbPath);
+    try:
+        return [row[0].encode('utf-8') for row in conn.execute('SELECT word FROM EnronWords WHERE metaTotalOcc IS NOT NULL ORDER BY metaTotalOcc*1 DESC LIMIT ?;',
+                                                                (numWords,))];
+    finally:
+        conn.close();
+
+def startServer(serverArgs, port, logFile):
+    '''
+    Start echo_tree_server.py with the given arguments, and wait until it accepts connections.
+    @return: the server process.
+    @rtype: subprocess.Popen
+    @raise IOError: if the server does not accept connections within SERVER_START_TIMEOUT seconds.
+    '''
+    serverPath = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'echo_tree_server.py');
+    server = subprocess.Popen([sys.executable, serverPath] + shlex.split(serverArgs),
+                              cwd=os.path.dirname(serverPath), stdout=logFile, stderr=subprocess.STDOUT);
+    deadline = time.time() + SERVER_START_TIMEOUT;
+    while time.time() < deadline and server.poll() is None:
+        try:
+            socket.create_connection(('localhost', port), 1.0).close();
+            return server;
+        except socket.error:
+            time.sleep(0.2);
+    stopServer(server);
+    raise IOError("Server did not accept connections on port %d." % port);
+
+def stopServer(server):
+    if server.poll() is not None:
+        return;
+    # The server shuts down cleanly on KeyboardInterrupt:
+    server.send_signal(signal.SIGINT);
+    deadline = time.time() + 10;
+    while server.poll() is None and time.time() < deadline:
+        time.sleep(0.1);
+    if server.poll() is None:
+        server.kill();
+        server.wait();
+
+def getServerStats(host, port):
+    '''
+    @return: the server's STATS_URI_PATH metrics, or None if they cannot be fetched.
+    @rtype: {dict | None}
+    '''
+    try:
+        return json.load(urllib2.urlopen('http://%s:%d%s' % (host, port, STATS_URI_PATH), timeout=5));
+    except (urllib2.URLError, socket.error, ValueError):
+        return None;
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(prog='server_benchmark');
+    parser.add_argument("-n", "--subscribers", type=int, default=100, dest='numSubscribers',
+                        help="number of websocket subscribers. Default: 100.");
+    parser.add_argument("-m", "--submitters", type=int, default=1, dest='numSubmitters',
+                        help="number of root word submitters. Default: 1.");
+    parser.add_argument("-r", "--rate", type=float, default=1.0, dest='rate',
+                        help="submissions per second of each submitter. Default: 1.");
+    parser.add_argument("-c", "--channels", type=int, default=1, dest='numChannels',
+                        help="number of channels over which subscribers and submitters are spread. Default: 1.");
+    parser.add_argument("-t", "--duration", type=float, default=10.0, dest='duration',
+                        help="seconds during which words are submitted. Default: 10.");
+    parser.add_argument("-s", "--submitVia", choices=('http', 'websocket'), default='http', dest='submitVia',
+                        help="submit root words via HTTP POST to the submission port, or as websocket messages. Default: http.");
+    parser.add_argument("-H", "--host", default='localhost', dest='host',
+                        help="server host. Default: localhost.");
+    parser.add_argument("-p", "--port", type=int, default=ECHO_TREE_GET_PORT, dest='port',
+                        help="subscription port. Default: %d." % ECHO_TREE_GET_PORT);
+    parser.add_argument("-q", "--submitPort", type=int, default=ECHO_TREE_NEW_ROOT_PORT, dest='submitPort',
+                        help="port for HTTP submissions. Use the subscription port for servers started with -e. Default: %d." % ECHO_TREE_NEW_ROOT_PORT);
+    parser.add_argument("-d", "--db", default=DBPATH, dest='dbFile',
+                        help="database whose most frequent words are submitted. Default: %s." % DBPATH);
+    parser.add_argument("-w", "--words", dest='wordFile',
+                        help="file with one root word per line to submit, instead of words from the database.");
+    parser.add_argument("-x", "--serverArgs", dest='serverArgs',
+                        help="start echo_tree_server.py on this host with these arguments for the benchmark, given as -x='-w 2 -e'.");
+    parser.add_argument("-l", "--serverLog", dest='serverLog',
+                        help="file for the output of a server started with -x. Default: discarded.");
+    parser.add_argument("-i", "--serverPid", type=int, dest='serverPid',
+                        help="pid of a running server whose CPU and memory use are reported.");
+    parser.add_argument("-o", "--output", dest='outputFile',
+                        help="file for the JSON report. Default: stdout.");
+
+    args = parser.parse_args();
+    if args.wordFile is not None:
+        with open(args.wordFile) as wordFile:
+            words = [line.strip() for line in wordFile if len(line.strip()) > 0];
+    else:
+        words = getTopWords(args.dbFile, DEFAULT_NUM_WORDS);
+
+    server = None;
+    serverPid = args.serverPid;
+    if args.serverArgs is not None:
+        serverLog = open(args.serverLog, 'w') if args.serverLog is not None else open(os.devnull, 'w');
+        server = startServer(args.serverArgs, args.port, serverLog);
+        serverPid = server.pid;
+    try:
+        benchmark = ServerBenchmark(words, host=args.host, port=args.port, submitPort=args.submitPort,
+                                    numSubscribers=args.numSubscribers, numSubmitters=args.numSubmitters,
+                                    rate=args.rate, numChannels=args.numChannels, duration=args.duration,
+                                    submitVia=args.submitVia, serverPid=serverPid);
+        report = benchmark.run();
+        report['serverStats'] = getServerStats(args.host, args.port);
+    finally:
+        if server is not None:
+            stopServer(server);
+    reportJSON = json.dumps(report, indent=2, sort_keys=True);
+    if args.outputFile is not None:
+        with open(args.outputFile, 'w') as outputFile:
+            outputFile.write(reportJSON + '\n');
+    else:
+        print reportJSON;
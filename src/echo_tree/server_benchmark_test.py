@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+
+'''
+Tests of the bookkeeping of server_benchmark.py, without a server.
+'''
+
+import json;
+import unittest;
+
+from server_benchmark import ServerBenchmark, getPercentile, getRootWord;
+
+class FakeSubscriber(object):
+    '''
+    Stands in for a BenchmarkSubscriber whose connection is open.
+    '''
+    def __init__(self, channelId):
+        self.channelId = channelId;
+        self.recordDeliveries = True;
+        self.isOpen = True;
+        self.submitTimes = {};
+
+class ServerBenchmarkTest(unittest.TestCase):
+
+    def setUp(self):
+        self.benchmark = ServerBenchmark(['the', 'cat'], numChannels=2, logFD=None);
+
+    def tearDown(self):
+        self.benchmark.ioLoop.close();
+
+    def addSubscriber(self, channelId):
+        subscriber = FakeSubscriber(channelId);
+        self.benchmark.channelSubscribers.setdefault(channelId, []).append(subscriber);
+        self.benchmark.onSubscriberOpen(subscriber);
+        return subscriber;
+
+    def test_resubmitted_word_is_timed_from_each_submission(self):
+        subscribers = [self.addSubscriber('bench0'), self.addSubscriber('bench0')];
+        otherSubscriber = self.addSubscriber('bench1');
+        self.benchmark.onSubmitted('bench0', 'the');
+        self.benchmark.onSubmitted('bench0', 'the');
+        submitTimes = list(subscribers[0].submitTimes['the']);
+        self.assertEqual(otherSubscriber.submitTimes, {});
+        receiveTime = submitTimes[1] + 1.0;
+        for subscriber in subscribers:
+            self.benchmark.onTreeDelivered(subscriber, 'the', 100, receiveTime);
+            self.benchmark.onTreeDelivered(subscriber, 'the', 100, receiveTime);
+        self.assertEqual(self.benchmark.latencies, [receiveTime - submitTimes[0], receiveTime - submitTimes[1]] * 2);
+        # More trees than submissions, and trees of other words, are not matched:
+        self.benchmark.onTreeDelivered(subscribers[0], 'the', 100, receiveTime);
+        self.benchmark.onTreeDelivered(otherSubscriber, 'cat', 100, receiveTime);
+        self.assertEqual(self.benchmark.numUnmatchedMessages, 2);
+        self.assertEqual(self.benchmark.numExpectedDeliveries, 4);
+
+    def test_report(self):
+        subscriber = self.addSubscriber('bench0');
+        self.benchmark.onSubmitted('bench0', 'the');
+        self.benchmark.onSubmitted('bench0', 'cat');
+        submitTime = subscriber.submitTimes['the'][0];
+        self.benchmark.onTreeDelivered(subscriber, 'the', 100, submitTime + 0.5);
+        self.benchmark.onTreeDelivered(subscriber, 'cat', 50, subscriber.submitTimes['cat'][0] + 1.5);
+        report = self.benchmark.makeReport(2.0);
+        # Written to the report file as JSON:
+        json.dumps(report);
+        self.assertEqual((report['submissions'], report['deliveries'], report['expectedDeliveries']), (2, 2, 2));
+        self.assertEqual(report['bytesReceived'], 150);
+        self.assertEqual(report['config']['numChannels'], 2);
+        self.assertEqual(report['config']['numWords'], 2);
+        self.assertEqual(report['client'], {'cpuSeconds' : 2.0});
+        latency = report['latencySeconds'];
+        self.assertAlmostEqual(latency['mean'], 1.0);
+        self.assertAlmostEqual(latency['p50'], 0.5);
+        self.assertAlmostEqual(latency['p99'], 1.5);
+        self.assertAlmostEqual(latency['max'], 1.5);
+
+    def test_report_without_deliveries(self):
+        report = self.benchmark.makeReport(0.0);
+        self.assertEqual(report['deliveries'], 0);
+        self.assertEqual(report['latencySeconds'], {'mean' : None, 'p50' : None, 'p90' : None, 'p99' : None, 'max' : None});
+
+class PercentileTest(unittest.TestCase):
+
+    def test_nearest_rank(self):
+        values = range(1, 101);
+        self.assertEqual([getPercentile(values, fraction) for fraction in (0.0, 0.5, 0.9, 0.99, 1.0)], [1, 50, 90, 99, 100]);
+        self.assertEqual(getPercentile([3.0], 0.99), 3.0);
+        self.assertEqual(getPercentile([1, 2], 0.5), 1);
+        self.assertEqual(getPercentile([], 0.5), None);
+
+class RootWordTest(unittest.TestCase):
+
+    def test_root_word(self):
+        self.assertEqual(getRootWord('{"word": "the", "followWordObjs": []}'), 'the');
+        self.assertEqual(getRootWord('{"word":"caf\\u00e9"}'), 'caf\xc3\xa9');
+        self.assertEqual(getRootWord(''), None);
+
+if __name__ == '__main__':
+    unittest.main();
@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+
+'''
+Cheap metrics for long running servers: counters, fixed-bucket
+histograms, and gauges that are read only when the metrics are
+requested. Everything can be reported as JSON, or in the Prometheus
+text exposition format.
+
+Updates take no locks. They are meant to happen on one IOLoop;
+increments from other threads may, rarely, lose a count.
+'''
+
+import re;
+import time;
+import bisect;
+from collections import OrderedDict;
+
+# Upper bounds, in seconds, of the buckets of latency histograms:
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0);
+
+# Seconds between two IOLoop lag measurements:
+IOLOOP_LAG_CHECK_INTERVAL = 0.5;
+
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8';
+
+# ------------------------------- class Histogram ---------------------
+class Histogram(object):
+    '''
+    Counts observed values in fixed buckets, and keeps their
+    count, sum, and maximum.
+    '''
+
+    def __init__(self, name, helpText, bounds=LATENCY_BUCKETS):
+        '''
+        @param name: metric name, without the ServerStats prefix.
+        @type name: string
+        @param helpText: one line description.
+        @type helpText: string
+        @param bounds: increasing upper bounds of the buckets. Values
+                       above the last bound are counted in an extra bucket.
+        @type bounds: (float)
+        '''
+        self.name = name;
+        self.helpText = helpText;
+        self.bounds = tuple(bounds);
+        self.bucketCounts = [0] * (len(self.bounds) + 1);
+        self.count = 0;
+        self.sum = 0.0;
+        self.max = 0.0;
+
+    def observe(self, value):
+        self.bucketCounts[bisect.bisect_left(self.bounds, value)] += 1;
+        self.count += 1;
+        self.sum += value;
+        if value > self.max:
+            self.max = value;
+
+    def getStats(self):
+        '''
+        @return: count, sum, max, mean, and the cumulative counts of the buckets.
+        @rtype: {string : {number | [(string, int)]}}
+        '''
+        return {'count'   : self.count,
+                'sum'     : self.sum,
+                'max'     : self.max,
+                'mean'    : self.sum / self.count if self.count > 0 else 0.0,
+                'buckets' : self.getCumulativeCounts()
+                };
+
+    def getCumulativeCounts(self):
+        '''
+        @return: (upper bound, number of values at or below it) for each bucket.
+                 The last bound is '+Inf'.
+        @rtype: [(string, int)]
+        '''
+        cumulativeCounts = [];
+        numValues = 0;
+        for (bound, bucketCount) in zip(self.bounds + ('+Inf',), self.bucketCounts):
+            numValues += bucketCount;
+            cumulativeCounts.append((str(bound), numValues));
+        return cumulativeCounts;
+
+# ------------------------------- class IOLoop Lag Monitor ---------------------
+class IOLoopLagMonitor(object):
+    '''
+    Measures how late an IOLoop runs timeouts: a timeout is scheduled every
+    interval seconds, and the delay between its due time and the time it runs
+    is recorded. Long running callbacks on the loop show up as lag.
+    '''
+
+    def __init__(self, ioLoop, histogram, interval=IOLOOP_LAG_CHECK_INTERVAL):
+        '''
+        @param ioLoop: the loop to watch.
+        @type ioLoop: IOLoop
+        @param histogram: histogram that receives the measured lags.
+        @type histogram: Histogram
+        @param interval: seconds between measurements.
+        @type interval: float
+        '''
+        self.ioLoop = ioLoop;
+        self.histogram = histogram;
+        self.interval = interval;
+        self.lastLag = 0.0;
+        self.dueTime = None;
+        self.timeout = None;
+
+    def start(self):
+        self.scheduleCheck();
+
+    def stop(self):
+        if self.timeout is not None:
+            self.ioLoop.remove_timeout(self.timeout);
+            self.timeout = None;
+
+    def scheduleCheck(self):
+        self.dueTime = time.time() + self.interval;
+        self.timeout = self.ioLoop.add_timeout(self.dueTime, self.check);
+
+    def check(self):
+        self.lastLag = max(time.time() - self.dueTime, 0.0);
+        self.histogram.observe(self.lastLag);
+        self.scheduleCheck();
+
+# ------------------------------- class Server Stats ---------------------
+class ServerStats(object):
+    '''
+    Registry of a server's counters, histograms, and gauge sources.
+    Gauge sources are functions called when the stats are requested. Each
+    returns a list of (name, helpText, labelName, samples), where samples
+    is a list of (labelValue, value). For unlabeled gauges labelName is None,
+    and the single sample's labelValue is None.
+    '''
+
+    def __init__(self, prefix=''):
+        '''
+        @param prefix: prepended to all metric names in the Prometheus format.
+        @type prefix: string
+        '''
+        self.prefix = prefix;
+        self.counters = OrderedDict();
+        self.counterHelp = {};
+        self.histograms = OrderedDict();
+        self.gaugeSources = [];
+
+    def addCounter(self, name, helpText):
+        self.counters[name] = 0;
+        self.counterHelp[name] = helpText;
+
+    def increment(self, name, amount=1):
+        self.counters[name] += amount;
+
+    def addHistogram(self, name, helpText, bounds=LATENCY_BUCKETS):
+        '''
+        @return: the new histogram; callers keep it, and call its observe() method.
+        @rtype: Histogram
+        '''
+        histogram = Histogram(name, helpText, bounds);
+        self.histograms[name] = histogram;
+        return histogram;
+
+    def addGaugeSource(self, gaugeFunc):
+        self.gaugeSources.append(gaugeFunc);
+
+    def getGauges(self):
+        gauges = [];
+        for gaugeFunc in self.gaugeSources:
+            gauges.extend(gaugeFunc());
+        return gauges;
+
+    def getStats(self):
+        '''
+        Return all metrics in a form suitable for json.dumps(). Labeled
+        gauges become dicts from label value to value.
+        @rtype: {string : {string : object}}
+        '''
+        gauges = OrderedDict();
+        for (name, dummyHelpText, labelName, samples) in self.getGauges():
+            if labelName is None:
+                gauges[name] = samples[0][1];
+            else:
+                gauges[name] = OrderedDict(samples);
+        return {'time'       : time.time(),
+                'counters'   : self.counters,
+                'histograms' : OrderedDict([(name, histogram.getStats()) for (name, histogram) in self.histograms.items()]),
+                'gauges'     : gauges
+                };
+
+    def toPrometheus(self):
+        '''
+        Return all metrics in the Prometheus text exposition format.
+        @rtype: string
+        '''
+        lines = [];
+        for (name, value) in self.counters.items():
+            metricName = self.makeMetricName(name) + '_total';
+            lines.append('# HELP %s %s' % (metricName, self.counterHelp[name]));
+            lines.append('# TYPE %s counter' % metricName);
+            lines.append('%s %s' % (metricName, value));
+        for histogram in self.histograms.values():
+            metricName = self.makeMetricName(histogram.name);
+            lines.append('# HELP %s %s' % (metricName, histogram.helpText));
+            lines.append('# TYPE %s histogram' % metricName);
+            for (bound, numValues) in histogram.getCumulativeCounts():
+                lines.append('%s_bucket{le="%s"} %d' % (metricName, bound, numValues));
+            lines.append('%s_sum %s' % (metricName, histogram.sum));
+            lines.append('%s_count %d' % (metricName, histogram.count));
+        for (name, helpText, labelName, samples) in self.getGauges():
+            metricName = self.makeMetricName(name);
+            lines.append('# HELP %s %s' % (metricName, helpText));
+            lines.append('# TYPE %s gauge' % metricName);
+            for (labelValue, value) in samples:
+                if labelName is None:
+                    lines.append('%s %s' % (metricName, value));
+                else:
+                    lines.append('%s{%s="%s"} %s' % (metricName, labelName, self.escapeLabelValue(labelValue), value));
+        return '\n'.join(lines) + '\n';
+
+    def makeMetricName(self, name):
+        '''
+        Prefix a name, and turn camelCase into snake_case as Prometheus prefers.
+        '''
+        return self.prefix + re.sub(r'([a-z0-9])([A-Z])', r'\1_\2', name).lower();
+
+    @staticmethod
+    def escapeLabelValue(labelValue):
+        return str(labelValue).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n');
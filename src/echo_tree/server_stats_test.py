@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+
+'''
+Tests of the histograms, registry, and report formats of server_stats.py.
+'''
+
+import time;
+import unittest;
+
+from tornado.ioloop import IOLoop;
+
+from server_stats import Histogram, ServerStats, IOLoopLagMonitor;
+
+class HistogramTest(unittest.TestCase):
+
+    def test_buckets(self):
+        histogram = Histogram('latency', 'Latency.', bounds=(0.1, 1.0));
+        for value in (0.05, 0.1, 0.5, 1.0, 3.0):
+            histogram.observe(value);
+        # Bounds are inclusive, and counts cumulative:
+        self.assertEqual(histogram.getCumulativeCounts(), [('0.1', 2), ('1.0', 4), ('+Inf', 5)]);
+        stats = histogram.getStats();
+        self.assertEqual((stats['count'], stats['max']), (5, 3.0));
+        self.assertAlmostEqual(stats['sum'], 4.65);
+        self.assertAlmostEqual(stats['mean'], 0.93);
+
+    def test_empty(self):
+        stats = Histogram('latency', 'Latency.').getStats();
+        self.assertEqual((stats['count'], stats['mean'], stats['buckets'][-1]), (0, 0.0, ('+Inf', 0)));
+
+class ServerStatsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.stats = ServerStats(prefix='test_');
+        self.stats.addCounter('treesSent', 'Trees sent.');
+        self.latency = self.stats.addHistogram('fanOutSeconds', 'Fan out time.', bounds=(0.5,));
+        self.stats.addGaugeSource(lambda: [('channels', 'Channels.', None, [(None, 2)]),
+                                           ('subscribers', 'Subscribers.', 'channel', [('a', 3), ('say "hi"\\', 1)])]);
+
+    def test_json(self):
+        self.stats.increment('treesSent', 4);
+        self.latency.observe(0.25);
+        stats = self.stats.getStats();
+        self.assertEqual(dict(stats['counters']), {'treesSent' : 4});
+        self.assertEqual(stats['histograms']['fanOutSeconds']['buckets'], [('0.5', 1), ('+Inf', 1)]);
+        self.assertEqual(stats['gauges']['channels'], 2);
+        self.assertEqual(dict(stats['gauges']['subscribers']), {'a' : 3, 'say "hi"\\' : 1});
+
+    def test_prometheus(self):
+        self.stats.increment('treesSent');
+        self.latency.observe(1.0);
+        self.assertEqual(self.stats.toPrometheus().split('\n'),
+                         ['# HELP test_trees_sent_total Trees sent.',
+                          '# TYPE test_trees_sent_total counter',
+                          'test_trees_sent_total 1',
+                          '# HELP test_fan_out_seconds Fan out time.',
+                          '# TYPE test_fan_out_seconds histogram',
+                          'test_fan_out_seconds_bucket{le="0.5"} 0',
+                          'test_fan_out_seconds_bucket{le="+Inf"} 1',
+                          'test_fan_out_seconds_sum 1.0',
+                          'test_fan_out_seconds_count 1',
+                          '# HELP test_channels Channels.',
+                          '# TYPE test_channels gauge',
+                          'test_channels 2',
+                          '# HELP test_subscribers Subscribers.',
+                          '# TYPE test_subscribers gauge',
+                          'test_subscribers{channel="a"} 3',
+                          'test_subscribers{channel="say \\"hi\\"\\\\"} 1',
+                          '']);
+
+class IOLoopLagMonitorTest(unittest.TestCase):
+
+    def test_measures_lag(self):
+        ioLoop = IOLoop();
+        histogram = Histogram('lag', 'Lag.');
+        monitor = IOLoopLagMonitor(ioLoop, histogram, interval=0.01);
+        monitor.start();
+        # Keeps the loop busy past the first check's due time:
+        ioLoop.add_callback(lambda: time.sleep(0.05));
+        ioLoop.add_timeout(time.time() + 0.1, ioLoop.stop);
+        ioLoop.start();
+        monitor.stop();
+        ioLoop.close();
+        self.assertTrue(histogram.count >= 2);
+        self.assertTrue(histogram.max >= 0.03);
+
+if __name__ == '__main__':
+    unittest.main();
@@ -0,0 +1,279 @@
+from __future__ import absolute_import, division, with_statement
+from tornado.iostream import IOStream
+from tornado.testing import AsyncHTTPTestCase, LogTrapTestCase
+from tornado.util import b
+from tornado.web import Application
+from tornado.websocket import WebSocketHandler, WebSocketProtocol13, \
+    BroadcastMessage
+import socket
+import struct
+import unittest
+import zlib
+
+
+class EchoHandler(WebSocketHandler):
+    def initialize(self, compression_options, messages):
+        self.compression_options = compression_options
+        self.messages = messages
+
+    def get_compression_options(self):
+        return self.compression_options
+
+    def on_message(self, message):
+        self.messages.append(message)
+        self.write_message(message)
+
+
+class FakeHandler(object):
+    """Stands in for a WebSocketHandler where no connection is needed."""
+    def __init__(self):
+        self.request = None
+        self.stream = None
+        self.ws_connection = None
+
+
+def negotiate(offer, compression_options):
+    handler = FakeHandler()
+    connection = handler.ws_connection = WebSocketProtocol13(handler)
+    return connection, connection._negotiate_deflate(offer,
+                                                      compression_options)
+
+
+def deflate(compressor, data):
+    data = compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    return data[:-4]
+
+
+def inflate(decompressor, data):
+    return decompressor.decompress(data + b("\x00\x00\xff\xff"))
+
+
+class NegotiateDeflateTest(unittest.TestCase):
+    def test_defaults(self):
+        connection, response = negotiate("permessage-deflate", {})
+        self.assertEqual(response,
+                         "permessage-deflate; server_no_context_takeover")
+        # Messages are compressed on their own, so they can be shared:
+        self.assertTrue(connection._broadcast_key() is not None)
+        self.assertTrue(connection._decompressor._decompressor is not None)
+
+    def test_context_takeover(self):
+        connection, response = negotiate(" permessage-deflate ",
+                                         {"context_takeover": True})
+        self.assertEqual(response, "permessage-deflate")
+        self.assertEqual(connection._broadcast_key(), None)
+
+    def test_no_context_takeover(self):
+        connection, response = negotiate(
+            "permessage-deflate; server_no_context_takeover; "
+            "client_no_context_takeover", {"context_takeover": True})
+        self.assertEqual(response, "permessage-deflate; "
+                         "server_no_context_takeover; "
+                         "client_no_context_takeover")
+        self.assertTrue(connection._broadcast_key() is not None)
+        self.assertEqual(connection._decompressor._decompressor, None)
+
+    def test_server_max_window_bits(self):
+        connection, response = negotiate(
+            'permessage-deflate; server_max_window_bits="10"', {})
+        self.assertEqual(response, "permessage-deflate; "
+                         "server_max_window_bits=10; "
+                         "server_no_context_takeover")
+        self.assertEqual(connection._compressor._max_wbits, 10)
+
+    def test_rejected_offers(self):
+        for offer in ("permessage-deflate; server_max_window_bits=8",
+                      "permessage-deflate; server_max_window_bits=16",
+                      "permessage-deflate; server_max_window_bits=x",
+                      "permessage-deflate; unknown_param",
+                      "x-webkit-deflate-frame"):
+            connection, response = negotiate(offer, {})
+            self.assertEqual(response, None, offer)
+            self.assertEqual(connection._compressor, None)
+            self.assertEqual(connection._decompressor, None)
+
+
+class BroadcastMessageTest(unittest.TestCase):
+    def make_handler(self, compression_options):
+        handler = FakeHandler()
+        connection = handler.ws_connection = WebSocketProtocol13(handler)
+        if compression_options is not None:
+            connection._negotiate_deflate("permessage-deflate",
+                                          compression_options)
+        encode = connection._encode_for_connection
+        handler.num_encodings = 0
+
+        def counting_encode(*args, **kwargs):
+            handler.num_encodings += 1
+            return encode(*args, **kwargs)
+        connection._encode_for_connection = counting_encode
+        return handler
+
+    def test_encoded_once_per_key(self):
+        handlers = [self.make_handler(options) for options in
+                    (None, None, {}, {}, {"compression_level": 1})]
+        message = BroadcastMessage("hello " * 100)
+        frames = [message.encode_for(handler) for handler in handlers]
+        self.assertTrue(frames[0] is frames[1])
+        self.assertTrue(frames[2] is frames[3])
+        self.assertFalse(frames[2] is frames[4])
+        self.assertEqual([handler.num_encodings for handler in handlers],
+                         [1, 0, 1, 0, 1])
+        decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        # A two byte frame header, then the compressed payload:
+        self.assertEqual(inflate(decompressor, frames[2][2:]), "hello " * 100)
+
+    def test_encoded_per_connection_with_context_takeover(self):
+        handlers = [self.make_handler({"context_takeover": True})
+                    for i in range(2)]
+        for text in ("first " * 10, "second " * 10):
+            message = BroadcastMessage(text)
+            frames = [message.encode_for(handler) for handler in handlers]
+            self.assertFalse(frames[0] is frames[1])
+            self.assertEqual(frames[0], frames[1])
+        self.assertEqual([handler.num_encodings for handler in handlers],
+                         [2, 2])
+
+    def test_closed_connection(self):
+        handler = FakeHandler()
+        self.assertEqual(BroadcastMessage("hello").encode_for(handler), None)
+
+
+class WebSocketDeflateTest(AsyncHTTPTestCase, LogTrapTestCase):
+    def setUp(self):
+        self.compression_options = {}
+        self.messages = []
+        super(WebSocketDeflateTest, self).setUp()
+
+    def get_app(self):
+        return Application([("/echo", EchoHandler,
+                             dict(compression_options=self.compression_options,
+                                  messages=self.messages))])
+
+    def connect(self, extensions="permessage-deflate"):
+        """Opens a connection, and returns its stream and handshake response.
+        """
+        stream = IOStream(socket.socket(), io_loop=self.io_loop)
+        stream.connect(("localhost", self.get_http_port()), self.stop)
+        self.wait()
+        stream.write(b("GET /echo HTTP/1.1\r\n"
+                       "Host: localhost\r\n"
+                       "Upgrade: websocket\r\n"
+                       "Connection: Upgrade\r\n"
+                       "Sec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\n"
+                       "Sec-WebSocket-Version: 13\r\n"
+                       "Sec-WebSocket-Extensions: %s\r\n\r\n" % extensions))
+        stream.read_until(b("\r\n\r\n"), self.stop)
+        response = self.wait()
+        self.assertTrue(response.startswith(b("HTTP/1.1 101")))
+        return stream, response
+
+    def write_frame(self, stream, opcode, data, fin=True, rsv=0):
+        mask = b("abcd")
+        masked = "".join(chr(ord(c) ^ ord(mask[i % 4]))
+                         for i, c in enumerate(data))
+        header = struct.pack("BB", (0x80 if fin else 0) | rsv | opcode,
+                             0x80 | len(data))
+        assert len(data) < 126
+        stream.write(header + mask + masked)
+
+    def read_frame(self, stream):
+        """Returns the first header byte and the payload of the next frame.
+        """
+        stream.read_bytes(2, self.stop)
+        header, length = struct.unpack("BB", self.wait())
+        if length == 126:
+            stream.read_bytes(2, self.stop)
+            length = struct.unpack("!H", self.wait())[0]
+        stream.read_bytes(length, self.stop)
+        return header, self.wait()
+
+    def assert_aborted(self, stream):
+        stream.read_until_close(self.stop)
+        self.wait()
+        self.assertTrue(stream.closed())
+
+    def test_round_trips(self):
+        stream, response = self.connect()
+        self.assertTrue(b("Sec-WebSocket-Extensions: permessage-deflate; "
+                          "server_no_context_takeover") in response)
+        # The client keeps its context; the server does not:
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+        for text in ("hello hello hello", "hello hello hello"):
+            self.write_frame(stream, 0x1, deflate(compressor, text),
+                             rsv=0x40)
+            header, payload = self.read_frame(stream)
+            self.assertEqual(header, 0x80 | 0x40 | 0x1)
+            decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+            self.assertEqual(inflate(decompressor, payload), text)
+        self.assertEqual(self.messages, ["hello hello hello"] * 2)
+        stream.close()
+
+    def test_round_trips_with_context_takeover(self):
+        self.compression_options["context_takeover"] = True
+        stream, response = self.connect(
+            "permessage-deflate; client_no_context_takeover")
+        self.assertTrue(b("Sec-WebSocket-Extensions: permessage-deflate; "
+                          "client_no_context_takeover\r\n") in response)
+        decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        payloads = []
+        for text in ("hello hello hello", "hello hello hello"):
+            compressor = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+            self.write_frame(stream, 0x1, deflate(compressor, text),
+                             rsv=0x40)
+            header, payload = self.read_frame(stream)
+            self.assertEqual(inflate(decompressor, payload), text)
+            payloads.append(payload)
+        # The second reply refers back to the first:
+        self.assertTrue(len(payloads[1]) < len(payloads[0]))
+        stream.close()
+
+    def test_rejected_window_bits_offer(self):
+        stream, response = self.connect(
+            "permessage-deflate; server_max_window_bits=8")
+        self.assertFalse(b("Sec-WebSocket-Extensions") in response)
+        self.write_frame(stream, 0x1, "hello")
+        self.assertEqual(self.read_frame(stream), (0x81, b("hello")))
+        # Without the extension, compressed frames are not allowed:
+        self.write_frame(stream, 0x1, "hello", rsv=0x40)
+        self.assert_aborted(stream)
+
+    def test_rsv1_on_control_frame(self):
+        stream, response = self.connect()
+        self.write_frame(stream, 0x9, "ping")
+        self.assertEqual(self.read_frame(stream), (0x8A, b("ping")))
+        self.write_frame(stream, 0x9, "ping", rsv=0x40)
+        self.assert_aborted(stream)
+
+    def test_rsv1_on_continuation_frame(self):
+        stream, response = self.connect()
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+        data = deflate(compressor, "hello hello hello")
+        self.write_frame(stream, 0x1, data[:3], fin=False, rsv=0x40)
+        self.write_frame(stream, 0x0, data[3:], rsv=0x40)
+        self.assert_aborted(stream)
+        self.assertEqual(self.messages, [])
+
+    def test_fragmented_compressed_message(self):
+        stream, response = self.connect()
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+        data = deflate(compressor, "hello hello hello")
+        self.write_frame(stream, 0x1, data[:3], fin=False, rsv=0x40)
+        self.write_frame(stream, 0x0, data[3:])
+        self.read_frame(stream)
+        self.assertEqual(self.messages, ["hello hello hello"])
+        stream.close()
+
+    def test_max_message_size(self):
+        self.compression_options["max_message_size"] = 100
+        stream, response = self.connect(
+            "permessage-deflate; client_no_context_takeover")
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+        self.write_frame(stream, 0x1, deflate(compressor, "a" * 100),
+                         rsv=0x40)
+        self.read_frame(stream)
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+        self.write_frame(stream, 0x1, deflate(compressor, "a" * 101),
+                         rsv=0x40)
+        self.assert_aborted(stream)
+        self.assertEqual(self.messages, ["a" * 100])
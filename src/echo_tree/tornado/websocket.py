@@ -27,11 +27,15 @@ import logging
 import struct
 import time
 import base64
+import zlib
 import tornado.escape
 import tornado.web
 
 from tornado.util import bytes_type, b
 
+# Default limit for the decompressed size of incoming compressed messages:
+_DEFAULT_MAX_MESSAGE_SIZE = 10 * 1024 * 1024
+
 
 class WebSocketHandler(tornado.web.RequestHandler):
     """Subclass this class to create a basic WebSocket handler.
@@ -156,6 +160,29 @@ class WebSocketHandler(tornado.web.RequestHandler):
         """
         return None
 
+    def get_compression_options(self):
+        """Override to enable the permessage-deflate extension (RFC 7692)
+        on connections whose client offers it.
+
+        Return None (the default) to disable compression, or a dict
+        with any of these keys:
+
+        * ``compression_level``: zlib level for outgoing messages (default 6)
+        * ``mem_level``: zlib memory level for outgoing messages (default 8)
+        * ``context_takeover``: if False (the default), each outgoing
+          message is compressed on its own.  If True, the compression
+          context is kept between messages, which compresses similar
+          messages better but costs a compressor per connection.
+        * ``max_message_size``: largest size, in bytes, to which an
+          incoming message may decompress (default 10MB).  Connections
+          that send larger messages are aborted.
+
+        Without context takeover, `broadcast_message` compresses a
+        message only once for all connections that use the same options.
+        Compression only applies to the RFC 6455 protocol.
+        """
+        return None
+
     def open(self):
         """Invoked when a new WebSocket is opened.
 
@@ -243,6 +270,7 @@ class WebSocketProtocol(object):
         self.stream = handler.stream
         self.client_terminated = False
         self.server_terminated = False
+        self._flush_callback = None
 
     def async_callback(self, callback, *args, **kwargs):
         """Wrap callbacks with this if they are used on asynchronous requests.
@@ -265,6 +293,59 @@ class WebSocketProtocol(object):
     def on_connection_close(self):
         self._abort()
 
+    def _broadcast_key(self):
+        """Returns a hashable key shared by all connections to which
+        `_encode_for_connection` sends identical bytes for the same
+        message, or None if this connection's encoding depends on its
+        own history.
+        """
+        return self.__class__
+
+    def _encode_for_connection(self, message, binary=False):
+        """Returns the bytes that carry the given message on this
+        connection.  The bytes must be written before any other message
+        is encoded for this connection.
+        """
+        return self.encode_message(message, binary=binary)
+
+    def write_encoded_message(self, frame, callback=None):
+        """Sends a message that was already encoded with this class's
+        `encode_message`.  Used by `broadcast_message` to send the same
+        bytes to many clients.
+
+        If a callback is given, it is run when the stream's write buffer
+        has been flushed, as with `IOStream.write`.
+        """
+        if callback is not None:
+            self._flush_callback = callback
+        self._write(frame)
+
+    def set_flush_callback(self, callback):
+        """Runs the given callback once the stream's write buffer has
+        been flushed, or soon if nothing is being written.
+
+        Unlike the callback of `IOStream.write`, it is not dropped when
+        this connection writes another frame (a pong or a close) before
+        the buffer empties.
+        """
+        self._flush_callback = callback
+        if not self.stream.writing():
+            self.stream.io_loop.add_callback(self._on_flushed)
+
+    def _write(self, data):
+        """Writes to the stream, keeping any pending flush callback."""
+        self.stream.write(data, self._on_flushed)
+
+    def _on_flushed(self):
+        if self.stream.writing():
+            # More was written since this callback was scheduled; the
+            # later write's callback will run it.
+            return
+        callback = self._flush_callback
+        self._flush_callback = None
+        if callback is not None:
+            callback()
+
     def _abort(self):
         """Instantly aborts the WebSocket connection by closing the socket"""
         self.client_terminated = True
@@ -308,7 +389,7 @@ class WebSocketProtocol76(WebSocketProtocol):
         # This is necessary when using proxies (such as HAProxy), which
         # need to see the Upgrade headers before passing through the
         # non-HTTP traffic that follows.
-        self.stream.write(tornado.escape.utf8(
+        self._write(tornado.escape.utf8(
             "HTTP/1.1 101 WebSocket Protocol Handshake\r\n"
             "Upgrade: WebSocket\r\n"
             "Connection: Upgrade\r\n"
@@ -350,7 +431,7 @@ class WebSocketProtocol76(WebSocketProtocol):
         self._write_response(challenge_response)
 
     def _write_response(self, challenge):
-        self.stream.write(challenge)
+        self._write(challenge)
         self.async_callback(self.handler.open)(*self.handler.open_args, **self.handler.open_kwargs)
         self._receive_message()
 
@@ -412,19 +493,24 @@ class WebSocketProtocol76(WebSocketProtocol):
 
     def write_message(self, message, binary=False):
         """Sends the given message to the client of this Web Socket."""
+        self._write(self.encode_message(message, binary=binary))
+
+    @staticmethod
+    def encode_message(message, binary=False):
+        """Returns the bytes that carry the given message on the wire."""
         if binary:
             raise ValueError(
                 "Binary messages not supported by this version of websockets")
         if isinstance(message, unicode):
             message = message.encode("utf-8")
         assert isinstance(message, bytes_type)
-        self.stream.write(b("\x00") + message + b("\xff"))
+        return b("\x00") + message + b("\xff")
 
     def close(self):
         """Closes the WebSocket connection."""
         if not self.server_terminated:
             if not self.stream.closed():
-                self.stream.write("\xff\x00")
+                self._write("\xff\x00")
             self.server_terminated = True
         if self.client_terminated:
             if self._waiting is not None:
@@ -450,7 +536,12 @@ class WebSocketProtocol13(WebSocketProtocol):
         self._frame_length = None
         self._fragmented_message_buffer = None
         self._fragmented_message_opcode = None
+        self._frame_compressed = None
+        self._message_compressed = False
         self._waiting = None
+        self._compressor = None
+        self._decompressor = None
+        self._max_message_size = _DEFAULT_MAX_MESSAGE_SIZE
 
     def accept_connection(self):
         try:
@@ -488,42 +579,127 @@ class WebSocketProtocol13(WebSocketProtocol):
                 assert selected in subprotocols
                 subprotocol_header = "Sec-WebSocket-Protocol: %s\r\n" % selected
 
-        self.stream.write(tornado.escape.utf8(
+        extension_header = ''
+        compression_options = self.handler.get_compression_options()
+        if compression_options is not None:
+            offers = self.request.headers.get("Sec-WebSocket-Extensions", '')
+            for offer in offers.split(','):
+                response = self._negotiate_deflate(offer, compression_options)
+                if response is not None:
+                    extension_header = ("Sec-WebSocket-Extensions: %s\r\n" %
+                                        response)
+                    break
+
+        self._write(tornado.escape.utf8(
             "HTTP/1.1 101 Switching Protocols\r\n"
             "Upgrade: websocket\r\n"
             "Connection: Upgrade\r\n"
             "Sec-WebSocket-Accept: %s\r\n"
-            "%s"
-            "\r\n" % (self._challenge_response(), subprotocol_header)))
+            "%s%s"
+            "\r\n" % (self._challenge_response(), subprotocol_header,
+                       extension_header)))
 
         self.async_callback(self.handler.open)(*self.handler.open_args, **self.handler.open_kwargs)
         self._receive_frame()
 
-    def _write_frame(self, fin, opcode, data):
+    def _negotiate_deflate(self, offer, compression_options):
+        """Accepts a permessage-deflate extension offer from the client,
+        and sets up this connection's compressor and decompressor.
+        Returns the extension's response parameters, or None if the
+        offer is for another extension or cannot be accepted.
+        """
+        params = [p.strip() for p in offer.split(';')]
+        if params[0] != "permessage-deflate":
+            return None
+        args = {}
+        for param in params[1:]:
+            name, _, value = param.partition('=')
+            args[name.strip()] = value.strip().strip('"')
+        response = ["permessage-deflate"]
+        server_max_wbits = zlib.MAX_WBITS
+        for name, value in args.items():
+            if name == "server_max_window_bits":
+                try:
+                    server_max_wbits = int(value)
+                except ValueError:
+                    return None
+                # zlib cannot produce streams with 256-byte windows:
+                if not 9 <= server_max_wbits <= zlib.MAX_WBITS:
+                    return None
+                response.append("server_max_window_bits=%d" %
+                                server_max_wbits)
+            elif name not in ("server_no_context_takeover",
+                              "client_no_context_takeover",
+                              "client_max_window_bits"):
+                return None
+        server_persistent = (compression_options.get("context_takeover", False)
+                             and "server_no_context_takeover" not in args)
+        if not server_persistent:
+            response.append("server_no_context_takeover")
+        client_persistent = "client_no_context_takeover" not in args
+        if not client_persistent:
+            response.append("client_no_context_takeover")
+        self._compressor = _PerMessageDeflateCompressor(
+            server_persistent, server_max_wbits,
+            compression_options.get("compression_level", 6),
+            compression_options.get("mem_level", 8))
+        self._decompressor = _PerMessageDeflateDecompressor(client_persistent)
+        self._max_message_size = compression_options.get(
+            "max_message_size", _DEFAULT_MAX_MESSAGE_SIZE)
+        return "; ".join(response)
+
+    @staticmethod
+    def _build_frame(fin, opcode, data, rsv=0):
         if fin:
             finbit = 0x80
         else:
             finbit = 0
-        frame = struct.pack("B", finbit | opcode)
         l = len(data)
         if l < 126:
-            frame += struct.pack("B", l)
+            header = struct.pack("BB", finbit | rsv | opcode, l)
         elif l <= 0xFFFF:
-            frame += struct.pack("!BH", 126, l)
+            header = struct.pack("!BBH", finbit | rsv | opcode, 126, l)
         else:
-            frame += struct.pack("!BQ", 127, l)
-        frame += data
-        self.stream.write(frame)
+            header = struct.pack("!BBQ", finbit | rsv | opcode, 127, l)
+        return header + data
+
+    def _write_frame(self, fin, opcode, data):
+        self._write(self._build_frame(fin, opcode, data))
 
     def write_message(self, message, binary=False):
         """Sends the given message to the client of this Web Socket."""
+        self._write(self._encode_for_connection(message, binary=binary))
+
+    def _broadcast_key(self):
+        if self._compressor is None:
+            return self.__class__
+        return self._compressor.broadcast_key()
+
+    def _encode_for_connection(self, message, binary=False):
+        if self._compressor is None:
+            return self.encode_message(message, binary=binary)
         if binary:
             opcode = 0x2
         else:
             opcode = 0x1
         message = tornado.escape.utf8(message)
         assert isinstance(message, bytes_type)
-        self._write_frame(True, opcode, message)
+        # RSV1 marks the message as compressed:
+        return self._build_frame(True, opcode,
+                                 self._compressor.compress(message), rsv=0x40)
+
+    @classmethod
+    def encode_message(cls, message, binary=False):
+        """Returns the bytes of a single, unfragmented frame carrying
+        the given message.
+        """
+        if binary:
+            opcode = 0x2
+        else:
+            opcode = 0x1
+        message = tornado.escape.utf8(message)
+        assert isinstance(message, bytes_type)
+        return cls._build_frame(True, opcode, message)
 
     def _receive_frame(self):
         self.stream.read_bytes(2, self._on_frame_start)
@@ -534,6 +710,15 @@ class WebSocketProtocol13(WebSocketProtocol):
         reserved_bits = header & 0x70
         self._frame_opcode = header & 0xf
         self._frame_opcode_is_control = self._frame_opcode & 0x8
+        # RSV1 marks compressed messages. It is only allowed on the
+        # first frame of a data message, and only with permessage-deflate:
+        self._frame_compressed = bool(reserved_bits & 0x40)
+        if self._frame_compressed:
+            if (self._decompressor is None or self._frame_opcode_is_control
+                or self._frame_opcode == 0):
+                self._abort()
+                return
+            reserved_bits &= ~0x40
         if reserved_bits:
             # client is using as-yet-undefined extensions; abort
             self._abort()
@@ -596,6 +781,7 @@ class WebSocketProtocol13(WebSocketProtocol):
                 # can't start new message until the old one is finished
                 self._abort()
                 return
+            self._message_compressed = self._frame_compressed
             if self._final_frame:
                 opcode = self._frame_opcode
             else:
@@ -612,6 +798,16 @@ class WebSocketProtocol13(WebSocketProtocol):
         if self.client_terminated:
             return
 
+        if self._message_compressed and not (opcode & 0x8):
+            self._message_compressed = False
+            try:
+                data = self._decompressor.decompress(data,
+                                                     self._max_message_size)
+            except (zlib.error, ValueError):
+                # Corrupt, or a decompression bomb:
+                self._abort()
+                return
+
         if opcode == 0x1:
             # UTF-8 data
             try:
@@ -652,3 +848,126 @@ class WebSocketProtocol13(WebSocketProtocol):
             # otherwise just close the connection.
             self._waiting = self.stream.io_loop.add_timeout(
                 time.time() + 5, self._abort)
+
+
+class _PerMessageDeflateCompressor(object):
+    """Compresses outgoing messages for the permessage-deflate extension."""
+    def __init__(self, persistent, max_wbits, compression_level, mem_level):
+        self._max_wbits = max_wbits
+        self._compression_level = compression_level
+        self._mem_level = mem_level
+        if persistent:
+            self._compressor = self._create_compressor()
+        else:
+            self._compressor = None
+
+    def _create_compressor(self):
+        return zlib.compressobj(self._compression_level, zlib.DEFLATED,
+                                -self._max_wbits, self._mem_level)
+
+    def broadcast_key(self):
+        """Returns a key shared by all compressors that produce the same
+        bytes for the same message, or None if the output depends on
+        earlier messages.
+        """
+        if self._compressor is not None:
+            return None
+        return (WebSocketProtocol13, self._max_wbits,
+                self._compression_level, self._mem_level)
+
+    def compress(self, data):
+        compressor = self._compressor or self._create_compressor()
+        data = (compressor.compress(data) +
+                compressor.flush(zlib.Z_SYNC_FLUSH))
+        assert data.endswith(b("\x00\x00\xff\xff"))
+        return data[:-4]
+
+
+class _PerMessageDeflateDecompressor(object):
+    """Decompresses incoming messages for the permessage-deflate extension."""
+    def __init__(self, persistent):
+        if persistent:
+            self._decompressor = self._create_decompressor()
+        else:
+            self._decompressor = None
+
+    def _create_decompressor(self):
+        # A full-size window also decodes streams made with smaller ones:
+        return zlib.decompressobj(-zlib.MAX_WBITS)
+
+    def decompress(self, data, max_length):
+        """Returns the decompressed message.  Raises ValueError if it
+        is longer than max_length bytes, without decompressing the rest.
+        """
+        decompressor = self._decompressor or self._create_decompressor()
+        # One byte more than allowed tells a message that is too long
+        # from one that just fits:
+        data = decompressor.decompress(data + b("\x00\x00\xff\xff"),
+                                       max_length + 1)
+        if len(data) > max_length:
+            raise ValueError("Decompressed message exceeds %d bytes" %
+                             max_length)
+        return data
+
+
+class BroadcastMessage(object):
+    """A message to be sent to many `WebSocketHandler` instances.
+
+    The message is encoded at most once for each protocol version and
+    compression setting, the first time a handler using them asks for
+    it.  Those handlers share the encoded bytes.  Connections that keep
+    a compression context across messages get their own encoding.
+    """
+    def __init__(self, message, binary=False):
+        if isinstance(message, dict):
+            message = tornado.escape.json_encode(message)
+        self.message = message
+        self.binary = binary
+        self._frames = {}
+
+    def encode_for(self, handler):
+        """Returns the bytes to write to the given handler's connection,
+        or None if the connection is closed.  The bytes must be written
+        before another message is encoded for the same handler.  Raises
+        the same errors as `write_message` if the message cannot be encoded.
+        """
+        connection = handler.ws_connection
+        if connection is None:
+            return None
+        key = connection._broadcast_key()
+        if key is None:
+            return connection._encode_for_connection(
+                self.message, binary=self.binary)
+        frame = self._frames.get(key)
+        if frame is None:
+            frame = self._frames[key] = connection._encode_for_connection(
+                self.message, binary=self.binary)
+        return frame
+
+
+def broadcast_message(handlers, message, binary=False):
+    """Sends the same message to each of the given `WebSocketHandler`
+    instances.
+
+    The message is encoded only once for each protocol version and
+    compression setting in use among the handlers, and the resulting
+    bytes are shared by all of their streams (see `BroadcastMessage`).  This is much cheaper than
+    calling `write_message` on each handler when there are many clients.
+    Must be called on the handlers' IOLoop.
+
+    Returns the list of handlers to which the message could not be
+    written, for example because their connection has closed.  Raises
+    the same errors as `write_message` if the message cannot be encoded.
+    """
+    broadcast = BroadcastMessage(message, binary=binary)
+    failed = []
+    for handler in handlers:
+        frame = broadcast.encode_for(handler)
+        if frame is None:
+            failed.append(handler)
+            continue
+        try:
+            handler.ws_connection.write_encoded_message(frame)
+        except Exception:
+            failed.append(handler)
+    return failed
@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+
+'''
+Compact binary encoding of EchoTrees, as an alternative to JSON for
+clients on slow links or with little CPU. Browsers ask for it by
+offering the websocket subprotocol BINARY_TREE_SUBPROTOCOL.
+
+Format, all integers unsigned LEB128 varints:
+   magic      2 bytes, 'ET'
+   version    1 byte, BINARY_TREE_FORMAT_VERSION
+   numStrings
+   numStrings times: UTF-8 byte length, UTF-8 bytes
+   numNodes
+   numNodes times, in preorder: word index, number of children
+Word index 0 stands for a NULL word; index i > 0 is string i-1.
+Each distinct word is stored once. An empty message encodes 'no tree'.
+
+The reference decoder for browsers is decodeEchoTree() in
+browser_scripts/wordTreeListener.html.
+
+Usage: tree_codec.py [-n <numWords>] [<dbFile>]
+   prints a size and speed comparison of JSON and binary trees, computed
+   from the given SQLite word database; by default the one the server uses.
+'''
+
+import os;
+import sys;
+
+BINARY_TREE_SUBPROTOCOL    = 'echotree-binary-v1';
+BINARY_TREE_MAGIC          = 'ET';
+BINARY_TREE_FORMAT_VERSION = 1;
+
+# Database whose trees the comparison encodes, if none is given. The server's:
+DEFAULT_DB_PATH = os.path.join(os.path.realpath(os.path.dirname(__file__)), "Resources/EnronCollectionProcessed/EnronDB/enronDB.db");
+
+def encodeBinaryTree(wordTree):
+    '''
+    Return the binary encoding of a tree.
+    @param wordTree: tree as returned by WordExplorer.makeWordTree(), or None.
+    @type wordTree: {WordTreeNode | OrderedDict | None}
+    @rtype: string
+    '''
+    if wordTree is None:
+        return '';
+    wordIndexes = {None : 0};
+    strings = [];
+    nodeInts = [];
+    # Preorder walk without recursion:
+    stack = [wordTree];
+    while stack:
+        node = stack.pop();
+        word = node['word'];
+        wordIndex = wordIndexes.get(word);
+        if wordIndex is None:
+            strings.append(word);
+            wordIndex = wordIndexes[word] = len(strings);
+        children = node['followWordObjs'];
+        nodeInts.append(wordIndex);
+        nodeInts.append(len(children));
+        if children:
+            stack.extend(children[::-1]);
+    parts = [BINARY_TREE_MAGIC, chr(BINARY_TREE_FORMAT_VERSION), encodeVarint(len(strings))];
+    for word in strings:
+        if isinstance(word, unicode):
+            word = word.encode('utf-8');
+        parts.append(encodeVarint(len(word)));
+        parts.append(word);
+    parts.append(encodeVarint(len(nodeInts) / 2));
+    # Indexes and child counts nearly always fit into one byte:
+    if max(nodeInts) < 0x80:
+        parts.append(''.join(map(chr, nodeInts)));
+    else:
+        parts.extend([encodeVarint(num) for num in nodeInts]);
+    return ''.join(parts);
+
+def decodeBinaryTree(data):
+    '''
+    Reference decoder. Return the tree in the form json.loads() returns
+    for the tree's JSON encoding: nested dicts with keys 'word' and
+    'followWordObjs'.
+    @param data: a binary tree, as made by encodeBinaryTree()
+    @type data: string
+    @return: the tree, or None for an empty message.
+    @rtype: {dict | None}
+    @raise ValueError: if data is not a binary tree.
+    '''
+    if len(data) == 0:
+        return None;
+    if data[:2] != BINARY_TREE_MAGIC or ord(data[2]) != BINARY_TREE_FORMAT_VERSION:
+        raise ValueError("Not a version %d binary EchoTree." % BINARY_TREE_FORMAT_VERSION);
+    pos = 3;
+    (numStrings, pos) = decodeVarint(data, pos);
+    words = [None];
+    for dummy in range(numStrings):
+        (numBytes, pos) = decodeVarint(data, pos);
+        words.append(data[pos:pos + numBytes].decode('utf-8'));
+        pos += numBytes;
+    (numNodes, pos) = decodeVarint(data, pos);
+    root = None;
+    # Nodes whose children are still being read, with their number of missing children:
+    openNodes = [];
+    for dummy in range(numNodes):
+        (wordIndex, pos) = decodeVarint(data, pos);
+        (numChildren, pos) = decodeVarint(data, pos);
+        node = {'word' : words[wordIndex], 'followWordObjs' : []};
+        if root is None:
+            root = node;
+        else:
+            if len(openNodes) == 0:
+                raise ValueError("Binary EchoTree has more than one root.");
+            openNodes[-1][0]['followWordObjs'].append(node);
+            openNodes[-1][1] -= 1;
+            if openNodes[-1][1] == 0:
+                openNodes.pop();
+        if numChildren > 0:
+            openNodes.append([node, numChildren]);
+    if root is None or len(openNodes) > 0:
+        raise ValueError("Binary EchoTree is truncated.");
+    return root;
+
+def encodeVarint(num):
+    parts = [];
+    while num >= 0x80:
+        parts.append(chr((num & 0x7F) | 0x80));
+        num >>= 7;
+    parts.append(chr(num));
+    return ''.join(parts);
+
+def decodeVarint(data, pos):
+    '''
+    @return: the number at data[pos], and the position after it.
+    @rtype: (int, int)
+    '''
+    num = 0;
+    shift = 0;
+    while True:
+        if pos >= len(data):
+            raise ValueError("Binary EchoTree is truncated.");
+        byte = ord(data[pos]);
+        pos += 1;
+        num |= (byte & 0x7F) << shift;
+        if byte < 0x80:
+            return (num, pos);
+        shift += 7;
+
+if __name__ == '__main__':
+
+    import json;
+    import time;
+    import zlib;
+    import argparse;
+    import sqlite3;
+
+    from echo_tree import WordExplorer;
+
+    parser = argparse.ArgumentParser(prog='tree_codec');
+    parser.add_argument("dbFile", nargs='?', default=DEFAULT_DB_PATH,
+                        help="SQLite database with an EnronWords table, as made by make_database_from_emails.py. Default: %s." % DEFAULT_DB_PATH);
+    parser.add_argument("-n", "--numWords", type=int, default=200, dest='numWords',
+                        help="number of root words to compare, most frequent first. Default: 200.");
+    args = parser.parse_args();
+
+    if not os.path.isfile(args.dbFile):
+        print "Database %s does not exist." % args.dbFile;
+        sys.exit(1);
+    conn = sqlite3.connect(args.dbFile);
+    try:
+        rootWords = [row[0] for row in conn.execute('SELECT word from EnronWords where follower is not null GROUP BY word ORDER BY count(*) desc LIMIT ?', (args.numWords,))];
+    except sqlite3.DatabaseError as e:
+        print "Cannot select root words from %s: %s" % (args.dbFile, str(e));
+        sys.exit(1);
+    finally:
+        conn.close();
+    explorer = WordExplorer(args.dbFile);
+    trees = [explorer.makeWordTree(word) for word in rootWords];
+
+    def timeIt(func, inputs):
+        startTime = time.time();
+        outputs = [func(item) for item in inputs];
+        return (outputs, (time.time() - startTime) / max(len(inputs), 1) * 1000000);
+
+    (jsonTrees, jsonEncodeTime)     = timeIt(explorer.makeJSONTree, trees);
+    (binaryTrees, binaryEncodeTime) = timeIt(encodeBinaryTree, trees);
+    (jsonDecoded, jsonDecodeTime)   = timeIt(json.loads, jsonTrees);
+    (binaryDecoded, binaryDecodeTime) = timeIt(decodeBinaryTree, binaryTrees);
+    if jsonDecoded != binaryDecoded:
+        print "Binary and JSON trees differ!";
+        sys.exit(1);
+
+    def deflatedSize(data):
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS);
+        return len(compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)) - 4;
+
+    numTrees = max(len(trees), 1);
+    print "%d trees of depth 3 and breadth 5." % len(trees);
+    print "%-8s %12s %16s %16s %16s" % ("Format", "Mean bytes", "Mean deflated", "Encode usec/tree", "Decode usec/tree");
+    for (name, encoded, encodeTime, decodeTime) in [("JSON", jsonTrees, jsonEncodeTime, jsonDecodeTime),
+                                                     ("Binary", binaryTrees, binaryEncodeTime, binaryDecodeTime)]:
+        print "%-8s %12.0f %16.0f %16.1f %16.1f" % (name,
+                                                   sum([len(data) for data in encoded]) / float(numTrees),
+                                                   sum([deflatedSize(data) for data in encoded]) / float(numTrees),
+                                                   encodeTime,
+                                                   decodeTime);
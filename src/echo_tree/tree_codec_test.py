@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+
+'''
+Tests that binary EchoTrees decode to the same trees as their JSON encoding.
+'''
+
+import json;
+import unittest;
+
+from echo_tree import WordExplorer;
+from tree_codec import encodeBinaryTree, decodeBinaryTree, encodeVarint, decodeVarint;
+from echo_tree_testing import EchoTreeTestCase, TEST_FOLLOWERS;
+
+def makeTree(word, children=()):
+    return {'word' : word, 'followWordObjs' : list(children)};
+
+class TreeCodecTest(EchoTreeTestCase):
+
+    def assertRoundTrip(self, wordTree, jsonTree):
+        self.assertEqual(decodeBinaryTree(encodeBinaryTree(wordTree)), json.loads(jsonTree));
+
+    def test_explorer_trees(self):
+        for compactTrees in (True, False):
+            explorer = WordExplorer(self.dbPath, compactTrees=compactTrees);
+            for word in sorted(TEST_FOLLOWERS.keys()) + ['unknown']:
+                (wordTree, jsonTree) = explorer.makeWordTreeAndJSON(word, maxDepth=4, maxBranch=5);
+                self.assertRoundTrip(wordTree, jsonTree);
+
+    def test_null_and_unicode_words(self):
+        wordTree = makeTree(u'caf\xe9', [makeTree(None), makeTree('the', [makeTree(u'caf\xe9')])]);
+        self.assertRoundTrip(wordTree, json.dumps(wordTree));
+
+    def test_repeated_words_are_stored_once(self):
+        wordTree = makeTree('the', [makeTree('cat', [makeTree('the')]), makeTree('cat')]);
+        self.assertEqual(encodeBinaryTree(wordTree).count('cat'), 1);
+        self.assertRoundTrip(wordTree, json.dumps(wordTree));
+
+    def test_multi_byte_indexes(self):
+        # More than 127 distinct words and children need multi-byte varints:
+        wordTree = makeTree('root', [makeTree('w%d' % i) for i in range(300)]);
+        self.assertRoundTrip(wordTree, json.dumps(wordTree));
+
+    def test_no_tree(self):
+        self.assertEqual(encodeBinaryTree(None), '');
+        self.assertEqual(decodeBinaryTree(''), None);
+
+    def test_varints(self):
+        for num in (0, 1, 0x7f, 0x80, 0x3fff, 0x4000, 2 ** 32):
+            data = 'x' + encodeVarint(num);
+            self.assertEqual(decodeVarint(data, 1), (num, len(data)));
+
+    def test_malformed_data(self):
+        data = encodeBinaryTree(makeTree('the', [makeTree('cat'), makeTree('dog')]));
+        self.assertRaises(ValueError, decodeBinaryTree, 'XX' + data[2:]);
+        self.assertRaises(ValueError, decodeBinaryTree, data[:-1]);
+        self.assertRaises(ValueError, decodeBinaryTree, data[:3]);
+
+if __name__ == '__main__':
+    unittest.main();
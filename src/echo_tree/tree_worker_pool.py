@@ -0,0 +1,535 @@
+#!/usr/bin/env python
+
+'''
+Pool of worker processes that compute JSON EchoTrees. Lets the
+EchoTree server build trees on several cores, outside of the process
+whose IOLoop serves the browsers. Each worker holds its own
+WordExplorer. Point the workers at a graph file (see follower_graph.py)
+to have them share a single copy of the word data in the OS page cache.
+
+Results are delivered to callbacks that run on a Tornado IOLoop,
+never on a pool thread. Workers send back only the JSON of a tree and
+the words it shows, never the Python tree, so that little has to be 
+pickled and unpickled per result. Finished trees are cached in the server
+process. Concurrent requests for the same tree share one computation.
+Requests can be withdrawn; a computation that nobody waits for any
+more is cancelled, and its worker abandons the tree at the next level.
+
+After a requested tree is finished, the pool can speculatively compute
+the trees of the words shown in it, since the next submission is
+usually one of them. Prefetches are queued per requester, typically a
+channel, and only use workers that would otherwise be idle. A new
+request cancels the prefetches of its requester that have not started
+yet. When a requested tree finds no idle worker, a running prefetch
+that nobody waits for is cancelled to make room.
+
+The pool can move to another database, or to a rebuilt version of the
+same file, while it serves requests. Each task names the database and 
+the version (see echo_tree.getDatabaseVersion()) it is computed from, and
+workers open databases as tasks name them, keeping the WORKER_MAX_DATABASES
+most recent ones.
+prepareDatabase() computes the hot trees from the new database, and 
+useDatabase() has later tasks name it. No worker processes are forked
+after the pool started.
+'''
+
+import sys;
+import time;
+import functools;
+import threading;
+import traceback;
+import multiprocessing;
+from collections import OrderedDict;
+
+from tornado.ioloop import IOLoop;
+
+from echo_tree import WordExplorer, TreeCache, TreeComputationCancelled, getDatabaseVersion, WORD_TREE_DEPTH, WORD_TREE_BREADTH;
+from follower_graph import FollowerGraph;
+
+DEFAULT_NUM_TREE_WORKERS = multiprocessing.cpu_count();
+
+# Number of slots in the shared table through which the server
+# process cancels tasks. Task N is cancelled when slot N % CANCEL_TABLE_SIZE
+# holds N. Must exceed the number of tasks outstanding at any one time:
+CANCEL_TABLE_SIZE = 4096;
+
+# Number of databases a worker keeps open. Two, so that tasks queued
+# before a database swap need not reopen the old database. Older ones
+# are closed:
+WORKER_MAX_DATABASES = 2;
+
+# The WordExplorers of a worker process, keyed by database path and
+# version, most recently used last; whether to load databases into memory; and the 
+# shared table of cancelled tasks. Set by initTreeWorker():
+workerExplorers = OrderedDict();
+workerUsesInMemoryGraph = False;
+workerCancelTable = None;
+
+def initTreeWorker(dbPath, dbVersion, useInMemoryGraph, cancelTable):
+    '''
+    Runs once in each worker process when the pool starts.
+    @param dbPath: SQLite database or graph file for the worker's first WordExplorer.
+    @type dbPath: string
+    @param dbVersion: version of dbPath, as returned by getDatabaseVersion().
+    @type dbVersion: string
+    @param useInMemoryGraph: if True, load SQLite databases into in-memory FollowerGraphs.
+    @type useInMemoryGraph: boolean
+    @param cancelTable: shared array of cancelled task IDs.
+    @type cancelTable: multiprocessing.RawArray
+    '''
+    global workerUsesInMemoryGraph, workerCancelTable;
+    workerCancelTable = cancelTable;
+    workerUsesInMemoryGraph = useInMemoryGraph;
+    getWorkerExplorer(dbPath, dbVersion);
+
+def getWorkerExplorer(dbPath, dbVersion):
+    '''
+    Return the worker's WordExplorer for the given version of a database,
+    opening the database if needed. A database rebuilt at the same path 
+    has a new version, and is therefore opened afresh, with empty caches.
+    '''
+    key = (dbPath, dbVersion);
+    try:
+        workerExplorers[key] = workerExplorer = workerExplorers.pop(key);
+        return workerExplorer;
+    except KeyError:
+        pass;
+    if workerUsesInMemoryGraph:
+        workerExplorer = WordExplorer(dbPath, graph=FollowerGraph.fromSQLite(dbPath));
+    else:
+        workerExplorer = WordExplorer(dbPath);
+    workerExplorers[key] = workerExplorer;
+    while len(workerExplorers) > WORKER_MAX_DATABASES:
+        # Workers run one task at a time, so no task uses the evicted explorer:
+        workerExplorers.popitem(last=False)[1].close();
+    return workerExplorer;
+
+def isTaskCancelled(taskID):
+    return workerCancelTable[taskID % CANCEL_TABLE_SIZE] == taskID;
+
+def computeJSONTree(taskID, dbPath, dbVersion, word, maxDepth, maxBranch):
+    '''
+    Runs in a worker process. Never raises, because Python 2 pools
+    drop the callbacks of failed tasks. The Python tree stays in the 
+    worker; only what the server needs is pickled back.
+    @param dbPath: database to compute the tree from.
+    @type dbPath: string
+    @param dbVersion: version of dbPath that the server expects.
+    @type dbVersion: string
+    @return: the words of the tree below the root as returned by getTreeWords(), 
+             or None; the JSON tree or None; an error message or None; and the
+             computation time in seconds. Words, tree, and error message are all
+             None if the task was cancelled.
+    @rtype: ({[string] | None}, {string | None}, {string | None}, float)
+    '''
+    startTime = time.time();
+    try:
+        (wordTree, jsonTree) = getWorkerExplorer(dbPath, dbVersion).makeWordTreeAndJSON(word, maxDepth=maxDepth, maxBranch=maxBranch,
+                                                                             isCancelled=functools.partial(isTaskCancelled, taskID));
+        # Trees from a tree store come without Python tree:
+        treeWords = getTreeWords(wordTree) if wordTree is not None else [];
+        return (treeWords, jsonTree, None, time.time() - startTime);
+    except TreeComputationCancelled:
+        return (None, None, None, time.time() - startTime);
+    except Exception:
+        return (None, None, traceback.format_exc(), time.time() - startTime);
+
+def getTreeWords(wordTree):
+    '''
+    Return the words of the given tree below the root, level by level.
+    Within each level, the words of one parent are in decreasing
+    frequency order. Duplicates and NULL words are omitted.
+    @param wordTree: tree as returned by WordExplorer.makeWordTree()
+    @type wordTree: {WordTreeNode | OrderedDict}
+    @rtype: [string]
+    '''
+    treeWords = [];
+    seen = set([wordTree['word']]);
+    level = wordTree['followWordObjs'];
+    while len(level) > 0:
+        nextLevel = [];
+        for subtree in level:
+            word = subtree['word'];
+            if word is not None and word not in seen:
+                seen.add(word);
+                treeWords.append(word);
+            nextLevel.extend(subtree['followWordObjs']);
+        level = nextLevel;
+    return treeWords;
+
+# ------------------------------- class JSON Tree Cache ---------------------
+class JSONTreeCache(TreeCache):
+    '''
+    TreeCache of the server process. Entries hold the words of a tree,
+    as returned by getTreeWords(), in place of the Python tree, which 
+    stays in the worker that computed it. get() returns (treeWords, jsonTree).
+    '''
+
+    def put(self, word, maxDepth, maxBranch, treeWords, jsonTree):
+        '''
+        Add or replace the cached tree for the given root word and tree shape.
+        @param treeWords: words of the tree below the root.
+        @type treeWords: [string]
+        @param jsonTree: the JSON tree.
+        @type jsonTree: string
+        '''
+        numBytes = sys.getsizeof(jsonTree) + sys.getsizeof(treeWords) + sum([sys.getsizeof(treeWord) for treeWord in treeWords]);
+        self.store((word, maxDepth, maxBranch), (treeWords, jsonTree), numBytes);
+
+# ------------------------------- classes Tree Task and Tree Request ---------------------
+class TreeTask(object):
+    '''
+    One tree computation handed to the worker processes.
+    '''
+    __slots__ = ('key', 'taskID', 'requests', 'isPrefetch', 'prefetchRequesters', 'generation');
+
+    def __init__(self, key, taskID, generation, isPrefetch=False):
+        self.key = key;
+        self.taskID = taskID;
+        # Database generation of the workers that run the task:
+        self.generation = generation;
+        # TreeRequest instances waiting for the result:
+        self.requests = [];
+        self.isPrefetch = isPrefetch;
+        # Requesters for which the tree's words are prefetched once the tree is done:
+        self.prefetchRequesters = set();
+
+class TreeRequest(object):
+    '''
+    Handle returned by TreeWorkerPool.computeTree(). Pass it to
+    TreeWorkerPool.cancelRequest() to withdraw the request.
+    '''
+    __slots__ = ('task', 'callback');
+
+    def __init__(self, task, callback):
+        self.task = task;
+        self.callback = callback;
+
+# ------------------------------- class Tree Worker Pool ---------------------
+class TreeWorkerPool(object):
+    '''
+    Computes JSON EchoTrees in a pool of worker processes. Create
+    instances before starting any threads, since the workers are forked.
+    '''
+
+    def __init__(self, dbPath, numWorkers=DEFAULT_NUM_TREE_WORKERS, useInMemoryGraph=False, ioLoop=None, treeCache=None, treeStore=None):
+        '''
+        Start the worker processes.
+        @param dbPath: SQLite database or graph file the workers build trees from.
+        @type dbPath: string
+        @param numWorkers: number of worker processes.
+        @type numWorkers: int
+        @param useInMemoryGraph: if True, each worker loads an SQLite database into its
+                                 own in-memory FollowerGraph.
+        @type useInMemoryGraph: boolean
+        @param ioLoop: IOLoop on which result callbacks run. Default: IOLoop.instance()
+        @type ioLoop: IOLoop
+        @param treeCache: cache for finished trees in this process. Default: a JSONTreeCache
+                          with default budget.
+        @type treeCache: JSONTreeCache
+        @param treeStore: precomputed trees, served in this process without asking a worker.
+        @type treeStore: {PrecomputedTreeStore | None}
+        '''
+        if numWorkers <= 0:
+            raise ValueError("Number of tree worker processes must be a positive integer.");
+        if treeCache is None:
+            treeCache = JSONTreeCache();
+        self.numWorkers = numWorkers;
+        # Database that new tasks are computed from, and its version. Changed by useDatabase():
+        self.dbPath = dbPath;
+        self.dbVersion = getDatabaseVersion(dbPath);
+        self.ioLoop = ioLoop;
+        self.treeCache = treeCache;
+        self.treeStore = treeStore;
+        # Guards the bookkeeping below, which is used from IOLoop
+        # threads, and from the pool's result handler thread:
+        self.lock = threading.Lock();
+        # (word, maxDepth, maxBranch) --> TreeTask computing that tree.
+        # Cancelled tasks are removed, even while a worker still runs them:
+        self.inFlight = {};
+        # Number of tasks handed to workers whose results have not arrived:
+        self.numRunning = 0;
+        self.nextTaskID = 1;
+        self.cancelTable = multiprocessing.RawArray('l', CANCEL_TABLE_SIZE);
+        # Requester --> keys of trees to prefetch for it when workers become idle, 
+        # in priority order. Requesters take turns:
+        self.prefetchQueues = OrderedDict();
+        self.numPrefetchesStarted   = 0;
+        self.numPrefetchesCancelled = 0;
+        self.numSharedRequests      = 0;
+        self.numTasksCancelled      = 0;
+        # Incremented by useDatabase(). Results of earlier generations are not cached:
+        self.generation = 0;
+        # Set by stop(). No prefetches are started afterwards:
+        self.stopped = False;
+        self.pool = multiprocessing.Pool(numWorkers, initTreeWorker, (dbPath, self.dbVersion, useInMemoryGraph, self.cancelTable));
+
+    def getIOLoop(self):
+        if self.ioLoop is None:
+            return IOLoop.instance();
+        return self.ioLoop;
+
+    def getNumPending(self):
+        '''
+        Return the number of trees, including prefetches, that workers are computing.
+        '''
+        return self.numRunning;
+
+    def computeTree(self, word, callback, maxDepth=WORD_TREE_DEPTH, maxBranch=WORD_TREE_BREADTH, prefetchFollowers=False, requester=None):
+        '''
+        Have a worker compute the JSON tree for the given root word, unless
+        the tree is cached or already being computed. Returns immediately.
+        Cancels the requester's prefetches that have not started yet. If
+        all workers are busy, cancels a running prefetch that no request 
+        waits for. Safe to call from any thread.
+        @param word: root word.
+        @type word: string
+        @param callback: called on the IOLoop as callback(word, jsonTree, errorMsg, computeTime).
+                         jsonTree is None if the computation failed; errorMsg then holds 
+                         the worker's traceback. computeTime is 0 for cached trees.
+                         Not called if the request is cancelled first.
+        @type callback: callable
+        @param maxDepth: tree depth. See WordExplorer.makeWordTree()
+        @type maxDepth: int
+        @param maxBranch: tree breadth. See WordExplorer.makeWordTree()
+        @type maxBranch: int
+        @param prefetchFollowers: if True, prefetch the trees of the words in this tree.
+        @type prefetchFollowers: boolean
+        @param requester: whoever makes the request, typically a channel ID. Prefetches
+                          are queued and cancelled per requester.
+        @type requester: hashable
+        @return: handle for cancelRequest(), or None if the tree was served from the store or cache.
+        @rtype: {TreeRequest | None}
+        '''
+        if self.treeStore is not None:
+            jsonTree = self.treeStore.get(word, maxDepth, maxBranch);
+            if jsonTree is not None:
+                # The store typically holds the words of stored trees as well; no prefetching:
+                self.getIOLoop().add_callback(functools.partial(callback, word, jsonTree, None, 0.0));
+                return None;
+        key = (word, maxDepth, maxBranch);
+        with self.lock:
+            self.numPrefetchesCancelled += len(self.prefetchQueues.pop(requester, ()));
+            try:
+                (treeWords, jsonTree) = self.treeCache.get(word, maxDepth, maxBranch);
+            except KeyError:
+                jsonTree = None;
+            if jsonTree is None:
+                try:
+                    # Already being computed, maybe as a prefetch:
+                    task = self.inFlight[key];
+                    self.numSharedRequests += 1;
+                except KeyError:
+                    if self.numRunning >= self.numWorkers:
+                        self.cancelRunningPrefetch();
+                    task = self.startTask(key);
+                if prefetchFollowers:
+                    task.prefetchRequesters.add(requester);
+                request = TreeRequest(task, callback);
+                task.requests.append(request);
+                return request;
+            if prefetchFollowers:
+                self.queuePrefetches(treeWords, maxDepth, maxBranch, requester);
+        self.getIOLoop().add_callback(functools.partial(callback, word, jsonTree, None, 0.0));
+        return None;
+
+    def cancelRequest(self, request):
+        '''
+        Withdraw a request made via computeTree(). Its callback will not be
+        called. If no other request waits for the same tree, the computation
+        is cancelled, also if it started as a prefetch. Safe to call from any
+        thread, also after the result was delivered.
+        @param request: handle returned by computeTree(). None is ignored.
+        @type request: {TreeRequest | None}
+        '''
+        if request is None:
+            return;
+        task = request.task;
+        with self.lock:
+            try:
+                task.requests.remove(request);
+            except ValueError:
+                return;
+            if len(task.requests) > 0 or self.inFlight.get(task.key) is not task:
+                return;
+            self.cancelTask(task);
+            self.numTasksCancelled += 1;
+
+    def cancelTask(self, task):
+        # Caller holds self.lock. The worker abandons the tree at the next level:
+        del self.inFlight[task.key];
+        self.cancelTable[task.taskID % CANCEL_TABLE_SIZE] = task.taskID;
+
+    def cancelRunningPrefetch(self):
+        '''
+        Cancel the most recently started prefetch that no request waits for, 
+        so that its worker becomes free for a requested tree. Caller holds self.lock.
+        @return: True if a prefetch was cancelled.
+        @rtype: boolean
+        '''
+        prefetches = [task for task in self.inFlight.itervalues() if task.isPrefetch and len(task.requests) == 0];
+        if len(prefetches) == 0:
+            return False;
+        self.cancelTask(max(prefetches, key=lambda task: task.taskID));
+        self.numPrefetchesCancelled += 1;
+        return True;
+
+    def startTask(self, key, isPrefetch=False):
+        # Caller holds self.lock.
+        (word, maxDepth, maxBranch) = key;
+        task = TreeTask(key, self.nextTaskID, self.generation, isPrefetch);
+        self.nextTaskID += 1;
+        self.inFlight[key] = task;
+        self.numRunning += 1;
+        self.pool.apply_async(computeJSONTree, (task.taskID, self.dbPath, self.dbVersion, word, maxDepth, maxBranch),
+                              callback=functools.partial(self.onResult, task));
+        return task;
+
+    def queuePrefetches(self, treeWords, maxDepth, maxBranch, requester):
+        '''
+        Queue the trees of the given words for prefetching on behalf
+        of the requester, replacing the requester's earlier prefetches that
+        have not started. Starts as many as there are idle workers.
+        Caller holds self.lock.
+        @param treeWords: words of a tree, as returned by getTreeWords().
+        @type treeWords: [string]
+        '''
+        prefetchQueue = [];
+        for word in treeWords:
+            if (word, maxDepth, maxBranch) in self.treeCache:
+                continue;
+            if self.treeStore is not None and self.treeStore.get(word, maxDepth, maxBranch) is not None:
+                continue;
+            prefetchQueue.append((word, maxDepth, maxBranch));
+        self.numPrefetchesCancelled += len(self.prefetchQueues.pop(requester, ()));
+        if len(prefetchQueue) > 0:
+            self.prefetchQueues[requester] = prefetchQueue;
+        self.startPrefetches();
+
+    def startPrefetches(self):
+        # Caller holds self.lock. Takes one key from each requester's queue in turn:
+        while not self.stopped and len(self.prefetchQueues) > 0 and self.numRunning < self.numWorkers:
+            (requester, prefetchQueue) = self.prefetchQueues.popitem(last=False);
+            key = prefetchQueue.pop(0);
+            if len(prefetchQueue) > 0:
+                self.prefetchQueues[requester] = prefetchQueue;
+            if key in self.inFlight or key in self.treeCache:
+                continue;
+            self.numPrefetchesStarted += 1;
+            self.startTask(key, isPrefetch=True);
+
+    def onResult(self, task, result):
+        # Runs on the pool's result handler thread.
+        (word, maxDepth, maxBranch) = task.key;
+        (treeWords, jsonTree, errorMsg, computeTime) = result;
+        with self.lock:
+            self.numRunning -= 1;
+            if self.inFlight.get(task.key) is task:
+                del self.inFlight[task.key];
+            callbacks = [request.callback for request in task.requests];
+            # Later cancelRequest() calls for this task are no-ops:
+            task.requests = [];
+            # Trees of a replaced database still go to their requests, but not into the cache:
+            if jsonTree is not None and task.generation == self.generation:
+                self.treeCache.put(word, maxDepth, maxBranch, treeWords, jsonTree);
+                for requester in task.prefetchRequesters:
+                    self.queuePrefetches(treeWords, maxDepth, maxBranch, requester);
+            # A worker just became idle:
+            self.startPrefetches();
+        # Hand off to the IOLoop:
+        for callback in callbacks:
+            self.getIOLoop().add_callback(functools.partial(callback, word, jsonTree, errorMsg, computeTime));
+
+    def getHotTreeKeys(self, maxKeys=None):
+        '''
+        Return the keys of the cached trees, most recently used first.
+        @param maxKeys: max number of keys to return. None for all.
+        @type maxKeys: {int | None}
+        @rtype: [(string, int, int)]
+        '''
+        return self.treeCache.getKeys(maxKeys);
+
+    def prepareDatabase(self, dbPath, treeStore=None, warmUpKeys=(), dbVersion=None):
+        '''
+        Have the workers compute the given trees from another database, or
+        from a rebuilt version of the current one, alongside the requests 
+        they serve. Blocks until the trees are done, so call it from a thread
+        other than the IOLoop's. Hand the result to useDatabase().
+        @param dbPath: SQLite database or graph file.
+        @type dbPath: string
+        @param treeStore: precomputed trees of dbPath, or None.
+        @type treeStore: {PrecomputedTreeStore | None}
+        @param warmUpKeys: (word, maxDepth, maxBranch) of the trees to compute ahead,
+                           typically the result of getHotTreeKeys().
+        @type warmUpKeys: [(string, int, int)]
+        @param dbVersion: version of dbPath, as returned by getDatabaseVersion(). Default: 
+                          the version of the file now.
+        @type dbVersion: {string | None}
+        @return: dbPath, dbVersion, a tree cache holding the trees computed ahead, and treeStore.
+        @rtype: (string, string, JSONTreeCache, {PrecomputedTreeStore | None})
+        '''
+        if dbVersion is None:
+            dbVersion = getDatabaseVersion(dbPath);
+        treeCache = JSONTreeCache(self.treeCache.maxEntries, self.treeCache.maxBytes);
+        warmUpKeys = [key for key in warmUpKeys if treeStore is None or treeStore.get(*key) is None];
+        # Task ID -1 is never found in the cancel table:
+        results = [self.pool.apply_async(computeJSONTree, (-1, dbPath, dbVersion) + key) for key in warmUpKeys];
+        # Oldest first, so that the hottest trees end up most recently used:
+        for (key, result) in reversed(zip(warmUpKeys, results)):
+            (treeWords, jsonTree, errorMsg, dummyComputeTime) = result.get();
+            if errorMsg is not None:
+                raise IOError("Cannot compute trees from %s: %s" % (dbPath, errorMsg));
+            treeCache.put(key[0], key[1], key[2], treeWords, jsonTree);
+        return (dbPath, dbVersion, treeCache, treeStore);
+
+    def useDatabase(self, preparedDatabase):
+        '''
+        Have new tasks computed from the database prepared by prepareDatabase(),
+        and swap in its tree cache and tree store. Requests made earlier are
+        answered from the old database. New requests never share their 
+        computations. Safe to call from any thread.
+        @param preparedDatabase: result of prepareDatabase().
+        @type preparedDatabase: (string, string, JSONTreeCache, {PrecomputedTreeStore | None})
+        '''
+        (dbPath, dbVersion, treeCache, treeStore) = preparedDatabase;
+        with self.lock:
+            self.dbPath = dbPath;
+            self.dbVersion = dbVersion;
+            self.treeCache = treeCache;
+            self.treeStore = treeStore;
+            self.generation += 1;
+            self.inFlight = {};
+            self.numPrefetchesCancelled += self.getNumPrefetchesQueued();
+            self.prefetchQueues = OrderedDict();
+
+    def getNumPrefetchesQueued(self):
+        # Caller holds self.lock.
+        return sum(len(prefetchQueue) for prefetchQueue in self.prefetchQueues.itervalues());
+
+    def getStats(self):
+        '''
+        Return counters for the pool and its tree cache.
+        @rtype: {string : number}
+        '''
+        with self.lock:
+            return {'workers'             : self.numWorkers,
+                    'running'             : self.numRunning,
+                    'sharedRequests'      : self.numSharedRequests,
+                    'tasksCancelled'      : self.numTasksCancelled,
+                    'prefetchesQueued'    : self.getNumPrefetchesQueued(),
+                    'prefetchesStarted'   : self.numPrefetchesStarted,
+                    'prefetchesCancelled' : self.numPrefetchesCancelled,
+                    'treeCache'           : self.treeCache.getStats()
+                    };
+
+    def stop(self):
+        '''
+        Terminate the worker processes. Pending results are dropped.
+        '''
+        with self.lock:
+            # Results arriving while the pool terminates must not start
+            # prefetches; that would kill the pool's result handler thread:
+            self.stopped = True;
+            self.prefetchQueues.clear();
+        self.pool.terminate();
+        self.pool.join();
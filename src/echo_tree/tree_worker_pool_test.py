@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+
+'''
+Tests of TreeWorkerPool. Each test starts its own worker processes.
+Tests that need a worker to be busy occupy it with a sleep task, which
+the pool does not count as one of its own tasks.
+'''
+
+import time;
+import unittest;
+from collections import OrderedDict;
+
+from tornado.testing import AsyncTestCase;
+
+from echo_tree import WordExplorer, WORD_TREE_DEPTH, WORD_TREE_BREADTH;
+import tree_worker_pool;
+from tree_worker_pool import TreeWorkerPool, getTreeWords, getWorkerExplorer, WORKER_MAX_DATABASES;
+from echo_tree_testing import EchoTreeTestCase;
+
+# Seconds for which occupyWorker() keeps the worker busy:
+WORKER_BUSY_TIME = 0.5;
+
+class TreeWorkerPoolTest(AsyncTestCase, EchoTreeTestCase):
+
+    def setUp(self):
+        super(TreeWorkerPoolTest, self).setUp();
+        self.pool = TreeWorkerPool(self.dbPath, numWorkers=1, ioLoop=self.io_loop);
+        self.results = [];
+
+    def tearDown(self):
+        self.pool.stop();
+        super(TreeWorkerPoolTest, self).tearDown();
+
+    def onTree(self, word, jsonTree, errorMsg, computeTime):
+        self.results.append((word, jsonTree, errorMsg, computeTime));
+        self.stop();
+
+    def waitForResults(self, numResults):
+        while len(self.results) < numResults:
+            self.wait(timeout=10);
+
+    def occupyWorker(self):
+        self.pool.pool.apply_async(time.sleep, (WORKER_BUSY_TIME,));
+
+    def waitUntilIdle(self):
+        # Cancelled tasks still return a result, which is not passed to callbacks:
+        deadline = time.time() + 10;
+        while self.pool.getNumPending() > 0 and time.time() < deadline:
+            time.sleep(0.01);
+        self.assertEqual(self.pool.getNumPending(), 0);
+
+    def test_computes_and_caches_tree(self):
+        (expectedTree, expectedJSON) = WordExplorer(self.dbPath).makeWordTreeAndJSON('the', maxDepth=3, maxBranch=2);
+        self.assertTrue(self.pool.computeTree('the', self.onTree, maxDepth=3, maxBranch=2) is not None);
+        self.waitForResults(1);
+        self.assertEqual(self.results[0][:3], ('the', expectedJSON, None));
+        # Only the JSON and the tree's words came back from the worker:
+        self.assertEqual(self.pool.treeCache.lookup(('the', 3, 2)), (getTreeWords(expectedTree), expectedJSON));
+        # Served from the cache, without a handle:
+        self.assertTrue(self.pool.computeTree('the', self.onTree, maxDepth=3, maxBranch=2) is None);
+        self.waitForResults(2);
+        self.assertEqual(self.results[1], ('the', expectedJSON, None, 0.0));
+        self.assertEqual(self.pool.getStats()['treeCache']['hits'], 1);
+
+    def test_concurrent_requests_share_computation(self):
+        self.occupyWorker();
+        self.pool.computeTree('the', self.onTree);
+        self.pool.computeTree('the', self.onTree);
+        self.assertEqual(self.pool.getNumPending(), 1);
+        self.waitForResults(2);
+        self.assertEqual(self.results[0][1], self.results[1][1]);
+        self.assertEqual(self.pool.getStats()['sharedRequests'], 1);
+
+    def test_cancelled_request_is_not_answered(self):
+        self.occupyWorker();
+        request = self.pool.computeTree('the', self.onTree);
+        self.pool.cancelRequest(request);
+        self.waitUntilIdle();
+        # Would deliver any callback the IOLoop still holds:
+        self.io_loop.add_timeout(time.time() + 0.1, self.stop);
+        self.wait();
+        self.assertEqual(self.results, []);
+        self.assertFalse(('the', WORD_TREE_DEPTH, WORD_TREE_BREADTH) in self.pool.treeCache);
+        self.assertEqual(self.pool.getStats()['tasksCancelled'], 1);
+
+    def test_shared_computation_survives_one_cancellation(self):
+        self.occupyWorker();
+        staleRequest = self.pool.computeTree('the', self.onTree);
+        self.pool.computeTree('the', self.onTree);
+        self.pool.cancelRequest(staleRequest);
+        self.waitForResults(1);
+        self.assertTrue(self.results[0][1] is not None);
+        self.assertEqual(self.pool.getStats()['tasksCancelled'], 0);
+
+    def test_new_request_after_cancellation_recomputes(self):
+        self.occupyWorker();
+        self.pool.cancelRequest(self.pool.computeTree('the', self.onTree));
+        self.pool.computeTree('the', self.onTree);
+        self.waitForResults(1);
+        self.assertTrue(self.results[0][1] is not None);
+
+    def test_late_cancellation_is_ignored(self):
+        self.pool.cancelRequest(None);
+        request = self.pool.computeTree('the', self.onTree);
+        self.waitForResults(1);
+        self.pool.cancelRequest(request);
+        self.assertEqual(self.pool.getStats()['tasksCancelled'], 0);
+        self.assertTrue(('the', WORD_TREE_DEPTH, WORD_TREE_BREADTH) in self.pool.treeCache);
+
+    def test_prefetches_tree_words(self):
+        self.pool.computeTree('the', self.onTree, maxDepth=2, maxBranch=2, prefetchFollowers=True, requester='a');
+        self.waitForResults(1);
+        self.waitUntilIdle();
+        for word in ('cat', 'dog'):
+            self.assertTrue((word, 2, 2) in self.pool.treeCache);
+        self.assertEqual(self.pool.getStats()['prefetchesStarted'], 2);
+
+    def test_request_preempts_running_prefetch(self):
+        self.occupyWorker();
+        with self.pool.lock:
+            prefetch = self.pool.startTask(('cat', 2, 2), isPrefetch=True);
+        self.pool.computeTree('dog', self.onTree, maxDepth=2, maxBranch=2, requester='b');
+        self.assertFalse(('cat', 2, 2) in self.pool.inFlight);
+        self.assertEqual(self.pool.cancelTable[prefetch.taskID], prefetch.taskID);
+        self.waitForResults(1);
+        self.waitUntilIdle();
+        self.assertFalse(('cat', 2, 2) in self.pool.treeCache);
+        self.assertEqual(self.pool.getStats()['prefetchesCancelled'], 1);
+
+    def test_prefetches_are_queued_per_requester(self):
+        explorer = WordExplorer(self.dbPath);
+        self.occupyWorker();
+        # Keeps the only worker busy, so that prefetches stay queued:
+        self.pool.computeTree('on', self.onTree, maxDepth=2, maxBranch=2);
+        with self.pool.lock:
+            self.pool.queuePrefetches(getTreeWords(explorer.makeWordTree('the', maxDepth=2, maxBranch=2)), 2, 2, 'a');
+            self.pool.queuePrefetches(getTreeWords(explorer.makeWordTree('cat', maxDepth=2, maxBranch=2)), 2, 2, 'b');
+        self.assertEqual(self.pool.getStats()['prefetchesQueued'], 4);
+        # Only cancels the queued prefetches of its own requester:
+        self.pool.computeTree('dog', self.onTree, maxDepth=2, maxBranch=2, requester='b');
+        self.assertEqual(self.pool.prefetchQueues.keys(), ['a']);
+        self.assertEqual(self.pool.getStats()['prefetchesCancelled'], 2);
+
+    def test_no_prefetches_after_stop(self):
+        with self.pool.lock:
+            task = self.pool.startTask(('on', 2, 2));
+            task.prefetchRequesters.add('a');
+        self.pool.stop();
+        # As if the result arrived while the pool was terminating:
+        self.pool.onResult(task, (['the', 'a'], '{}', None, 0.1));
+        self.assertEqual(self.pool.getStats()['prefetchesStarted'], 0);
+
+    def test_worker_closes_evicted_databases(self):
+        # Runs the worker's part in this process:
+        savedExplorers = tree_worker_pool.workerExplorers;
+        tree_worker_pool.workerExplorers = OrderedDict();
+        try:
+            explorers = [getWorkerExplorer(self.dbPath, 'version%d' % i) for i in range(WORKER_MAX_DATABASES + 1)];
+            self.assertTrue(getWorkerExplorer(self.dbPath, 'version1') is explorers[1]);
+        finally:
+            tree_worker_pool.workerExplorers = savedExplorers;
+        self.assertEqual(explorers[0].db, None);
+        for explorer in explorers[1:]:
+            self.assertEqual(explorer.makeWordTree('the', maxDepth=1)['word'], 'the');
+            explorer.close();
+
+if __name__ == '__main__':
+    unittest.main();